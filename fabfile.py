@@ -305,16 +305,21 @@ def log(service='web'):
 @roles('commander')
 def commander(action):
     """
-    Run or stop the IL-2 DS commander.
+    Run, stop or restart the IL-2 DS commander. Connected users are asked
+    to stay connected while commander restarts.
 
     Arguments:
 
-    `action` - 'run' or 'stop'.
+    `action` - 'run', 'stop' or 'restart'.
 
     Example:
       fab commander:run
     """
-    dj("{0}_commander".format(action))
+    if action == 'restart':
+        dj("stop_commander --restart")
+        dj("run_commander")
+    else:
+        dj("{0}_commander".format(action))
 
 
 @task
@@ -12,20 +12,62 @@ class APICommandValueConstant(ValueConstant):
     Extends base class by providing support for creating a command with payload
     for commander's API.
     """
-    def to_request(self, payload=None):
+    def to_request(self, payload=None, request_id=None):
         """
         Make API command with payload and convert it to request in JSON format,
-        so it can be sent to commander.
+        so it can be sent to commander. Commander replies only to requests
+        with ID. Reply is a JSON list: [REQUEST_ID, ERROR, RESULT], where
+        ERROR is 'null' if request has succeeded.
         """
-        return json.dumps((self.value, payload, ))
+        return json.dumps(self.make_request(payload, request_id))
+
+    def make_request(self, payload=None, request_id=None):
+        """
+        Make API command with payload as a tuple, so it can be encoded by any
+        codec of commander's API.
+        """
+        request = (self.value, payload, )
+        if request_id is not None:
+            request += (request_id, )
+        return request
 
 
 class APIOpcode(Values):
     """
     Constants representing operation codes for commander API.
     """
-    # Stop commander and quit it.
+    # Stop commander and quit it. Payload: {"restart": true} if commander
+    # will be started again right away, so connected users are asked to stay.
     QUIT = APICommandValueConstant(1)
+    # Get list of online pilots with their state.
+    PILOTS = APICommandValueConstant(2)
+    # Kick pilot. Payload: callsign.
+    KICK = APICommandValueConstant(3)
+    # Send chat message. Payload: {"message": MESSAGE, "callsign": CALLSIGN},
+    # message is sent to everyone if callsign is not specified.
+    CHAT = APICommandValueConstant(4)
+    # Get status of current mission.
+    MISSION_STATUS = APICommandValueConstant(5)
+    # Get changes of online pilots' state. Payload: number of version of
+    # state known by client or 'null' to get the whole state.
+    TELEMETRY = APICommandValueConstant(6)
+    # Switch connection to length-prefixed frames. Payload: name of codec of
+    # frames' bodies ("json" or "msgpack"). Request must have an ID. Reply
+    # is the last message sent before switching.
+    FRAMING = APICommandValueConstant(7)
+    # Get statistics of queue of console commands: number of queued and sent
+    # commands, rate limiting and waiting time for every priority class.
+    CONSOLE_STATS = APICommandValueConstant(8)
+    # Get statistics of storing of events to database: number of queued,
+    # dropped, skipped, written and retried events and duration of the last
+    # batch.
+    EVENTS_STORE_STATS = APICommandValueConstant(9)
+    # Get statistics of cache of users: number of cached users, hits, misses
+    # and hit rate.
+    USERS_STATS = APICommandValueConstant(10)
+    # Get statistics of collecting of pilots' info and positions: intervals
+    # and latencies of loops.
+    TELEMETRY_STATS = APICommandValueConstant(11)
 
 
 # A symbol or string used to identify user command and separate it's arguments
@@ -47,6 +89,8 @@ class UserCommand(Values):
     Commands which can be sent by users to server from game chat.
     """
     CONNECTION_PASSWORD = UserCommandValueConstant('pass')
+    # Ask about pilots of the same army and destroyed objects around
+    NEARBY = UserCommandValueConstant('near')
 
     @classmethod
     def decompose(cls, string):
@@ -62,3 +106,20 @@ class UserCommand(Values):
             raise
         else:
             return (command, components)
+
+
+class ConsolePriority(Values):
+    """
+    Priority classes of commands sent to game server's console. Commands of
+    higher classes are sent first. Classes are listed in order of priority.
+    """
+    # Mission loading, beginning and ending
+    CONTROL = ValueConstant('control')
+    # Kicking users
+    KICK = ValueConstant('kick')
+    # Direct replies to users' actions, e.g. to given connection passwords
+    REPLY = ValueConstant('reply')
+    # Requests of server's state, e.g. mission status or users' info
+    QUERY = ValueConstant('query')
+    # Chat messages
+    CHAT = ValueConstant('chat')
@@ -2,19 +2,17 @@
 """
 Commander helping functions.
 """
-import socket
 import tx_logging
 
 from commander import settings
-from commander.protocol.blocking import api_create_client_socket
-from commander.sharing import (shared_storage, KEY_SERVER_RUNNING,
-    KEY_SERVER_NAME, KEY_SERVER_LOCAL_ADDRESS, KEY_SERVER_USER_PORT,
-    KEY_SERVER_CHANNELS, KEY_SERVER_DIFFICULTY, KEY_SERVER_UPDATE_TOKEN, )
+from commander.protocol.blocking import api_pool
+from commander.sharing import (shared_storage, KEY_SERVER_INFO,
+    FIELD_SERVER_NAME, FIELD_SERVER_LOCAL_ADDRESS, FIELD_SERVER_USER_PORT,
+    FIELD_SERVER_CHANNELS, FIELD_SERVER_DIFFICULTY, KEY_PILOTS_VERSION,
+    CHANNEL_USER_CHANGED, )
 
 from il2ds_difficulty import decompose_difficulty_to_tabs
 
-from misc.helpers import current_time_hash
-
 
 LOG = tx_logging.getLogger(__name__)
 
@@ -23,55 +21,150 @@ def is_server_running():
     """
     Tell whether game server is running. Values is read from shared storage.
     """
-    return shared_storage.exists(KEY_SERVER_RUNNING)
+    return shared_storage.exists(KEY_SERVER_INFO)
 
 
 def is_commander_running():
     """
     Tell whether commander is running. It is considered to be running if
     information about game server is present in the shared storage or if
-    commander's API socket exists.
+    connection with commander's API can be established.
     """
-    if is_server_running():
-        return True
-    try:
-        s = api_create_client_socket()
-    except socket.error:
-        return False
-    else:
-        s.close()
-        return True
+    return is_server_running() or api_pool.is_available()
 
 
 def get_server_info():
-    if not is_server_running():
-        return None
+    return get_server_info_n_version()[0]
 
-    difficulty = int(shared_storage.get(KEY_SERVER_DIFFICULTY))
-    return {
-        'name': shared_storage.get(KEY_SERVER_NAME),
+
+def get_server_info_n_version():
+    """
+    Read information about game server and its version with a single
+    request to shared storage.
+
+    Output:
+    A tuple with a dictionary with server info (or 'None' if server is not
+    running) and integer number of version.
+    """
+    raw_info, version = shared_storage.get_server_info()
+    if not raw_info:
+        return None, version
+
+    difficulty = int(raw_info[FIELD_SERVER_DIFFICULTY])
+    info = {
+        'name': raw_info[FIELD_SERVER_NAME],
         'version': settings.IL2_VERSION,
         'mods': settings.IL2_PRESENT_MODS,
         'address': {
             'external': settings.IL2_EXTERNAL_ADDRESS,
-            'local': shared_storage.get(KEY_SERVER_LOCAL_ADDRESS),
-            'port': int(shared_storage.get(KEY_SERVER_USER_PORT)),
+            'local': raw_info[FIELD_SERVER_LOCAL_ADDRESS],
+            'port': int(raw_info[FIELD_SERVER_USER_PORT]),
         },
-        'channels': int(shared_storage.get(KEY_SERVER_CHANNELS)),
+        'channels': int(raw_info[FIELD_SERVER_CHANNELS]),
         'difficulty': decompose_difficulty_to_tabs(difficulty),
     }
+    return info, version
+
+
+def share_server_info(name, local_address, user_port, channels, difficulty):
+    """
+    Replace information about game server in shared storage and increment
+    its version at once.
+
+    Output:
+    New version of server info.
+    """
+    return shared_storage.set_server_info({
+        FIELD_SERVER_NAME: name,
+        FIELD_SERVER_LOCAL_ADDRESS: local_address,
+        FIELD_SERVER_USER_PORT: user_port,
+        FIELD_SERVER_CHANNELS: channels,
+        FIELD_SERVER_DIFFICULTY: difficulty,
+    })
+
+
+def clear_shared_storage():
+    """
+    Remove all shared information and increment version of server info at
+    once.
+
+    Output:
+    New version of server info.
+    """
+    return shared_storage.clear()
+
+
+def get_server_version():
+    """
+    Get version of server info. Version is incremented on every update of
+    server info, so it can be used to tell whether info was updated.
+    """
+    return shared_storage.get_server_version()
 
 
-def set_server_update_token():
-    token = current_time_hash()
-    shared_storage.set(KEY_SERVER_UPDATE_TOKEN, token)
-    return token
+def save_commander_snapshot(snapshot):
+    """
+    Save snapshot of commander's state to shared storage. Snapshot expires
+    after max age from settings.
+    """
+    shared_storage.save_snapshot(snapshot,
+                                 settings.COMMANDER_SNAPSHOT['max_age'])
+
+
+def pop_commander_snapshot():
+    """
+    Get snapshot of commander's state from shared storage and remove it, so
+    it will not be restored twice.
+    """
+    return shared_storage.pop_snapshot()
+
+
+def notify_user_changed(callsign):
+    """
+    Tell commander that user's data has changed, so it will not use outdated
+    data from its cache.
+    """
+    shared_storage.publish(CHANNEL_USER_CHANGED, callsign)
+
+
+def get_pilots_version():
+    """
+    Get version of online pilots' state. Compare it with a known one to tell
+    whether pilots have to be read again.
+    """
+    return int(shared_storage.get(KEY_PILOTS_VERSION) or 0)
 
 
-def get_server_update_token():
-    return shared_storage.get(KEY_SERVER_UPDATE_TOKEN) or \
-           set_server_update_token()
+def get_online_pilots():
+    """
+    Get a tuple with version of online pilots' state and a list of
+    dictionaries with state of each pilot.
+    """
+    return shared_storage.get_pilots()
 
 
-def server_info_was_updated(update_token):
-    return update_token != get_server_update_token()
+def get_radar(callsign):
+    """
+    Get the latest snapshot of radar picture as it is seen by army of given
+    pilot: only pilots who are visible for the army and counts of the army's
+    pilots in sectors. Pilots are listed in the same form as in the whole
+    snapshot (see 'RadarEngine.refresh').
+
+    Output:
+    A dictionary with version of snapshot, size of sectors, pilots and
+    sectors or 'None' if pilot is not on radar.
+    """
+    snapshot = shared_storage.get_radar()
+    if not snapshot:
+        return None
+    pilots = snapshot['pilots']
+    army = next((row[1] for row in pilots if row[0] == callsign), None)
+    if army is None:
+        return None
+    view = snapshot['armies'][str(army)]
+    return {
+        'version': snapshot['version'],
+        'sector_size': snapshot['sector_size'],
+        'pilots': [pilots[i] for i in view['visible']],
+        'sectors': view['sectors'],
+    }
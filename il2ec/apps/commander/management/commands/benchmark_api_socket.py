@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Implement 'benchmark_api_socket' Django management command for measuring
+speed of reading lines from commander in blocking mode.
+"""
+import random
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from commander.protocol.blocking import api_socket
+
+
+def _make_chunks(data, max_chunk_size, rnd):
+    """
+    Split data into chunks of random sizes like network does.
+    """
+    chunks = []
+    i, length = 0, len(data)
+    while i < length:
+        size = rnd.randint(1, max_chunk_size)
+        chunks.append(data[i:i + size])
+        i += size
+    return chunks
+
+
+class Command(BaseCommand):
+    """
+    A management command which feeds growing amounts of data to
+    'api_socket.read_line' in chunks of random sizes instead of receiving
+    them from network and measures time per megabyte. Reading is linear if
+    time per megabyte stays the same while amount of data grows.
+    """
+
+    help = "Measure speed of reading lines from commander's API socket"
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--sizes',
+            dest='sizes', default='1,2,4,8,16',
+            help="Comma-separated numbers of megabytes to read"),
+        make_option('-l', '--line-length',
+            type='int', dest='line_length', default=0,
+            help="Length of lines in bytes. Whole amount of data is sent "
+                 "as a single line if it is 0"),
+        make_option('--max-chunk-size',
+            type='int', dest='max_chunk_size', default=4096,
+            help="Max number of bytes received at once"),
+        make_option('--seed',
+            type='int', dest='seed', default=None,
+            help="Seed of random numbers generator"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [float(x) for x in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("Sizes must be numbers")
+        line_length = options['line_length']
+        max_chunk_size = options['max_chunk_size']
+        if min(sizes) <= 0 or max_chunk_size <= 0 or line_length < 0:
+            raise CommandError("Sizes and lengths must be positive")
+        rnd = random.Random(options['seed'])
+
+        for size in sizes:
+            length = int(size * 1024 * 1024)
+            data, lines_count = self._make_data(length, line_length)
+            chunks = _make_chunks(data, max_chunk_size, rnd)
+            seconds = self._read(chunks, lines_count, len(data))
+            megabytes = len(data) / 1048576.0
+            self.stdout.write(
+                "{size:.1f} MB in {chunks} chunks: {seconds:.3f} sec "
+                "({per_mb:.1f} msec per MB)".format(
+                size=megabytes, chunks=len(chunks), seconds=seconds,
+                per_mb=seconds / megabytes * 1000))
+
+    @staticmethod
+    def _make_data(length, line_length):
+        """
+        Get a string with lines of given length and number of lines in it.
+        """
+        delimiter = api_socket.delimiter
+        if not line_length:
+            return 'x' * length + delimiter, 1
+        line = 'x' * line_length + delimiter
+        lines_count = max(length // len(line), 1)
+        return line * lines_count, lines_count
+
+    @staticmethod
+    def _read(chunks, lines_count, length):
+        """
+        Read all lines from chunks and return number of seconds it took.
+        """
+        s = api_socket()
+        try:
+            chunks = iter(chunks)
+            # Chunks are received instead of data from network
+            s.recv = lambda dummy_size: next(chunks, '')
+
+            started_at = time.time()
+            total = 0
+            for dummy in xrange(lines_count):
+                line = s.read_line()
+                if line is None:
+                    break
+                total += len(line) + len(s.delimiter)
+            seconds = time.time() - started_at
+        finally:
+            s.close()
+
+        if total != length:
+            raise CommandError("Read {0} bytes instead of {1}".format(
+                               total, length))
+        return seconds
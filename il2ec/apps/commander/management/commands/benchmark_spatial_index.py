@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Implement 'benchmark_spatial_index' Django management command for measuring
+speed of spatial index of pilots' and objects' positions.
+"""
+import random
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from commander import settings
+from commander.service.spatial import GridIndex
+
+
+def _format_time(seconds, count):
+    return "{count} in {seconds:.3f} sec ({each:.1f} usec each)".format(
+           count=count, seconds=seconds,
+           each=seconds / count * 1000000 if count else 0)
+
+
+class Command(BaseCommand):
+    """
+    A management command which fills spatial index with randomly placed
+    items, moves them like a telemetry cycle does and measures radius and
+    rectangle queries. Results of queries are checked against a linear scan,
+    which is measured too.
+    """
+
+    help = "Measure speed of spatial index of positions"
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--items',
+            type='int', dest='items', default=5000,
+            help="Number of indexed items"),
+        make_option('-q', '--queries',
+            type='int', dest='queries', default=1000,
+            help="Number of queries of every kind"),
+        make_option('-r', '--radius',
+            type='float', dest='radius', default=5000,
+            help="Radius of queries in meters"),
+        make_option('--map-size',
+            type='float', dest='map_size', default=300000,
+            help="Side of square map in meters"),
+        make_option('--cell-size',
+            type='float', dest='cell_size', default=None,
+            help="Side of cell of index in meters"),
+        make_option('--seed',
+            type='int', dest='seed', default=None,
+            help="Seed of random numbers generator"),
+    )
+
+    def handle(self, *args, **options):
+        count, queries = options['items'], options['queries']
+        radius, map_size = options['radius'], options['map_size']
+        if count <= 0 or queries <= 0:
+            raise CommandError("Numbers of items and queries must be "
+                               "positive")
+        cell_size = options['cell_size'] or \
+                    settings.COMMANDER_SPATIAL_INDEX['cell_size']
+        rnd = random.Random(options['seed'])
+
+        positions = {
+            key: (rnd.uniform(0, map_size), rnd.uniform(0, map_size), )
+            for key in xrange(count)
+        }
+        points = [
+            (rnd.uniform(0, map_size), rnd.uniform(0, map_size), )
+            for dummy in xrange(queries)
+        ]
+        index = GridIndex(cell_size)
+
+        started_at = time.time()
+        for key, (x, y) in positions.iteritems():
+            index.update(key, x, y)
+        self._report("Insert", time.time() - started_at, count)
+
+        # Items move up to 300 meters per cycle like fast aircraft do
+        for key, (x, y) in positions.iteritems():
+            positions[key] = (x + rnd.uniform(-300, 300),
+                              y + rnd.uniform(-300, 300), )
+        started_at = time.time()
+        for key, (x, y) in positions.iteritems():
+            index.update(key, x, y)
+        self._report("Update", time.time() - started_at, count)
+
+        started_at = time.time()
+        found = [index.query_radius(x, y, radius) for x, y in points]
+        self._report("Radius query", time.time() - started_at, queries)
+
+        started_at = time.time()
+        rects = [
+            index.query_rect(x - radius, y - radius, x + radius, y + radius)
+            for x, y in points
+        ]
+        self._report("Rectangle query", time.time() - started_at, queries)
+
+        radius_squared = radius * radius
+        started_at = time.time()
+        expected = [
+            set(key for key, (item_x, item_y) in positions.iteritems()
+                if (item_x - x) ** 2 + (item_y - y) ** 2 <= radius_squared)
+            for x, y in points
+        ]
+        self._report("Linear scan", time.time() - started_at, queries)
+
+        for result, keys in zip(found, expected):
+            if set(key for key, dummy_distance in result) != keys:
+                raise CommandError("Radius query returned wrong items")
+        for result, keys in zip(rects, expected):
+            if not keys.issubset(result):
+                raise CommandError("Rectangle query missed items")
+
+        self.stdout.write("Found {0:.1f} items per radius query on "
+                          "average".format(
+                          sum(len(keys) for keys in expected) /
+                          float(queries)))
+
+    def _report(self, title, seconds, count):
+        self.stdout.write("{0}: {1}".format(title,
+                                            _format_time(seconds, count)))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Implement 'replay_events_log' Django management command for passing saved
+server's events logs through commander's services.
+"""
+import multiprocessing
+import os
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from commander import settings
+from commander.helpers import is_commander_running
+from commander.replay import replay_log, make_events_store
+from commander.service.stats import reset_stats
+
+
+def _replay(args):
+    return replay_log(*args)
+
+
+def _is_commander_alive():
+    """
+    Tell whether commander is running or its daemon has not exited yet.
+    """
+    pid_file = settings.COMMANDER_PID_FILE
+    return is_commander_running() or \
+        (pid_file is not None and os.path.exists(pid_file))
+
+
+def _format_rate(events, seconds):
+    return "{events} events in {seconds:.2f} sec ({rate:.0f} events/sec)" \
+           .format(events=events, seconds=seconds,
+                   rate=events / seconds if seconds else 0)
+
+
+class Command(BaseCommand):
+    """
+    A management command which replays saved events logs (plain or gzipped)
+    at full speed without connection to game server. Every log is replayed
+    by its own set of services, so logs can be replayed in parallel.
+
+    Events can also be stored to database and added to statistics in the
+    same way as on a live server. They are stored by a single process in
+    order of given logs while commander is stopped.
+    """
+
+    args = "<events_log events_log ...>"
+    help = "Replay saved events logs of IL-2 DS"
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--processes',
+            type='int', dest='processes', default=1,
+            help="Number of processes to replay logs in parallel"),
+        make_option('--chunk-size',
+            type='int', dest='chunk_size', default=None,
+            help="Number of bytes to read at once"),
+        make_option('--store',
+            action='store_true', dest='store', default=False,
+            help="Store events and add them to statistics"),
+        make_option('--reset-stats',
+            action='store_true', dest='reset_stats', default=False,
+            help="Delete statistics before storing, so they are counted "
+                 "again from all stored events"),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("No events logs are specified")
+        for path in args:
+            if not os.path.isfile(path):
+                raise CommandError("Events log {path} does not exist".format(
+                                   path=path))
+
+        if options['reset_stats'] and not options['store']:
+            raise CommandError("Statistics can be reset only if events are "
+                               "stored")
+        if options['store'] and options['processes'] > 1:
+            raise CommandError("Events can be stored by a single process "
+                               "only")
+        if options['store'] and _is_commander_alive():
+            # Commander's events store would have its missions ended and
+            # would count events of this one in statistics
+            raise CommandError("Events cannot be stored while commander is "
+                               "running, stop it first")
+
+        if options['reset_stats']:
+            reset_stats()
+        store = make_events_store() if options['store'] else None
+        tasks = [(path, options['chunk_size'], store) for path in args]
+        processes = min(max(options['processes'], 1), len(tasks))
+        started_at = time.time()
+
+        if store is not None:
+            store.startService()
+        if processes == 1:
+            results = (_replay(task) for task in tasks)
+            pool = None
+        else:
+            # Database connection must not be shared with child processes
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_replay, tasks)
+
+        total = 0
+        try:
+            for result in results:
+                total += result['events']
+                self.stdout.write("{path}: {rate}".format(
+                    path=result['path'],
+                    rate=_format_rate(result['events'], result['seconds'])))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if store is not None:
+                store.join()
+
+        if store is not None:
+            self.stdout.write("Events store: {stats}".format(
+                stats=store.get_stats()))
+        self.stdout.write("Total: {rate}".format(
+            rate=_format_rate(total, time.time() - started_at)))
@@ -5,23 +5,41 @@ commander.
 """
 import os
 import signal
+import time
 
-from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
 
 from commander import settings
 from commander.constants import APIOpcode
 from commander.protocol.blocking import api_send_noreply_message
 
 
+# Max number of seconds to wait for commander to exit before restart
+RESTART_TIMEOUT = 60
+
+
 class Command(BaseCommand):
     """
     A management command which stops IL-2 DS events commander.
     """
 
     help = "Stop IL-2 DS events commander"
+    option_list = BaseCommand.option_list + (
+        make_option('--restart',
+            action='store_true', dest='restart', default=False,
+            help="Ask connected users to stay, because commander will be "
+                 "started again"),
+    )
 
     def handle(self, *args, **kwargs): # pylint: disable=W0613
-        if settings.COMMANDER_PID_FILE is None:
+        if kwargs.get('restart'):
+            # Commander is told about restart via API only
+            api_send_noreply_message(APIOpcode.QUIT.to_request(
+                {'restart': True, }))
+            self._wait_for_exit()
+        elif settings.COMMANDER_PID_FILE is None:
             # Mostly for Windows only
             api_send_noreply_message(APIOpcode.QUIT.to_request())
         else:
@@ -36,5 +54,17 @@ class Command(BaseCommand):
             except OSError as e:
                 print "Failed to terminate daemon: {e}".format(e=unicode(e))
 
-
-
+    @staticmethod
+    def _wait_for_exit():
+        """
+        Wait until daemon removes its PID file, so it can be started again
+        right away.
+        """
+        if settings.COMMANDER_PID_FILE is None:
+            return
+        deadline = time.time() + RESTART_TIMEOUT
+        while os.path.exists(settings.COMMANDER_PID_FILE):
+            if time.time() > deadline:
+                raise CommandError("Daemon has not exited in {0} seconds"
+                                   .format(RESTART_TIMEOUT))
+            time.sleep(0.5)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'PilotRollup'
+        db.create_table(u'commander_pilotrollup', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('kills', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('deaths', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('sorties', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('flight_time', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(related_name='rollups', to=orm['auth_custom.User'])),
+            ('period', self.gf('django.db.models.fields.CharField')(max_length=5)),
+            ('start', self.gf('django.db.models.fields.DateField')()),
+        ))
+        db.send_create_signal(u'commander', ['PilotRollup'])
+
+        # Adding unique constraint on 'PilotRollup', fields ['user', 'period', 'start']
+        db.create_unique(u'commander_pilotrollup', ['user_id', 'period', 'start'])
+
+        # Adding index on 'PilotRollup', fields ['period', 'start']
+        db.create_index(u'commander_pilotrollup', ['period', 'start'])
+
+        # Adding model 'RollupState'
+        db.create_table(u'commander_rollupstate', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('last_event_id', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('version', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('flights', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('updated', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal(u'commander', ['RollupState'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'PilotRollup', fields ['period', 'start']
+        db.delete_index(u'commander_pilotrollup', ['period', 'start'])
+
+        # Removing unique constraint on 'PilotRollup', fields ['user', 'period', 'start']
+        db.delete_unique(u'commander_pilotrollup', ['user_id', 'period', 'start'])
+
+        # Deleting model 'PilotRollup'
+        db.delete_table(u'commander_pilotrollup')
+
+        # Deleting model 'RollupState'
+        db.delete_table(u'commander_rollupstate')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth_custom.user': {
+            'Meta': {'object_name': 'User'},
+            'callsign': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'}),
+            'connection_password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'unique': 'True', 'max_length': '75'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_blocked': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'language': ('django.db.models.fields.CharField', [], {'default': "'en'", 'max_length': '5'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"})
+        },
+        u'commander.event': {
+            'Meta': {'ordering': "('id',)", 'object_name': 'Event'},
+            'aircraft': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'attacker': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'attacks'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['auth_custom.User']"}),
+            'attacker_aircraft': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'attacker_callsign': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'callsign': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'data': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'mission': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'events'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['commander.Mission']"}),
+            'pos_x': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'pos_y': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'events'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['auth_custom.User']"})
+        },
+        u'commander.mission': {
+            'Meta': {'ordering': "('-began',)", 'object_name': 'Mission'},
+            'began': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'ended': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        u'commander.missionstats': {
+            'Meta': {'ordering': "('mission', 'army')", 'unique_together': "(('mission', 'army'),)", 'object_name': 'MissionStats'},
+            'army': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'deaths': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'flight_time': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kills': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'mission': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'stats'", 'to': u"orm['commander.Mission']"}),
+            'sorties': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        u'commander.pilotrollup': {
+            'Meta': {'unique_together': "(('user', 'period', 'start'),)", 'object_name': 'PilotRollup', 'index_together': "(('period', 'start'),)"},
+            'deaths': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'flight_time': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kills': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'period': ('django.db.models.fields.CharField', [], {'max_length': '5'}),
+            'sorties': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'start': ('django.db.models.fields.DateField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'rollups'", 'to': u"orm['auth_custom.User']"})
+        },
+        u'commander.pilotstats': {
+            'Meta': {'object_name': 'PilotStats'},
+            'deaths': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'flight_time': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'kills': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'sorties': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'stats'", 'unique': 'True', 'primary_key': 'True', 'to': u"orm['auth_custom.User']"})
+        },
+        u'commander.rollupstate': {
+            'Meta': {'object_name': 'RollupState'},
+            'flights': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_event_id': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['commander']
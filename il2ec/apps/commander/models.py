@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Commander models.
+"""
+import datetime
+import logging
+import redis
+
+from django.conf import settings
+from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import ugettext_lazy as _
+
+from auth_custom.models import User
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Mission(models.Model):
+    """
+    Mission which was played on game server. Mission is created when the
+    server starts playing it and is closed when it ends.
+    """
+    name = models.CharField(
+        verbose_name=_("name"),
+        max_length=255)
+    began = models.DateTimeField(
+        verbose_name=_("began"),
+        db_index=True)
+    ended = models.DateTimeField(
+        verbose_name=_("ended"),
+        null=True,
+        blank=True)
+
+    class Meta:
+        verbose_name = _("mission")
+        verbose_name_plural = _("missions")
+        ordering = ('-began', )
+
+    def __unicode__(self):
+        return self.name
+
+
+class Event(models.Model):
+    """
+    Event from server's events log. Events are only appended and are never
+    changed. Values which are specific for the type of event (seat, fuel,
+    name of destroyed object, etc.) are stored as JSON in 'data' field.
+    """
+    mission = models.ForeignKey(
+        Mission,
+        verbose_name=_("mission"),
+        related_name='events',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL)
+    type = models.CharField(
+        verbose_name=_("type"),
+        max_length=16,
+        db_index=True)
+    time = models.DateTimeField(
+        verbose_name=_("time"),
+        db_index=True)
+    callsign = models.CharField(
+        verbose_name=_("callsign"),
+        max_length=255,
+        blank=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("user"),
+        related_name='events',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL)
+    aircraft = models.CharField(
+        verbose_name=_("aircraft"),
+        max_length=255,
+        blank=True)
+    attacker_callsign = models.CharField(
+        verbose_name=_("attacker's callsign"),
+        max_length=255,
+        blank=True)
+    attacker = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("attacker"),
+        related_name='attacks',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL)
+    attacker_aircraft = models.CharField(
+        verbose_name=_("attacker's aircraft"),
+        max_length=255,
+        blank=True)
+    pos_x = models.FloatField(
+        verbose_name=_("x coordinate"),
+        null=True,
+        blank=True)
+    pos_y = models.FloatField(
+        verbose_name=_("y coordinate"),
+        null=True,
+        blank=True)
+    data = models.TextField(
+        verbose_name=_("data"),
+        blank=True)
+    # Position of event's line in events log, so event which was parsed
+    # twice is stored once. Log is identified by hash of its first line
+    # which stays the same when log is rotated or compressed
+    log_id = models.CharField(
+        verbose_name=_("ID of events log"),
+        max_length=40,
+        null=True,
+        blank=True)
+    log_offset = models.BigIntegerField(
+        verbose_name=_("offset in events log"),
+        null=True,
+        blank=True)
+
+    class Meta:
+        verbose_name = _("event")
+        verbose_name_plural = _("events")
+        ordering = ('id', )
+        unique_together = (('log_id', 'log_offset'), )
+
+    def __unicode__(self):
+        return u"{0} {1}".format(self.type, self.callsign)
+
+
+class StatsCounters(models.Model):
+    """
+    Counters of pilots' activity.
+    """
+    kills = models.PositiveIntegerField(
+        verbose_name=_("kills"),
+        default=0)
+    deaths = models.PositiveIntegerField(
+        verbose_name=_("deaths"),
+        default=0)
+    sorties = models.PositiveIntegerField(
+        verbose_name=_("sorties"),
+        default=0)
+    flight_time = models.PositiveIntegerField(
+        verbose_name=_("flight time"),
+        default=0,
+        help_text=_("Number of seconds spent in the air."))
+
+    # Names of counter fields in the order they are kept by aggregator
+    COUNTERS = ('kills', 'deaths', 'sorties', 'flight_time', )
+
+    class Meta:
+        abstract = True
+
+
+class MissionStats(StatsCounters):
+    """
+    Statistics of an army in a mission.
+    """
+    mission = models.ForeignKey(
+        Mission,
+        verbose_name=_("mission"),
+        related_name='stats')
+    army = models.CharField(
+        verbose_name=_("army"),
+        max_length=16)
+
+    class Meta:
+        verbose_name = _("mission's statistics")
+        verbose_name_plural = _("missions' statistics")
+        unique_together = (('mission', 'army'), )
+        ordering = ('mission', 'army', )
+
+    def __unicode__(self):
+        return u"{0} ({1})".format(self.mission, self.army)
+
+
+class PilotRollup(StatsCounters):
+    """
+    Statistics of a pilot for a day, for a week or for all time. Rollups are
+    refreshed periodically by Celery task from stored events.
+    """
+    DAY, WEEK, ALL_TIME = 'day', 'week', 'all'
+    PERIODS = (
+        (DAY, _("day")),
+        (WEEK, _("week")),
+        (ALL_TIME, _("all time")),
+    )
+    # Start date of all-time period
+    ALL_TIME_START = datetime.date(1970, 1, 1)
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("user"),
+        related_name='rollups')
+    period = models.CharField(
+        verbose_name=_("period"),
+        max_length=5,
+        choices=PERIODS)
+    start = models.DateField(
+        verbose_name=_("start of period"))
+
+    class Meta:
+        verbose_name = _("pilot's rollup")
+        verbose_name_plural = _("pilots' rollups")
+        unique_together = (('user', 'period', 'start'), )
+        index_together = (('period', 'start'), )
+
+    def __unicode__(self):
+        return u"{0} ({1} {2})".format(self.user, self.period, self.start)
+
+    @classmethod
+    def get_starts(cls, date):
+        """
+        Get a tuple of tuples with period and start date of period for every
+        period which includes given date.
+        """
+        return (
+            (cls.DAY, date),
+            (cls.WEEK, date - datetime.timedelta(days=date.weekday())),
+            (cls.ALL_TIME, cls.ALL_TIME_START),
+        )
+
+
+class RollupState(models.Model):
+    """
+    State of refreshing of pilots' rollups. There is only one instance.
+    """
+    last_event_id = models.PositiveIntegerField(
+        verbose_name=_("last event ID"),
+        default=0,
+        help_text=_("ID of the last event which was added to rollups."))
+    version = models.PositiveIntegerField(
+        verbose_name=_("version"),
+        default=0)
+    flights = models.TextField(
+        verbose_name=_("flights"),
+        blank=True,
+        help_text=_("JSON with pilots who were in the air at the time of "
+                    "the last event."))
+    updated = models.DateTimeField(
+        verbose_name=_("updated"),
+        null=True,
+        blank=True)
+
+    class Meta:
+        verbose_name = _("state of rollups")
+        verbose_name_plural = _("states of rollups")
+
+    def __unicode__(self):
+        return unicode(self.version)
+
+
+class StatsState(models.Model):
+    """
+    State of aggregation of pilots' and missions' statistics. It is saved
+    together with every change of statistics. There is only one instance.
+    """
+    last_event_id = models.PositiveIntegerField(
+        verbose_name=_("last event ID"),
+        default=0,
+        help_text=_("ID of the last event which was added to statistics."))
+    flights = models.TextField(
+        verbose_name=_("flights"),
+        blank=True,
+        help_text=_("JSON with pilots who were in the air at the time of "
+                    "the last event."))
+    armies = models.TextField(
+        verbose_name=_("armies"),
+        blank=True,
+        help_text=_("JSON with armies of pilots in the mission which was "
+                    "playing at the time of the last event."))
+    updated = models.DateTimeField(
+        verbose_name=_("updated"),
+        null=True,
+        blank=True)
+
+    class Meta:
+        verbose_name = _("state of statistics")
+        verbose_name_plural = _("states of statistics")
+
+    def __unicode__(self):
+        return unicode(self.last_event_id)
+
+
+@receiver(post_init, sender=User)
+def remember_callsign(sender, instance, **kwargs):
+    """
+    Remember callsign which user had when he was loaded, so commander can
+    be told about change of callsign.
+    """
+    instance._loaded_callsign = instance.__dict__.get('callsign')
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def notify_commander(sender, instance, **kwargs):
+    """
+    Tell commander that user was changed wherever it was done (website,
+    admin, shell), so commander will not use outdated user from its cache.
+    Changes made by 'QuerySet.update' are not noticed.
+    """
+    from commander.helpers import notify_user_changed
+
+    callsigns = set([instance.callsign, instance._loaded_callsign, ])
+    callsigns.discard(None)
+    try:
+        for callsign in callsigns:
+            notify_user_changed(callsign)
+    except redis.RedisError as e:
+        LOG.error("Failed to notify commander about change of {0}: {1}"
+                  .format(instance.callsign, unicode(e)))
+    instance._loaded_callsign = instance.callsign
@@ -2,3 +2,9 @@
 """
 Commander network protocols (plain and twisted) definitions.
 """
+
+
+class APIError(Exception):
+    """
+    Error of processing of request to commander's API.
+    """
@@ -5,54 +5,306 @@ Commander network asynchronous protocols and factories.
 import simplejson as json
 import tx_logging
 
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet import defer
+from twisted.protocols.basic import LineReceiver
 
 from commander import stop_everything_n_quit
 from commander.constants import APIOpcode
+from commander.protocol import APIError
+from commander.protocol.framing import (FRAME_HEADER, MAX_FRAME_LENGTH,
+    JSONCodec, get_codec, make_frame, )
 
 
 LOG = tx_logging.getLogger(__name__)
 
 
-class APIServerProtocol(LineOnlyReceiver):
+class APIServerProtocol(LineReceiver):
     """
     Twisted implementation of commander-side version of protocol for
     communicating with commander from the outside world.
+
+    Requests which contain request ID are replied. Every request is processed
+    as soon as it is received, so many requests can be in progress at the same
+    time and replies can be sent in different order.
+
+    Requests are JSON lines by default. Client can switch connection to
+    length-prefixed frames with a 'framing' request. Requests are dispatched
+    in the same way regardless of framing.
     """
     def __init__(self):
         self.handlers = {
             APIOpcode.QUIT: self._on_quit,
+            APIOpcode.PILOTS: self._on_pilots,
+            APIOpcode.KICK: self._on_kick,
+            APIOpcode.CHAT: self._on_chat,
+            APIOpcode.MISSION_STATUS: self._on_mission_status,
+            APIOpcode.TELEMETRY: self._on_telemetry,
+            APIOpcode.FRAMING: self._on_framing,
+            APIOpcode.CONSOLE_STATS: self._on_console_stats,
+            APIOpcode.EVENTS_STORE_STATS: self._on_events_store_stats,
+            APIOpcode.USERS_STATS: self._on_users_stats,
+            APIOpcode.TELEMETRY_STATS: self._on_telemetry_stats,
         }
+        # Codec of frames' bodies or 'None' if connection uses JSON lines
+        self.codec = None
+        self._in_buffer = bytearray()
+        # Position of the beginning of the next frame in buffer
+        self._frame_start = 0
 
     def lineReceived(self, line):
+        self._request_received(line, JSONCodec)
+
+    def rawDataReceived(self, data):
+        in_buffer = self._in_buffer
+        if self._frame_start:
+            # Drop processed frames before buffer grows
+            del in_buffer[:self._frame_start]
+            self._frame_start = 0
+        in_buffer.extend(data)
+
+        header_size = FRAME_HEADER.size
+        while len(in_buffer) - self._frame_start >= header_size:
+            length = FRAME_HEADER.unpack_from(in_buffer, self._frame_start)[0]
+            if length > MAX_FRAME_LENGTH:
+                peer = self.transport.getPeer()
+                LOG.error("Too long frame ({length} bytes) from {host}:{port}"
+                          .format(length=length, host=peer.host,
+                                  port=peer.port))
+                self.transport.loseConnection()
+                return
+            start = self._frame_start + header_size
+            end = start + length
+            if len(in_buffer) < end:
+                break
+            self._frame_start = end
+            body = memoryview(in_buffer)[start:end].tobytes()
+            self._request_received(body, self.codec)
+            if not self.transport.connected:
+                return
+
+        if self._frame_start == len(in_buffer):
+            del in_buffer[:]
+            self._frame_start = 0
+
+    def _request_received(self, data, codec):
         peer = self.transport.getPeer()
 
         try:
-            code_value, payload = tuple(json.loads(line))
+            request = tuple(codec.decode(data))
+            code_value, payload = request[:2]
+            request_id = request[2] if len(request) > 2 else None
         except Exception as e:
             LOG.error(
-                "Failed to decode JSON from {host}:{port} in request "
-                "\"{request}\": {err}".format(host=peer.host, port=peer.port,
-                                              request=line, err=unicode(e)))
+                "Failed to decode {codec} from {host}:{port} in request "
+                "{request}: {err}".format(codec=codec.name, host=peer.host,
+                                          port=peer.port,
+                                          request=repr(data[:200]),
+                                          err=unicode(e)))
             self.transport.loseConnection()
             return
         try:
             opcode = APIOpcode.lookupByValue(code_value)
         except ValueError as e:
             LOG.error("Failed to parse opcode '{code}' from {host}:{port} in "
-                      "request \"{request}\"".format(code=code_value,
-                      host=peer.host, port=peer.port, request=line))
+                      "request {request}".format(code=code_value,
+                      host=peer.host, port=peer.port,
+                      request=repr(data[:200])))
             self.transport.loseConnection()
             return
 
         handler = self.handlers.get(opcode)
         if handler is None:
             LOG.error("No handler for opcode {opcode}!".format(opcode=opcode))
+            d = defer.fail(APIError("Unsupported opcode"))
+        elif opcode == APIOpcode.FRAMING and request_id is None:
+            # Client must know which reply is the last one before the switch
+            d = defer.fail(APIError("Framing request has no ID"))
+        else:
+            d = defer.maybeDeferred(handler, payload)
+
+        if request_id is None:
+            d.addErrback(self._on_error, opcode)
+        else:
+            reply = self._reply_framing if opcode == APIOpcode.FRAMING else \
+                    self._reply
+            d.addCallbacks(reply, self._reply_error,
+                           callbackArgs=(request_id, ),
+                           errbackArgs=(request_id, opcode, ))
+
+    def _send_message(self, message):
+        if self.codec is None:
+            self.sendLine(json.dumps(message))
+        else:
+            self.transport.write(make_frame(self.codec, message))
+
+    def _reply(self, result, request_id, error=None):
+        if self.transport.connected:
+            self._send_message((request_id, error, result, ))
+
+    def _reply_framing(self, codec_name, request_id):
+        """
+        Reply to 'framing' request and switch connection to length-prefixed
+        frames right after the reply.
+        """
+        self._reply(codec_name, request_id)
+        self.codec = get_codec(codec_name)
+        self.setRawMode()
+
+    def _reply_error(self, failure, request_id, opcode):
+        self._on_error(failure, opcode)
+        error = unicode(failure.value) if failure.check(APIError) else \
+                "Internal error"
+        self._reply(None, request_id, error)
+
+    @staticmethod
+    def _on_error(failure, opcode):
+        if failure.check(APIError):
+            LOG.debug("Failed to process request {opcode}: {err}".format(
+                      opcode=opcode, err=unicode(failure.value)))
         else:
-            handler(payload)
+            LOG.error("Failed to process request {opcode}: {err}".format(
+                      opcode=opcode, err=unicode(failure.value)))
+
+    @property
+    def commander(self):
+        """
+        Get running commander service.
+        """
+        commander = self.factory.root_service.commander
+        if not commander.running:
+            raise APIError("Commander is not connected to game server")
+        return commander
 
-    def _on_quit(self, dummy_payload):
+    def _on_quit(self, payload):
         """
         Process 'quit' request.
         """
+        if isinstance(payload, dict) and payload.get('restart'):
+            self.factory.root_service.restarting = True
         stop_everything_n_quit()
+
+    def _on_pilots(self, dummy_payload):
+        """
+        Process 'pilots' request.
+
+        Output:
+        A list of dictionaries with callsign and state of each online pilot
+        sorted by callsign.
+        """
+        pilots = self.commander.services.pilots
+        result = []
+        for callsign in sorted(pilots.confirmed.iterkeys()):
+            info = pilots.confirmed[callsign].state.to_dict()
+            info['callsign'] = callsign
+            result.append(info)
+        return result
+
+    def _on_kick(self, callsign):
+        """
+        Process 'kick' request.
+        """
+        if not callsign:
+            raise APIError("Callsign is not specified")
+        return self.commander.cl_queue.kick_callsign(callsign)
+
+    def _on_chat(self, payload):
+        """
+        Process 'chat' request.
+        """
+        try:
+            message = payload['message']
+        except (TypeError, KeyError):
+            raise APIError("Message is not specified")
+        callsign = payload.get('callsign')
+        cl_queue = self.commander.cl_queue
+        if callsign:
+            return cl_queue.chat_user(message, callsign)
+        else:
+            return cl_queue.chat_all(message)
+
+    def _on_mission_status(self, dummy_payload):
+        """
+        Process 'mission status' request.
+
+        Output:
+        A dictionary with name of mission status and name of mission (or
+        'None' if mission is not loaded).
+        """
+        def on_status(info):
+            status, mission = info
+            return {
+                'status': status.name,
+                'mission': mission,
+            }
+
+        return self.commander.cl_queue.mission_status().addCallback(
+            on_status)
+
+    def _on_telemetry(self, version):
+        """
+        Process 'telemetry' request.
+
+        Output:
+        A dictionary with current version of online pilots' state, changes
+        of pilots' state since given version and list of callsigns of pilots
+        who have left since given version.
+        """
+        version, changed, removed = \
+            self.commander.services.pilots.get_changes(version or 0)
+        return {
+            'version': version,
+            'changed': changed,
+            'removed': removed,
+        }
+
+    def _on_framing(self, codec_name):
+        """
+        Process 'framing' request. Connection is switched to length-prefixed
+        frames after the reply is sent.
+
+        Output:
+        Name of codec of frames' bodies.
+        """
+        if self.codec is not None:
+            raise APIError("Framing was already switched")
+        try:
+            return get_codec(codec_name).name
+        except ValueError as e:
+            raise APIError(unicode(e))
+
+    def _on_console_stats(self, dummy_payload):
+        """
+        Process 'console stats' request.
+
+        Output:
+        A dictionary with statistics of queue of console commands for every
+        priority class.
+        """
+        return self.commander.cl_queue.get_stats()
+
+    def _on_events_store_stats(self, dummy_payload):
+        """
+        Process 'events store stats' request.
+
+        Output:
+        A dictionary with statistics of storing of events to database.
+        """
+        return self.commander.services.events_store.get_stats()
+
+    def _on_users_stats(self, dummy_payload):
+        """
+        Process 'users stats' request.
+
+        Output:
+        A dictionary with statistics of cache of users.
+        """
+        return self.commander.services.users.get_stats()
+
+    def _on_telemetry_stats(self, dummy_payload):
+        """
+        Process 'telemetry stats' request.
+
+        Output:
+        A dictionary with statistics of collecting of pilots' telemetry.
+        """
+        return self.commander.services.pilots.get_telemetry_stats()
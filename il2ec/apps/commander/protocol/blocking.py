@@ -3,80 +3,220 @@
 Provides stuff for communicating with commander via network public API in
 blocking mode.
 """
+import itertools
 import logging
+import os
+import select
+import simplejson as json
 import socket
+import threading
+import time
+
+from contextlib import contextmanager
 
 from commander import settings
+from commander.constants import APIOpcode
+from commander.protocol import APIError
 from commander.protocol.async import APIServerProtocol
+from commander.protocol.framing import (FRAME_HEADER, MAX_FRAME_LENGTH,
+    get_codec, make_frame, )
 
 
 LOG = logging.getLogger(__name__)
 
+# Generator of IDs of requests sent by this process
+_request_ids = itertools.count(1)
+
 
 class api_socket(socket.socket): # pylint: disable=C0103,R0904
     """
     Raw socket for communication with commander. Enhances standart socket by
     providing ability to send lines to coomander and receive lines from it.
+    Connection can be switched to length-prefixed frames, messages are sent
+    and received in the same way regardless of framing.
     """
 
     delimiter = APIServerProtocol.delimiter
-    input_size = 4096
+    input_size = 1024 * 64
 
     def __init__(self, family=socket.AF_INET, _type=socket.SOCK_STREAM,
                  proto=0, _sock=None):
         super(api_socket, self).__init__(family, _type, proto, _sock)
-        self._line_reader = self._buffered_read_line()
+        self._in_buffer = bytearray()
+        # Position of the beginning of the next line in buffer
+        self._line_start = 0
+        # Position in buffer to search for delimiter from. Data before this
+        # position was already searched through
+        self._search_start = 0
+        # Codec of frames' bodies or 'None' if connection uses JSON lines
+        self.codec = None
 
-    def _buffered_read_line(self):
+    @property
+    def buffered_size(self):
         """
-        Generator which provides buffered line reading from commander.
+        Get number of received bytes which were not read yet.
         """
-        in_buffer = self.recv(self.input_size)
-        while True:
-            if self.delimiter in in_buffer:
-                (line, in_buffer) = in_buffer.split(self.delimiter, 1)
-                yield line
-            else:
-                chunk = self.recv(self.input_size)
-                if not chunk:
-                    break
-                else:
-                    in_buffer = in_buffer + chunk
-        if in_buffer:
-            yield in_buffer
+        return len(self._in_buffer) - self._line_start
 
     def read_line(self):
         """
-        Read a line from commander with bufferization.
+        Read a line from commander with bufferization. Every received byte is
+        searched for delimiter only once, so time of reading is linear to
+        length of line.
+
+        Output:
+        A string without delimiter or 'None' if the connection was lost.
         """
-        try:
-            return next(self._line_reader)
-        except StopIteration:
-            # This will happen only if the connection was lost
-            return None
+        in_buffer = self._in_buffer
+        while True:
+            i = in_buffer.find(self.delimiter, self._search_start)
+            if i >= 0:
+                line = memoryview(in_buffer)[self._line_start:i].tobytes()
+                self._line_start = self._search_start = i + len(self.delimiter)
+                if self._line_start == len(in_buffer):
+                    del in_buffer[:]
+                    self._line_start = self._search_start = 0
+                return line
+
+            # Delimiter can be split between chunks
+            self._search_start = max(
+                self._line_start,
+                len(in_buffer) - len(self.delimiter) + 1)
+
+            chunk = self.recv(self.input_size)
+            if not chunk:
+                # Connection was lost, return incomplete line if any
+                line = str(in_buffer[self._line_start:]) or None
+                del in_buffer[:]
+                self._line_start = self._search_start = 0
+                return line
+
+            if self._line_start:
+                # Drop lines which were read already before buffer grows
+                del in_buffer[:self._line_start]
+                self._search_start -= self._line_start
+                self._line_start = 0
+            in_buffer.extend(chunk)
 
     def send_line(self, line):
         """
         Send a string message with delimiter at the end to commander.
+
+        Output:
+        Number of sent bytes including delimiter or 0 if connection is
+        broken.
+        """
+        data = line + self.delimiter
+        try:
+            # Partial sends are retried by 'sendall' without copying of data
+            self.sendall(data)
+        except socket.error as e:
+            LOG.warning("Connection with commander is broken: {err}"
+                        .format(err=unicode(e)))
+            return 0
+        return len(data)
+
+    def _fill(self, size):
+        """
+        Receive data until buffer contains at least given number of unread
+        bytes.
+
+        Output:
+        'False' if the connection was lost, 'True' otherwise.
         """
-        line = line + self.delimiter
-        done = 0
-        total = len(line)
-        while done < total:
-            try:
-                sent = self.send(line[done:])
-            except socket.error as e:
-                LOG.warning("Connection with commander is broken: {err}"
-                            .format(err=unicode(e)))
-                break
-            total = total + sent
-        return done
-
-
-def api_create_client_socket():
+        in_buffer = self._in_buffer
+        while len(in_buffer) - self._line_start < size:
+            chunk = self.recv(max(self.input_size,
+                                  size - len(in_buffer) + self._line_start))
+            if not chunk:
+                return False
+            if self._line_start:
+                del in_buffer[:self._line_start]
+                self._line_start = self._search_start = 0
+            in_buffer.extend(chunk)
+        return True
+
+    def read_frame(self):
+        """
+        Read body of a length-prefixed frame from commander.
+
+        Output:
+        A string with body of frame or 'None' if the connection was lost.
+        'socket.error' is raised if frame is too long.
+        """
+        header_size = FRAME_HEADER.size
+        if not self._fill(header_size):
+            return None
+        length = FRAME_HEADER.unpack_from(self._in_buffer,
+                                          self._line_start)[0]
+        if length > MAX_FRAME_LENGTH:
+            raise socket.error("Too long frame from commander ({0} bytes)"
+                               .format(length))
+        if not self._fill(header_size + length):
+            return None
+
+        start = self._line_start + header_size
+        end = start + length
+        body = memoryview(self._in_buffer)[start:end].tobytes()
+        self._line_start = self._search_start = end
+        if end == len(self._in_buffer):
+            del self._in_buffer[:]
+            self._line_start = self._search_start = 0
+        return body
+
+    def send_message(self, message):
+        """
+        Encode a message and send it to commander as a line or a frame
+        depending on framing of the connection.
+
+        Output:
+        Number of sent bytes or 0 if connection is broken.
+        """
+        if self.codec is None:
+            return self.send_line(json.dumps(message))
+        data = make_frame(self.codec, message)
+        try:
+            self.sendall(data)
+        except socket.error as e:
+            LOG.warning("Connection with commander is broken: {err}"
+                        .format(err=unicode(e)))
+            return 0
+        return len(data)
+
+    def read_message(self):
+        """
+        Read a message from commander and decode it.
+
+        Output:
+        Decoded message or 'None' if the connection was lost.
+        """
+        if self.codec is None:
+            data = self.read_line()
+            return None if data is None else json.loads(data)
+        data = self.read_frame()
+        return None if data is None else self.codec.decode(data)
+
+    def switch_framing(self, codec_name):
+        """
+        Ask commander to switch the connection to length-prefixed frames
+        with bodies encoded by given codec. Reply is received before the
+        switch, so no requests must be in progress.
+        """
+        codec = get_codec(codec_name)
+        _send_request(APIOpcode.FRAMING, codec.name, self)
+        self.codec = codec
+
+
+def api_create_client_socket(timeout=None, codec_name=None):
     """
     Create a blocking socket for interaction with commander via commander's API
     and make a connection.
+
+    Input:
+    `timeout`       # float number of seconds for socket operations or 'None'
+                    # to wait forever
+    `codec_name`    # name of codec to switch connection to length-prefixed
+                    # frames with or 'None' to use JSON lines
     """
     try:
         s = api_socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -84,6 +224,7 @@ def api_create_client_socket():
         LOG.error("Failed to create client API socket: {err}".format(
                   err=unicode(e)))
         raise e
+    s.settimeout(timeout)
     try:
         s.connect((settings.COMMANDER_API['host'],
                    settings.COMMANDER_API['port']))
@@ -91,8 +232,174 @@ def api_create_client_socket():
         LOG.error("Failed to connect to server API socket: {err}".format(
                   err=unicode(e)))
         raise e
-    else:
-        return s
+    if codec_name:
+        try:
+            s.switch_framing(codec_name)
+        except (socket.error, APIError) as e:
+            LOG.error("Failed to switch framing of API socket: {err}".format(
+                      err=unicode(e)))
+            s.close()
+            raise socket.error(unicode(e))
+    return s
+
+
+class APIConnectionPool(object):
+    """
+    Per-process pool of persistent connections to commander's API. Idle
+    connections are checked before reuse. After a failed attempt to connect
+    new attempts are not made for some time, which grows with every failure,
+    so unavailable commander does not slow down every request.
+    """
+
+    def __init__(self, size=None, timeout=None, retry_delay=None,
+                 codec_name=None):
+        """
+        Input:
+        `size`          # max number of connections
+        `timeout`       # float number of seconds to wait for a free
+                        # connection and for socket operations
+        `retry_delay`   # a tuple with min and max float number of seconds
+                        # to wait before connecting again after failure
+        `codec_name`    # name of codec of length-prefixed frames or 'None'
+                        # to use JSON lines
+        """
+        client_settings = settings.COMMANDER_API['client']
+        self.size = size or client_settings['pool_size']
+        self.timeout = timeout or client_settings['timeout']
+        self.min_retry_delay, self.max_retry_delay = \
+            retry_delay or client_settings['retry_delay']
+        self.codec_name = codec_name or client_settings.get('codec')
+
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._busy = 0
+        self._failures = 0
+        self._retry_at = 0
+
+    def _check_pid(self):
+        """
+        Forget connections inherited from parent process, because they are
+        shared with it.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    @staticmethod
+    def _is_alive(s):
+        """
+        Tell whether idle connection can be used. Idle connection must not
+        have anything to read: either connection was closed or it contains
+        outdated data.
+        """
+        if s.buffered_size:
+            return False
+        try:
+            readable = select.select([s, ], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def get(self):
+        """
+        Get a connection from the pool or create a new one. Wait for a free
+        connection if all of them are in use.
+
+        Output:
+        Connected 'api_socket'. 'socket.timeout' is raised if there is no
+        free connection after timeout, 'socket.error' is raised if commander
+        is not available.
+        """
+        deadline = time.time() + self.timeout
+        with self._condition:
+            self._check_pid()
+            while True:
+                while self._idle:
+                    s = self._idle.pop()
+                    if self._is_alive(s):
+                        self._busy += 1
+                        return s
+                    s.close()
+                if self._busy < self.size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout(
+                        "Timed out waiting for connection to commander")
+                self._condition.wait(remaining)
+
+            if time.time() < self._retry_at:
+                raise socket.error("Commander is not available")
+            self._busy += 1
+
+        try:
+            s = api_create_client_socket(self.timeout, self.codec_name)
+        except socket.error:
+            with self._condition:
+                self._busy -= 1
+                self._failures += 1
+                delay = min(self.min_retry_delay * 2 ** (self._failures - 1),
+                            self.max_retry_delay)
+                self._retry_at = time.time() + delay
+                self._condition.notify()
+            raise
+        else:
+            with self._condition:
+                self._failures = 0
+                self._retry_at = 0
+            return s
+
+    def put(self, s, broken=False):
+        """
+        Return connection to the pool. Broken connection is closed.
+        """
+        with self._condition:
+            if self._pid != os.getpid():
+                s.close()
+                return
+            self._busy -= 1
+            if broken:
+                s.close()
+            else:
+                self._idle.append(s)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager which provides a connection from the pool. Connection
+        is considered to be broken if any error except 'APIError' is raised.
+        """
+        s = self.get()
+        try:
+            yield s
+        except APIError:
+            # Reply was received completely, connection is fine
+            self.put(s)
+            raise
+        except:
+            self.put(s, broken=True)
+            raise
+        else:
+            self.put(s)
+
+    def is_available(self):
+        """
+        Tell whether connection with commander can be established.
+        """
+        try:
+            s = self.get()
+        except socket.error:
+            return False
+        else:
+            self.put(s)
+            return True
+
+
+api_pool = APIConnectionPool()
 
 
 def api_send_noreply_message(message, socket_instance=None):
@@ -100,12 +407,55 @@ def api_send_noreply_message(message, socket_instance=None):
     Send a noreply message to commander in blocking mode. Message is a string
     with JSON inside.
     """
+    message = json.loads(message)
     if socket_instance:
         if not isinstance(socket_instance, api_socket):
             raise ValueError(
                 "Invalid instance of socket. api_socket must be passed.")
-        socket_instance.send_line(message)
+        socket_instance.send_message(message)
     else:
-        socket_instance = api_create_client_socket()
-        socket_instance.send_line(message)
-        socket_instance.close()
+        with api_pool.connection() as socket_instance:
+            if not socket_instance.send_message(message):
+                raise socket.error("Failed to send message to commander")
+
+
+def api_send_request(opcode, payload=None, socket_instance=None):
+    """
+    Send a request to commander and wait for reply in blocking mode.
+
+    Input:
+    `opcode`            # 'APIOpcode' constant
+    `payload`           # JSON-serializable payload of request
+    `socket_instance`   # 'api_socket' to use. Socket is taken from the
+                        # pool of connections if it is not specified
+
+    Output:
+    Result of request. 'APIError' is raised if request has failed.
+    """
+    if socket_instance:
+        if not isinstance(socket_instance, api_socket):
+            raise ValueError(
+                "Invalid instance of socket. api_socket must be passed.")
+        return _send_request(opcode, payload, socket_instance)
+    else:
+        with api_pool.connection() as socket_instance:
+            return _send_request(opcode, payload, socket_instance)
+
+
+def _send_request(opcode, payload, socket_instance):
+    request_id = next(_request_ids)
+    request = opcode.make_request(payload, request_id)
+    if not socket_instance.send_message(request):
+        raise socket.error("Failed to send request to commander")
+    while True:
+        reply = socket_instance.read_message()
+        if reply is None:
+            raise socket.error("Connection with commander was lost")
+        reply_id, error, result = reply
+        if reply_id != request_id:
+            # Reply to some other request which was sent via this socket
+            LOG.warning("Unexpected reply to request #{0}".format(reply_id))
+            continue
+        if error is not None:
+            raise APIError(error)
+        return result
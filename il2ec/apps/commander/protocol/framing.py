@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Codecs and framing of messages of commander's API.
+
+By default every message is a line with JSON inside. Connection can be
+switched to length-prefixed frames: every frame starts with 4-byte big-endian
+length of its body. Body is encoded by one of codecs.
+"""
+import simplejson as json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Header of length-prefixed frame
+FRAME_HEADER = struct.Struct('!I')
+
+# Max length of frame's body in bytes
+MAX_FRAME_LENGTH = 1024 * 1024 * 64 # 64 MiB
+
+
+class JSONCodec(object):
+    name = 'json'
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+class MsgPackCodec(object):
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj)
+
+    @staticmethod
+    def decode(data):
+        # Strings are decoded to unicode like JSON does
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+# Codecs which can be used for frames' bodies
+CODECS = {
+    JSONCodec.name: JSONCodec,
+}
+if msgpack is not None:
+    CODECS[MsgPackCodec.name] = MsgPackCodec
+
+
+def get_codec(name):
+    """
+    Get codec by name. 'ValueError' is raised if codec is not available.
+    """
+    try:
+        return CODECS[name]
+    except (KeyError, TypeError):
+        raise ValueError("Codec '{0}' is not available".format(name))
+
+
+def make_frame(codec, obj):
+    """
+    Encode object and prepend length of result.
+    """
+    body = codec.encode(obj)
+    return FRAME_HEADER.pack(len(body)) + body
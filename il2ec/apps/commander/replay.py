@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of saved server's events logs through commander's services.
+"""
+import gzip
+import time
+
+from il2ds_middleware.parser import EventLogParser
+
+from commander import settings
+from commander.service.events_log import get_log_id, parse_lines
+
+
+class OfflineRoot(object):
+    """
+    Stands for 'RootService' when there is no connection with game server.
+    """
+    cl_client = None
+    cl_queue = None
+    dl_client = None
+
+
+def make_offline_parser(store=None):
+    """
+    Create events log parser with the same services which process events
+    on a live server, but without connections to server. If events store is
+    given, events are also stored like on a live server.
+    """
+    from commander.service.events_store import StoringEventLogParser
+    from commander.service.missions import MissionsService
+    from commander.service.objects import ObjectsService
+    from commander.service.pilots import PilotsService
+
+    root = OfflineRoot()
+    pilots = PilotsService(users=None)
+    objects = ObjectsService()
+    missions = MissionsService()
+    services = (pilots, objects, missions, )
+    for service in services:
+        service.parent = root
+    if store is None:
+        return EventLogParser(services)
+    return StoringEventLogParser(services, store)
+
+
+def make_events_store():
+    """
+    Create events store with statistics aggregator which are configured
+    like on a live server. Store must be started before events are replayed
+    and must be joined after that. Only one store can write events at the
+    same time, so caller must make sure that commander is stopped.
+    """
+    from commander.service.events_store import EventsStoreService
+    from commander.service.stats import StatsAggregator
+
+    aggregator = StatsAggregator(
+        flush_interval=settings.COMMANDER_STATS['flush_interval'])
+    return EventsStoreService(
+        batch_size=settings.COMMANDER_EVENTS_STORE['batch_size'],
+        batch_interval=settings.COMMANDER_EVENTS_STORE['batch_interval'],
+        max_queue=settings.COMMANDER_EVENTS_STORE['max_queue'],
+        max_retries=settings.COMMANDER_EVENTS_STORE['max_retries'],
+        retry_delay=settings.COMMANDER_EVENTS_STORE['retry_delay'],
+        aggregator=aggregator)
+
+
+def wait_for_store(store):
+    """
+    Wait until events store has written most of queued events, so replayed
+    events are not dropped because the queue is full.
+    """
+    while store.get_stats()['queued'] >= store.max_queue // 2:
+        time.sleep(store.batch_interval / 10.0)
+
+
+def open_log(path):
+    """
+    Open events log for reading. Logs with '.gz' extension are decompressed.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def replay_log(path, chunk_size=None, store=None):
+    """
+    Read events log from the beginning to the end and pass its events to
+    a new set of services. Lines are parsed in the same way as by
+    'EventsLogWatcher'. If events store is given, events are stored with
+    their positions in log, so events of logs which were replayed or
+    watched before are not stored twice. Log is identified by its first
+    line, so a rotated or compressed copy of log has the same ID as the
+    original one.
+
+    Output:
+    A dictionary with path to log, number of events and number of seconds
+    spent.
+    """
+    chunk_size = chunk_size or settings.IL2_EVENTS_LOG['chunk_size']
+    parser = make_offline_parser(store)
+    log_id = None
+    events = 0
+    # Offset of not parsed data in log
+    offset = 0
+    tail = ''
+    started_at = time.time()
+
+    with open_log(path) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            data = tail + data
+            end = data.rfind('\n') + 1
+            tail = data[end:]
+            if end:
+                if log_id is None:
+                    log_id = get_log_id(data)
+                position = (log_id, offset) if store else None
+                events += parse_lines(parser, data[:end], position)
+                offset += end
+                if store:
+                    wait_for_store(store)
+    # The last line may have no line break
+    if log_id is None:
+        log_id = get_log_id(tail)
+    events += parse_lines(parser, tail, (log_id, offset) if store else None)
+
+    return {
+        'path': path,
+        'events': events,
+        'seconds': time.time() - started_at,
+    }
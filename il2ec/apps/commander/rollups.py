@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Rollups of pilots' statistics by periods of time.
+"""
+import simplejson as json
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from commander import settings
+from commander.models import Event, PilotRollup, RollupState
+from commander.service.stats import (StatsAggregator, add_counters,
+    load_flights, dump_flights, )
+
+
+# Key of current version of rollups in cache
+ROLLUPS_VERSION_CACHE_KEY = 'commander:rollups_version'
+
+
+def local_date(value):
+    """
+    Get local date of datetime.
+    """
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+def local_today():
+    return local_date(timezone.now())
+
+
+class RollupAggregator(StatsAggregator):
+    """
+    Counts pilots' statistics for every period which includes time of event.
+    Statistics of missions are not counted.
+    """
+
+    def __init__(self, flights=None):
+        """
+        Input:
+        `flights`   # a dictionary with pilots who were in the air after the
+                    # previous refresh (see 'StatsAggregator.flights')
+        """
+        super(RollupAggregator, self).__init__(flush_interval=None)
+        # Changes of counters keyed by tuples with user's ID, period and
+        # start of period
+        self.rollups = {}
+        self.flights.update(flights or {})
+
+    def _count(self, index, value, event_time, user_id, dummy_mission_id,
+               dummy_army):
+        if user_id is None:
+            return
+        for period, start in PilotRollup.get_starts(local_date(event_time)):
+            key = (user_id, period, start)
+            counters = self.rollups.get(key)
+            if counters is None:
+                counters = self.rollups[key] = [0, ] * len(
+                    PilotRollup.COUNTERS)
+            counters[index] += value
+
+    def save(self):
+        """
+        Add changes of counters to rollups. Must be called within a
+        transaction.
+        """
+        add_counters(PilotRollup, self.rollups,
+                     lambda (user_id, period, start): {
+                         'user_id': user_id,
+                         'period': period,
+                         'start': start,
+                     })
+        self.rollups = {}
+
+
+def refresh_rollups(chunk_size=None):
+    """
+    Add events which were stored since the previous refresh to rollups.
+    Events are processed by chunks, every chunk is processed in a separate
+    transaction and increases version of rollups.
+
+    Output:
+    Current version of rollups.
+    """
+    chunk_size = chunk_size or settings.COMMANDER_ROLLUPS['chunk_size']
+    RollupState.objects.get_or_create(pk=1)
+
+    while True:
+        with transaction.atomic():
+            # Lock state, so rollups are not refreshed by several tasks
+            state = RollupState.objects.select_for_update().get(pk=1)
+            events = list(Event.objects.filter(
+                pk__gt=state.last_event_id).order_by('pk')[:chunk_size])
+            if events:
+                aggregator = RollupAggregator(load_flights(state.flights))
+                for event in events:
+                    aggregator.add(event, json.loads(event.data)
+                                          if event.data else {})
+                aggregator.save()
+
+                state.last_event_id = events[-1].pk
+                state.flights = dump_flights(aggregator.flights)
+                state.version += 1
+                state.updated = timezone.now()
+                state.save()
+        if len(events) < chunk_size:
+            break
+
+    cache.set(ROLLUPS_VERSION_CACHE_KEY, state.version)
+    return state.version
+
+
+def get_rollups_version():
+    """
+    Get current version of rollups. Version is changed every time new events
+    are added to rollups.
+    """
+    version = cache.get(ROLLUPS_VERSION_CACHE_KEY)
+    if version is None:
+        versions = RollupState.objects.values_list('version', flat=True)[:1]
+        version = versions[0] if versions else 0
+        cache.set(ROLLUPS_VERSION_CACHE_KEY, version)
+    return version
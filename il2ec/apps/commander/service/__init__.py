@@ -3,29 +3,29 @@
 Commander main services.
 """
 import ConfigParser
+import time
 import tx_logging
 
 from collections import namedtuple
 
 from django.utils.translation import ugettext as _
 
-from il2ds_middleware.parser import (ConsoleParser, DeviceLinkParser,
-    EventLogParser, )
+from il2ds_middleware.constants import MISSION_STATUS
+from il2ds_middleware.parser import ConsoleParser, DeviceLinkParser
 from il2ds_middleware.protocol import (DeviceLinkClient,
     ReconnectingConsoleClientFactory, )
-from il2ds_middleware.service import (LogWatchingService,
+from il2ds_middleware.service import (
     ClientServiceMixin as DefaultClientServiceMixin, )
 
 from twisted.application.service import MultiService, Service
-from twisted.internet import defer, task
+from twisted.internet import defer, task, threads
 from twisted.internet.protocol import Factory
 
 from commander import settings
-from commander.helpers import set_server_update_token
+from commander.helpers import (share_server_info, clear_shared_storage,
+    save_commander_snapshot, pop_commander_snapshot, )
 from commander.protocol.async import APIServerProtocol
-from commander.sharing import (shared_storage, KEY_SERVER_RUNNING,
-    KEY_SERVER_NAME, KEY_SERVER_LOCAL_ADDRESS, KEY_SERVER_USER_PORT,
-    KEY_SERVER_CHANNELS, KEY_SERVER_DIFFICULTY, )
+from commander.service.console import ConsoleCommandQueue
 
 
 LOG = tx_logging.getLogger(__name__)
@@ -41,6 +41,10 @@ class ClientServiceMixin(DefaultClientServiceMixin):
     def dl_client(self):
         return self.parent.dl_client
 
+    @property
+    def cl_queue(self):
+        return self.parent.cl_queue
+
 
 class CommanderService(MultiService, ClientServiceMixin):
     """
@@ -50,26 +54,58 @@ class CommanderService(MultiService, ClientServiceMixin):
 
     def __init__(self):
         MultiService.__init__(self)
+        # Snapshot left by previous run must be read before shared storage
+        # is cleared
+        self.snapshot = pop_commander_snapshot()
         self.clear_shared_storage()
+        self.snapshot_saver = task.LoopingCall(self.save_snapshot)
 
         # Place to store some of server confs values --------------------------
         self.confs = {}
 
-        # Init pilots service -------------------------------------------------
-        from commander.service.pilots import PilotsService
-        pilots = PilotsService()
-        pilots.setServiceParent(self)
+        # Init users database service -----------------------------------------
+        from commander.service.users import UsersService
+        users = UsersService()
+        users.setServiceParent(self)
 
         # Init objects service ------------------------------------------------
         from commander.service.objects import ObjectsService
         objects = ObjectsService()
         objects.setServiceParent(self)
 
+        # Init pilots service -------------------------------------------------
+        from commander.service.pilots import PilotsService
+        pilots = PilotsService(users, objects)
+        pilots.setServiceParent(self)
+
+        # Init store of events with statistics --------------------------------
+        from commander.service.events_store import (EventsStoreService,
+            StoringEventLogParser, )
+        from commander.service.stats import StatsAggregator
+        stats = StatsAggregator(
+            flush_interval=settings.COMMANDER_STATS['flush_interval'])
+        events_store = EventsStoreService(
+            batch_size=settings.COMMANDER_EVENTS_STORE['batch_size'],
+            batch_interval=settings.COMMANDER_EVENTS_STORE['batch_interval'],
+            max_queue=settings.COMMANDER_EVENTS_STORE['max_queue'],
+            max_retries=settings.COMMANDER_EVENTS_STORE['max_retries'],
+            retry_delay=settings.COMMANDER_EVENTS_STORE['retry_delay'],
+            aggregator=stats)
+        events_store.setServiceParent(self)
+
         # Init missions service with log watcher ------------------------------
         from commander.service.missions import MissionsService
-        log_watcher = LogWatchingService(settings.IL2_EVENTS_LOG_PATH)
-        missions = MissionsService(log_watcher)
-        log_parser = EventLogParser((pilots, objects, missions, ))
+        from commander.service.events_log import EventsLogWatcher
+        self.log_watcher = log_watcher = EventsLogWatcher(
+            settings.IL2_EVENTS_LOG_PATH,
+            settings.IL2_EVENTS_LOG['checkpoint_path'],
+            chunk_size=settings.IL2_EVENTS_LOG['chunk_size'],
+            poll_interval=settings.IL2_EVENTS_LOG['poll_interval'],
+            checkpoint_interval=settings.IL2_EVENTS_LOG[
+                'checkpoint_interval'])
+        missions = MissionsService(log_watcher, objects)
+        log_parser = StoringEventLogParser((pilots, objects, missions, ),
+                                           events_store)
         log_watcher.set_parser(log_parser)
         missions.setServiceParent(self)
 
@@ -82,8 +118,9 @@ class CommanderService(MultiService, ClientServiceMixin):
             field_names=['console', 'device_link', 'log'])(
             console_parser, device_link_parser, log_parser)
         self.services = namedtuple('commander_services',
-            field_names=['pilots', 'objects', 'missions'])(
-            pilots, objects, missions)
+            field_names=['users', 'pilots', 'objects', 'missions',
+                         'events_store'])(
+            users, pilots, objects, missions, events_store)
 
     @defer.inlineCallbacks
     def startService(self):
@@ -94,8 +131,17 @@ class CommanderService(MultiService, ClientServiceMixin):
         """
         self._load_server_config()
         self._share_data()
-        yield self._greet_n_kick_all()
-        yield MultiService.startService(self)
+
+        snapshot, self.snapshot = self.snapshot, None
+        if self._is_snapshot_fresh(snapshot):
+            yield MultiService.startService(self)
+            reconnected = yield self._find_reconnected(snapshot)
+            yield self.services.pilots.restore(snapshot['pilots'], reconnected)
+        else:
+            yield self._greet_n_kick_all()
+            yield MultiService.startService(self)
+        self.snapshot_saver.start(settings.COMMANDER_SNAPSHOT['interval'],
+                                  now=False)
 
     def _load_server_config(self):
         """
@@ -115,15 +161,73 @@ class CommanderService(MultiService, ClientServiceMixin):
         """
         Load information about game server into a shared storage.
         """
-        shared_storage.update({
-            KEY_SERVER_RUNNING: True,
-            KEY_SERVER_NAME: self.confs['name'],
-            KEY_SERVER_LOCAL_ADDRESS: self.cl_client.transport.getPeer().host,
-            KEY_SERVER_USER_PORT: self.confs['user_port'],
-            KEY_SERVER_CHANNELS: self.confs['channels'],
-            KEY_SERVER_DIFFICULTY: self.confs['difficulty'],
-        })
-        set_server_update_token()
+        share_server_info(
+            name=self.confs['name'],
+            local_address=self.cl_client.transport.getPeer().host,
+            user_port=self.confs['user_port'],
+            channels=self.confs['channels'],
+            difficulty=self.confs['difficulty'])
+
+    @staticmethod
+    def _is_snapshot_fresh(snapshot):
+        if snapshot is None:
+            return False
+        age = time.time() - snapshot['time']
+        if age > settings.COMMANDER_SNAPSHOT['max_age']:
+            LOG.debug("Snapshot is too old ({0:.1f} sec)".format(age))
+            return False
+        return True
+
+    @defer.inlineCallbacks
+    def _find_reconnected(self, snapshot):
+        """
+        Find users who have connected or disconnected since snapshot was
+        taken, so their current sessions may be not the ones which were
+        confirmed. Connections are looked for in events log after position
+        which was read when snapshot was taken.
+
+        Output:
+        Deferred which fires with a set of callsigns or with 'None' if
+        continuity of sessions cannot be proved for anyone.
+        """
+        position = snapshot.get('events_log')
+        if position is None:
+            defer.returnValue(None)
+        try:
+            # Connections are logged only while mission is playing
+            status, dummy_mission = yield self.cl_queue.mission_status()
+            if status != MISSION_STATUS.PLAYING:
+                defer.returnValue(None)
+            from commander.service.events_log import find_reconnected
+            reconnected = yield threads.deferToThread(
+                find_reconnected, self.log_watcher.log_path, position)
+        except Exception as e:
+            LOG.error("Failed to check users' sessions: {err}".format(
+                      err=unicode(e)))
+            defer.returnValue(None)
+        defer.returnValue(reconnected)
+
+    def get_snapshot(self):
+        """
+        Get JSON-serializable snapshot of commander's state. Mission's state
+        is not included, because it is requested from server after start.
+        """
+        return {
+            'time': time.time(),
+            'pilots': self.services.pilots.get_snapshot(),
+            'events_log': self.log_watcher.get_position(),
+        }
+
+    def save_snapshot(self, snapshot=None):
+        """
+        Save snapshot of commander's state to shared storage, so it can be
+        restored even if commander was not stopped cleanly.
+        """
+        try:
+            save_commander_snapshot(snapshot or self.get_snapshot())
+        except Exception as e:
+            LOG.error("Failed to save snapshot: {err}".format(
+                      err=unicode(e)))
 
     @defer.inlineCallbacks
     def _greet_n_kick_all(self):
@@ -132,7 +236,7 @@ class CommanderService(MultiService, ClientServiceMixin):
         after they reconnect. If there are some connected users, notify them
         about kick during 5 seconds.
         """
-        count = yield self.cl_client.users_count()
+        count = yield self.cl_queue.users_count()
         if not count:
             LOG.debug("No users to kick")
             defer.returnValue(None)
@@ -146,9 +250,9 @@ class CommanderService(MultiService, ClientServiceMixin):
                      sec=seconds_left) if seconds_left else \
                    _("Everyone will be kicked NOW!")
             msg2 = _("Please, reconnect after kick.")
-            self.cl_client.chat_all(u"{0} {1}".format(msg1, msg2))
+            self.cl_queue.chat_all(u"{0} {1}".format(msg1, msg2))
 
-        self.cl_client.chat_all(_("Hello everyone! This server is captured by "
+        self.cl_queue.chat_all(_("Hello everyone! This server is captured by "
                                   "IL-2 events commander."))
 
         LOG.debug("Greeting users with notification about kick")
@@ -157,33 +261,62 @@ class CommanderService(MultiService, ClientServiceMixin):
             yield task.deferLater(reactor, 1, notify_users, i)
 
         LOG.debug("Kicking all users")
-        yield self.cl_client.kick_all(self.confs['channels'], timeout=3)
+        yield self.cl_queue.kick_first(self.confs['channels'])
 
     @defer.inlineCallbacks
-    def stop(self, clean=False):
+    def stop(self, clean=False, restarting=False):
         """
         Overloaded base method for stopping commander service with all its
         subservices. Call this method when connection with server is lost or
         commander is going to exit.
 
         Input:
-        clean:  'True' if commander was stopped manually, 'False' if connection
-                with server was lost.
+        clean:      'True' if commander was stopped manually, 'False' if
+                    connection with server was lost.
+        restarting: 'True' if commander will be started again right away.
         """
+        if self.snapshot_saver.running:
+            self.snapshot_saver.stop()
+        snapshot = self.get_snapshot()
+
         if clean:
-            count = yield self.cl_client.users_count()
-            if count:
+            count = yield self.cl_queue.users_count()
+            if count and restarting:
+                LOG.debug("Notifying users about restart")
+                yield self.cl_queue.chat_all(
+                    _("Commander is restarting. Please, stay connected."))
+            elif count:
                 LOG.debug("Notifying users about quitting")
-                self.cl_client.chat_all(
+                yield self.cl_queue.chat_all(
                     _("Commander is quitting. Goodbye everyone!"))
 
         yield MultiService.stopService(self)
         self.confs.clear()
         self.clear_shared_storage()
+        if clean and not restarting:
+            # Users are greeted and kicked as usual after the next start
+            self.snapshot = None
+            self.discard_snapshot()
+        else:
+            # Users may stay connected to server, so they will be taken back
+            # after start or reconnection
+            self.snapshot = snapshot
+            self.save_snapshot(snapshot)
+
+    @staticmethod
+    def discard_snapshot():
+        """
+        Remove snapshot which was saved periodically, so it is not restored
+        after start.
+        """
+        try:
+            pop_commander_snapshot()
+        except Exception as e:
+            LOG.error("Failed to discard snapshot: {err}".format(
+                      err=unicode(e)))
 
     def clear_shared_storage(self):
-        shared_storage.clear()
-        set_server_update_token()
+        clear_shared_storage()
 
     def stopService(self):
         """
@@ -219,6 +352,9 @@ class RootService(Service):
 
     dl_client = None
     cl_client = None
+    cl_queue = None
+    # Whether commander is being stopped to be started again
+    restarting = False
 
     def __init__(self):
         self.cl_connector = None
@@ -243,14 +379,21 @@ class RootService(Service):
         self.api_service = APIService()
         self.api_service.parent = self
 
+        # Prepare listener of requests for updates of server info -------------
+        from commander.service.push import PushService
+        self.push_service = PushService()
+        self.push_service.parent = self
+
     def startService(self):
         """
-        Start API requests listening port and UPD port for communicating with
-        server via DeviceLink interface.
+        Start API requests listening port, listening port for requests for
+        updates of server info and UPD port for communicating with server via
+        DeviceLink interface.
 
         This method is called by application.
         """
         self.api_service.startService()
+        self.push_service.startService()
         self.dl_client.on_start.addCallback(self.start_console_connection)
 
         from twisted.internet import reactor
@@ -276,11 +419,15 @@ class RootService(Service):
         """
         # Stop commander service if running -----------------------------------
         if self.commander.running:
-            yield self.commander.stop(clean=True)
+            yield self.commander.stop(clean=True,
+                                      restarting=self.restarting)
 
         # Stop API listener ---------------------------------------------------
         yield self.api_service.stopService()
 
+        # Stop listener of requests for updates of server info ----------------
+        yield self.push_service.stopService()
+
         # Stop Device Link UDP listener ---------------------------------------
         yield defer.maybeDeferred(self.dl_connector.stopListening)
 
@@ -307,6 +454,11 @@ class RootService(Service):
         established. Main work starts from here.
         """
         self.cl_client = client
+        self.cl_queue = ConsoleCommandQueue(
+            client, settings.COMMANDER_CONSOLE['max_batch_size'],
+            rates=settings.COMMANDER_CONSOLE['rates'],
+            timeout=settings.COMMANDER_TIMEOUT['console'],
+            max_pipelined=settings.COMMANDER_CONSOLE['max_pipelined'])
         self.commander.startService()
 
     def on_connection_lost(self, reason):
@@ -315,5 +467,7 @@ class RootService(Service):
         lost. Stop every work and clean up resources.
         """
         self.cl_client = None
+        self.cl_queue.stop()
+        self.cl_queue = None
         self._update_connection_callbacks()
         return self.commander.stopService()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Listening for messages published to shared storage's channels.
+"""
+import redis
+import threading
+import time
+import tx_logging
+
+from commander.sharing import shared_storage
+
+
+LOG = tx_logging.getLogger(__name__)
+
+
+class ChannelListener(object):
+    """
+    Receives messages from a channel of shared storage in a separate thread
+    and passes them to callbacks in the reactor's thread. Subscription is
+    renewed if connection with shared storage was lost.
+    """
+    # Number of seconds to wait before subscribing again after connection
+    # with shared storage was lost
+    retry_delay = 5
+
+    def __init__(self, channel, on_message, on_subscribed=None, on_lost=None,
+                 name=None):
+        """
+        Input:
+        `channel`           # name of channel to listen to
+        `on_message`        # callable which accepts data of each message
+        `on_subscribed`     # callable to call after subscription is done.
+                            # Messages published before this moment are lost
+        `on_lost`           # callable to call after subscription is lost
+        `name`              # name of listening thread
+        """
+        self.channel = channel
+        self.on_message = on_message
+        self.on_subscribed = on_subscribed
+        self.on_lost = on_lost
+        self.name = name or "commander-channel-{0}".format(channel)
+        self.running = False
+        self._thread = None
+        self._pubsub = None
+
+    def start(self):
+        self.running = True
+        # Listening is blocking and lasts as long as the listener is running
+        self._thread = threading.Thread(target=self._listen, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._thread = None
+        if self._pubsub is not None:
+            try:
+                self._pubsub.unsubscribe()
+            except redis.RedisError:
+                pass
+
+    def _is_current(self, thread):
+        """
+        Tell whether given listening thread was not outdated by restart of
+        the listener.
+        """
+        return self.running and self._thread is thread
+
+    def _call(self, thread, func, *args):
+        """
+        Call a callback in the reactor's thread if listening thread is still
+        current.
+        """
+        def call():
+            if self._is_current(thread):
+                func(*args)
+
+        from twisted.internet import reactor
+        reactor.callFromThread(call)
+
+    def _listen(self):
+        thread = threading.current_thread()
+        while self._is_current(thread):
+            pubsub = self._pubsub = shared_storage.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                if self.on_subscribed is not None:
+                    self._call(thread, self.on_subscribed)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._call(thread, self.on_message, message['data'])
+            except redis.RedisError as e:
+                if not self._is_current(thread):
+                    break
+                LOG.error("Failed to listen to channel '{channel}': {err}"
+                          .format(channel=self.channel, err=unicode(e)))
+                if self.on_lost is not None:
+                    self._call(thread, self.on_lost)
+                time.sleep(self.retry_delay)
+            finally:
+                if self._pubsub is pubsub:
+                    self._pubsub = None
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of commands for game server's console.
+"""
+import time
+import tx_logging
+
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from il2ds_middleware.constants import CHAT_MAX_LENGTH
+from il2ds_middleware.requests import (REQ_CHAT, CHAT_ALL, CHAT_USER,
+    CHAT_ARMY, REQ_KICK_CALLSIGN, REQ_KICK_NUMBER, REQ_KICK_FIRST, )
+
+from commander.constants import ConsolePriority
+
+
+LOG = tx_logging.getLogger(__name__)
+
+
+def chat_lines(message, suffix):
+    """
+    Split chat message into console commands, because server does not accept
+    long messages.
+    """
+    return [
+        REQ_CHAT.format(message[i:i + CHAT_MAX_LENGTH].encode(
+                        'unicode-escape'), suffix)
+        for i in xrange(0, len(message), CHAT_MAX_LENGTH)
+    ]
+
+
+def _ignore_cancelled(failure):
+    failure.trap(defer.CancelledError)
+
+
+class TokenBucket(object):
+    """
+    Rate limiter. Tokens are added to bucket with constant rate until bucket
+    is full. Every sent console line takes one token.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Input:
+        `rate`      # float number of tokens added per second
+        `capacity`  # max number of tokens in bucket
+        """
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, count):
+        """
+        Get number of seconds to wait until given number of tokens can be
+        taken. Commands longer than capacity can be sent when bucket is full.
+        """
+        self._refill()
+        lack = min(count, self.capacity) - self.tokens
+        return lack / self.rate if lack > 0 else 0
+
+    def take(self, count):
+        """
+        Take tokens. Number of tokens goes below zero if more tokens than
+        available are taken, so next commands will wait for longer.
+        """
+        self._refill()
+        self.tokens -= count
+
+
+class ConsoleCommandQueue(object):
+    """
+    Priority queue of commands for game server's console. Commands are put to
+    one of priority classes (see 'ConsolePriority') and commands of higher
+    classes are sent first. Every class can be rate-limited, commands of
+    lower classes are sent while higher ones wait for tokens.
+
+    Requests of query class are pipelined: several of them can be sent
+    without waiting for replies to previous ones, and replies are matched by
+    request IDs. Other requests are sent one at a time when nothing is being
+    processed by server, so commands of higher classes never wait for more
+    than one request or pipeline of lower class. Commands of one class which
+    produce no output (chat messages and kicks) are coalesced and written to
+    console at once as a single request, so server's reply is awaited once
+    per batch instead of once per command.
+    """
+
+    # Priority classes of requests which can be pipelined
+    pipelined = (ConsolePriority.QUERY, )
+
+    def __init__(self, client, max_batch_size, rates=None, timeout=None,
+                 max_pipelined=1):
+        """
+        Input:
+        `client`            # connected 'ConsoleClient'
+        `max_batch_size`    # max number of console lines in one batch
+        `rates`             # a dictionary which maps name of priority class
+                            # to a tuple with rate of lines per second and
+                            # max burst size. Classes which are absent or
+                            # have 'None' rate are not limited
+        `timeout`           # float number of seconds to wait for server to
+                            # process a batch
+        `max_pipelined`     # max number of query requests which are
+                            # processed by server at once
+        """
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.max_pipelined = max(max_pipelined, 1)
+        self.priorities = list(ConsolePriority.iterconstants())
+        # Queues of tuples with list of command's lines (or a function which
+        # sends request and returns deferred), command's deferred and time
+        # of queueing
+        self.queues = {
+            priority: deque() for priority in self.priorities
+        }
+        self.buckets = {}
+        for priority in self.priorities:
+            rate = (rates or {}).get(priority.value)
+            if rate and rate[0]:
+                self.buckets[priority] = TokenBucket(*rate)
+        self.stats = {
+            priority: {
+                'max_queued': 0,
+                'sent': 0,
+                'throttled': 0,
+                'max_wait': 0,
+            } for priority in self.priorities
+        }
+        # Priority classes of requests which are being processed by server
+        self.in_flight = []
+        self.stopped = False
+        self._flush_call = None
+
+    def chat_all(self, message):
+        return self.put(chat_lines(message, CHAT_ALL))
+
+    def chat_user(self, message, callsign):
+        return self.put(chat_lines(message, CHAT_USER.format(callsign)))
+
+    def reply_user(self, message, callsign):
+        """
+        Send a direct reply to user's action, e.g. to the given password.
+        """
+        return self.put(chat_lines(message, CHAT_USER.format(callsign)),
+                        ConsolePriority.REPLY)
+
+    def chat_army(self, message, army):
+        return self.put(chat_lines(message, CHAT_ARMY.format(army)))
+
+    def kick_callsign(self, callsign):
+        return self.put([REQ_KICK_CALLSIGN.format(callsign), ],
+                        ConsolePriority.KICK)
+
+    def kick_number(self, number):
+        return self.put([REQ_KICK_NUMBER.format(number), ],
+                        ConsolePriority.KICK)
+
+    def kick_first(self, count):
+        """
+        Kick first user given number of times. See 'ConsoleClient.kick_all'
+        for details.
+        """
+        return self.put([REQ_KICK_FIRST, ] * count, ConsolePriority.KICK)
+
+    def server_info(self):
+        return self.request(self.client.server_info)
+
+    def mission_status(self):
+        return self.request(self.client.mission_status)
+
+    def users_count(self):
+        return self.request(self.client.users_count)
+
+    def users_common_info(self):
+        return self.request(self.client.users_common_info)
+
+    def users_statistics(self):
+        return self.request(self.client.users_statistics)
+
+    def mission_load(self, mission):
+        return self.request(self.client.mission_load,
+                            ConsolePriority.CONTROL, mission)
+
+    def mission_begin(self):
+        return self.request(self.client.mission_begin,
+                            ConsolePriority.CONTROL)
+
+    def mission_end(self):
+        return self.request(self.client.mission_end, ConsolePriority.CONTROL)
+
+    def mission_destroy(self):
+        return self.request(self.client.mission_destroy,
+                            ConsolePriority.CONTROL)
+
+    def put(self, lines, priority=ConsolePriority.CHAT):
+        """
+        Queue a command which produces no output.
+
+        Input:
+        `lines`     # a list of console lines of the command. Lines of one
+                    # command are always written in one batch
+        `priority`  # 'ConsolePriority' constant
+
+        Output:
+        Deferred which fires with 'None' after server has processed the
+        command, if the command was dropped because connection was lost or
+        if it failed to be written (error is logged). So callers which do
+        not wait for the command need no errbacks.
+        """
+        return self._enqueue(lines, priority)
+
+    def request(self, func, priority=ConsolePriority.QUERY, *args, **kwargs):
+        """
+        Queue a request which produces output.
+
+        Input:
+        `func`      # method of console client which sends request and
+                    # returns deferred
+        `priority`  # 'ConsolePriority' constant
+
+        Output:
+        Deferred which fires with result of request.
+        """
+        return self._enqueue(lambda: func(*args, **kwargs), priority)
+
+    def _enqueue(self, command, priority):
+        d = defer.Deferred()
+        d.addErrback(_ignore_cancelled)
+        if self.stopped:
+            d.cancel()
+            return d
+        queue = self.queues[priority]
+        queue.append((command, d, time.time()))
+        stats = self.stats[priority]
+        stats['max_queued'] = max(stats['max_queued'], len(queue))
+        self._schedule_flush()
+        return d
+
+    def _schedule_flush(self, delay=0):
+        if self.stopped:
+            return
+        from twisted.internet import reactor
+        if self._flush_call is not None:
+            if self._flush_call.getTime() <= reactor.seconds() + delay:
+                # Flush is already scheduled for earlier time
+                return
+            self._flush_call.cancel()
+        self._flush_call = reactor.callLater(delay, self.flush)
+
+    def _cancel_flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+    def _can_send(self, priority):
+        """
+        Tell whether request of given priority class can be sent while other
+        requests are being processed by server.
+        """
+        if not self.in_flight:
+            return True
+        return (priority in self.pipelined and
+                len(self.in_flight) < self.max_pipelined and
+                all(x in self.pipelined for x in self.in_flight))
+
+    def flush(self):
+        """
+        Send requests with queued commands of the highest priority classes
+        which are not limited by rate. Requests of query class are sent while
+        the pipeline has room, other requests are sent only if nothing is
+        being processed by server.
+        """
+        self._cancel_flush()
+
+        while not self.stopped:
+            min_delay = None
+            for priority in self.priorities:
+                queue = self.queues[priority]
+                if not queue:
+                    continue
+                if not self._can_send(priority):
+                    # Lower classes must not overtake this one, flush is
+                    # scheduled again when a request is done
+                    return
+                command = queue[0][0]
+                bucket = self.buckets.get(priority)
+                if bucket is not None:
+                    delay = bucket.delay(
+                        1 if callable(command) else len(command))
+                    if delay:
+                        self.stats[priority]['throttled'] += 1
+                        if min_delay is None or delay < min_delay:
+                            min_delay = delay
+                        continue
+                if callable(command):
+                    self._send_request(priority)
+                else:
+                    self._send_batch(priority)
+                break
+            else:
+                if min_delay is not None:
+                    self._schedule_flush(min_delay)
+                return
+
+    def _pop(self, priority):
+        command, d, queued_at = self.queues[priority].popleft()
+        stats = self.stats[priority]
+        stats['sent'] += 1
+        stats['max_wait'] = max(stats['max_wait'], time.time() - queued_at)
+        return command, d
+
+    def _send_request(self, priority):
+        func, d = self._pop(priority)
+        bucket = self.buckets.get(priority)
+        if bucket is not None:
+            bucket.take(1)
+        self.in_flight.append(priority)
+        defer.maybeDeferred(func).addBoth(self._on_request_done, d, priority)
+
+    def _on_request_done(self, result, d, priority):
+        self.in_flight.remove(priority)
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+        self._schedule_flush()
+
+    def _send_batch(self, priority):
+        queue = self.queues[priority]
+        bucket = self.buckets.get(priority)
+        limit = self.max_batch_size
+        if bucket is not None:
+            limit = min(limit, max(int(bucket.tokens), 1))
+
+        lines, deferreds = [], []
+        while queue and not callable(queue[0][0]):
+            command_lines = queue[0][0]
+            if lines and len(lines) + len(command_lines) > limit:
+                break
+            command_lines, d = self._pop(priority)
+            lines.extend(command_lines)
+            deferreds.append(d)
+
+        if bucket is not None:
+            bucket.take(len(lines))
+        LOG.debug("Writing {0} console commands ({1} lines) of {2} class"
+                  .format(len(deferreds), len(lines), priority.value))
+        self.in_flight.append(priority)
+        self.client.send_request(
+            self.client.delimiter.join(lines), self.timeout).addBoth(
+            self._on_batch_done, deferreds, priority)
+
+    def _on_batch_done(self, result, deferreds, priority):
+        self.in_flight.remove(priority)
+        if isinstance(result, Failure):
+            # Commands produce no output, so failure is reported only here
+            LOG.error("Failed to write {0} console commands: {1}".format(
+                      len(deferreds), unicode(result.value)))
+        for d in deferreds:
+            d.callback(None)
+        self._schedule_flush()
+
+    def get_stats(self):
+        """
+        Get a dictionary which maps name of priority class to a dictionary
+        with current number of queued commands, max number of queued
+        commands, number of sent commands, number of times when the class was
+        skipped because of rate limit and max number of seconds which a
+        command has spent in queue.
+        """
+        result = {}
+        for priority in self.priorities:
+            stats = dict(self.stats[priority])
+            stats['queued'] = len(self.queues[priority])
+            result[priority.value] = stats
+        return result
+
+    def stop(self):
+        """
+        Drop queued commands. Call this method when connection with server's
+        console is lost.
+        """
+        self.stopped = True
+        self._cancel_flush()
+        for priority in self.priorities:
+            queue, self.queues[priority] = self.queues[priority], deque()
+            for dummy_command, d, dummy_queued_at in queue:
+                d.cancel()
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+Commander's watcher of game server's events log.
+"""
+import errno
+import hashlib
+import os
+import re
+import simplejson as json
+import tx_logging
+
+from twisted.application.service import Service
+from twisted.internet import defer
+from twisted.python.filepath import FilePath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+from il2ds_log_parser.regex import (RX_FLAGS, RX_CONNECTED, RX_DISCONNECTED,
+    RX_MISSION_PLAYING, RX_MISSION_BEGIN, RX_MISSION_END, )
+
+
+LOG = tx_logging.getLogger(__name__)
+
+# Max number of bytes of log's first line which identify log
+LOG_ID_SIZE = 1024
+
+# Events of users' connections to server and disconnections from it
+_CONNECTION_EVENTS = [
+    re.compile(rx, RX_FLAGS) for rx in (RX_CONNECTED, RX_DISCONNECTED, )
+]
+
+# Events of missions' flow. Connections may be not logged around them
+_MISSION_EVENTS = [
+    re.compile(rx, RX_FLAGS)
+    for rx in (RX_MISSION_PLAYING, RX_MISSION_BEGIN, RX_MISSION_END, )
+]
+
+
+def get_log_id(data):
+    """
+    Get ID of events log which does not depend on file's inode or name, so
+    log has the same ID after rotation and after compression.
+
+    Input:
+    `data`  # a string from the beginning of log
+
+    Output:
+    A string with hash of the first line of log or 'None' if the first line
+    is not complete yet.
+    """
+    end = data.find('\n', 0, LOG_ID_SIZE)
+    if end < 0:
+        if len(data) < LOG_ID_SIZE:
+            return None
+        end = LOG_ID_SIZE
+    return hashlib.sha1(data[:end].rstrip()).hexdigest()
+
+
+def parse_lines(parser, data, position=None):
+    """
+    Parse complete lines of events log.
+
+    Input:
+    `parser`    # 'EventLogParser' instance
+    `data`      # a string with lines
+    `position`  # a tuple with ID of log and offset of data in it. If it
+                # is given, position of every line is set to parser's
+                # 'position' attribute before the line is parsed
+
+    Output:
+    Number of lines which were recognized as events.
+    """
+    count = 0
+    parse_line = parser.parse_line
+    if position is None:
+        for line in data.splitlines():
+            line = line.strip()
+            if line and parse_line(line):
+                count += 1
+        return count
+
+    log_id, offset = position
+    for line in data.splitlines(True):
+        parser.position = (log_id, offset, )
+        offset += len(line)
+        line = line.strip()
+        if line and parse_line(line):
+            count += 1
+    return count
+
+
+def find_reconnected(log_path, position):
+    """
+    Find users who have connected to server or disconnected from it since
+    given position in events log. Log is read in a blocking way.
+
+    Input:
+    `log_path`  # path to server's events log
+    `position`  # a dictionary with ID of log and byte offset in it (see
+                # 'EventsLogWatcher.get_position')
+
+    Output:
+    A set of callsigns or 'None' if log was rotated, truncated or cannot be
+    read or if mission was changed since given position, i.e. if nothing can
+    be told about connections.
+    """
+    try:
+        with open(log_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            log_id = get_log_id(f.readline(LOG_ID_SIZE))
+            if log_id is None or log_id != position.get('log_id') or \
+               stat.st_size < position['offset']:
+                return None
+            f.seek(position['offset'])
+            callsigns = set()
+            for line in f:
+                line = line.strip()
+                if 'connected' in line:
+                    for rx in _CONNECTION_EVENTS:
+                        m = rx.match(line)
+                        if m:
+                            callsigns.add(m.group('callsign'))
+                            break
+                elif 'Mission' in line:
+                    if any(rx.match(line) for rx in _MISSION_EVENTS):
+                        return None
+            return callsigns
+    except (IOError, OSError) as e:
+        LOG.error("Failed to read events log: {err}".format(err=unicode(e)))
+        return None
+
+
+class EventsLogWatcher(Service):
+    """
+    Watcher of server's events log which remembers the position of the last
+    read event. Position (byte offset and ID of log, see 'get_log_id') is
+    saved to a checkpoint file periodically and on stop, so reading is
+    resumed from the same place after restart and events are not lost. If
+    parser stores events, checkpoint does not go past the first event which
+    is not stored yet. Events which were read after the last saving of
+    checkpoint are parsed again after a crash, so every line is passed to
+    parser with its position and stored events are told apart by it.
+    Reading starts from the end of log if there is no checkpoint.
+
+    Log is read by chunks, lines of a chunk are parsed in one pass. Only one
+    chunk is parsed per iteration of the reactor, so a long backlog does not
+    block other work. Rotation of log is detected by change of inode and
+    truncation is detected by shrinking of file: reading starts from the
+    beginning in both cases.
+
+    While there is nothing to read watcher waits for inotify events. Log is
+    polled periodically if inotify is not available.
+    """
+
+    def __init__(self, log_path, checkpoint_path, parser=None,
+                 chunk_size=1024 * 64, poll_interval=1,
+                 checkpoint_interval=5):
+        """
+        Input:
+        `log_path`              # path to server's events log
+        `checkpoint_path`       # path to file with position in log
+        `chunk_size`            # max number of bytes to read at once
+        `poll_interval`         # float number of seconds between checks of
+                                # log if inotify is not available
+        `checkpoint_interval`   # min float number of seconds between
+                                # savings of checkpoint
+        """
+        self.log_path = os.path.abspath(log_path)
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.set_parser(parser)
+
+        self.log_file = None
+        self.inode = None
+        # ID of log or 'None' if its first line was not read yet
+        self.log_id = None
+        # Position in log right after the last parsed line
+        self.offset = 0
+        # Incomplete line at the end of log
+        self._tail = ''
+        self._saved_at = 0
+        self._read_call = None
+        self._notifier = None
+
+    def set_parser(self, parser):
+        self.parser = parser
+
+    def clear_parser(self):
+        self.set_parser(None)
+
+    def startService(self):
+        if self.running:
+            return
+        Service.startService(self)
+        self._watch()
+        self._open(self._load_checkpoint())
+        # Read events which were written while watcher was stopped
+        self._schedule_read(0)
+
+    def stopService(self):
+        if not self.running:
+            return defer.succeed(None)
+        Service.stopService(self)
+        if self._read_call is not None and self._read_call.active():
+            self._read_call.cancel()
+        self._read_call = None
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+        if self.log_file is not None:
+            self.read()
+            self._save_checkpoint()
+            self._close()
+        return defer.succeed(None)
+
+    def _watch(self):
+        """
+        Subscribe to changes of log's directory. Directory is watched instead
+        of log itself to notice creation of a new log after rotation.
+        """
+        if inotify is None:
+            return
+        mask = inotify.IN_MODIFY | inotify.IN_CREATE | inotify.IN_MOVED_TO | \
+               inotify.IN_MOVED_FROM | inotify.IN_DELETE
+        try:
+            notifier = inotify.INotify()
+            notifier.startReading()
+            notifier.watch(FilePath(os.path.dirname(self.log_path)),
+                           mask=mask, callbacks=[self._on_change, ])
+        except Exception as e:
+            LOG.warning("Failed to watch events log with inotify, polling "
+                        "will be used: {err}".format(err=unicode(e)))
+        else:
+            self._notifier = notifier
+
+    def _on_change(self, dummy_watch, path, dummy_mask):
+        if path.path == self.log_path:
+            self._schedule_read(0)
+
+    def _schedule_read(self, delay=None):
+        if not self.running:
+            return
+        if delay is None:
+            if self._notifier is not None:
+                # Nothing to wait for, inotify will tell about changes
+                return
+            delay = self.poll_interval
+        if self._read_call is not None and self._read_call.active():
+            if delay:
+                return
+            self._read_call.cancel()
+        from twisted.internet import reactor
+        self._read_call = reactor.callLater(delay, self._on_read_time)
+
+    def _on_read_time(self):
+        self._read_call = None
+        try:
+            more = self.read_chunk()
+        except Exception as e:
+            LOG.error("Failed to read events log: {err}".format(
+                      err=unicode(e)))
+            more = False
+        if more:
+            # Let the reactor do other work before the next chunk
+            self._schedule_read(0)
+        else:
+            self._schedule_read()
+
+    def _open(self, checkpoint=None):
+        """
+        Open log and seek to position from checkpoint if it belongs to the
+        same log, to the beginning if log was rotated or truncated or to
+        the end if there is no checkpoint.
+        """
+        try:
+            self.log_file = open(self.log_path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                LOG.error("Failed to open events log: {err}".format(
+                          err=unicode(e)))
+            self.log_file = None
+            return False
+
+        stat = os.fstat(self.log_file.fileno())
+        self.inode = stat.st_ino
+        self.log_id = self._read_log_id()
+        self._tail = ''
+        if checkpoint is None:
+            self.offset = stat.st_size
+        elif checkpoint['log_id'] != self.log_id:
+            LOG.debug("Events log was rotated, reading from the beginning")
+            self.offset = 0
+        elif checkpoint['offset'] > stat.st_size:
+            LOG.debug("Events log was truncated, reading from the beginning")
+            self.offset = 0
+        else:
+            self.offset = checkpoint['offset']
+        self.log_file.seek(self.offset)
+        return True
+
+    def _read_log_id(self):
+        self.log_file.seek(0)
+        return get_log_id(self.log_file.readline(LOG_ID_SIZE))
+
+    def _close(self):
+        self.log_file.close()
+        self.log_file = None
+        self._tail = ''
+
+    def read(self):
+        """
+        Read and parse everything which was appended to log. The reactor is
+        blocked until the end of log is reached.
+        """
+        while self.read_chunk():
+            pass
+
+    def read_chunk(self):
+        """
+        Read and parse the next chunk of log.
+
+        Output:
+        'True' if there may be more to read, 'False' if the end of log was
+        reached.
+        """
+        if self.log_file is None:
+            if not self._open({'log_id': None, 'offset': 0, }):
+                return False
+
+        # Reset end-of-file state of file object, otherwise nothing new is
+        # read after end of file was reached once
+        self.log_file.seek(self.offset + len(self._tail))
+        data = self.log_file.read(self.chunk_size)
+        if data:
+            self._parse_chunk(data)
+            return True
+
+        # Check for rotation or truncation after everything was read
+        try:
+            stat = os.stat(self.log_path)
+        except OSError:
+            # Log was moved and new one is not created yet
+            return False
+        if stat.st_ino != self.inode:
+            LOG.debug("Events log was rotated")
+            self._close()
+            return self._open({'log_id': None, 'offset': 0, })
+        elif stat.st_size < self.offset + len(self._tail):
+            LOG.debug("Events log was truncated")
+            self.log_id = None
+            self.offset = 0
+            self._tail = ''
+            return True
+        return False
+
+    def _parse_chunk(self, data):
+        data = self._tail + data
+        end = data.rfind('\n') + 1
+        self._tail = data[end:]
+        if not end:
+            return
+        if self.log_id is None:
+            # The first line of log is complete now
+            self.log_id = self._read_log_id()
+        offset, self.offset = self.offset, self.offset + end
+        if self.parser:
+            parse_lines(self.parser, data[:end], (self.log_id, offset, ))
+        self._maybe_save_checkpoint()
+
+    def get_position(self):
+        """
+        Get a dictionary with ID of log and offset right after the last
+        parsed line or 'None' if log is not being read.
+        """
+        if self.log_file is None:
+            return None
+        return {
+            'log_id': self.log_id,
+            'offset': self.offset,
+        }
+
+    def get_checkpoint(self):
+        """
+        Get a dictionary with ID of log and offset up to which every event
+        was handled: offset of the first event which is not stored yet if
+        parser stores events or offset right after the last parsed line.
+        """
+        offset = self.offset
+        get_uncommitted_offset = getattr(self.parser, 'get_uncommitted_offset',
+                                         None)
+        if get_uncommitted_offset is not None:
+            uncommitted = get_uncommitted_offset(self.log_id)
+            if uncommitted is not None:
+                offset = min(offset, uncommitted)
+        return {
+            'log_id': self.log_id,
+            'offset': offset,
+        }
+
+    def _maybe_save_checkpoint(self):
+        from twisted.internet import reactor
+        now = reactor.seconds()
+        if now - self._saved_at >= self.checkpoint_interval:
+            self._save_checkpoint()
+            self._saved_at = now
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            return {
+                'log_id': str(checkpoint['log_id']),
+                'offset': int(checkpoint['offset']),
+            }
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                LOG.error("Failed to read checkpoint of events log: {err}"
+                          .format(err=unicode(e)))
+        except (ValueError, KeyError, TypeError) as e:
+            LOG.error("Checkpoint of events log is malformed: {err}".format(
+                      err=unicode(e)))
+        return None
+
+    def _save_checkpoint(self):
+        """
+        Save position in log. Checkpoint is written to a temporary file which
+        replaces the old one, so checkpoint is never partially written.
+        """
+        if self.log_id is None:
+            return
+        tmp_path = self.checkpoint_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.get_checkpoint(), f)
+            os.rename(tmp_path, self.checkpoint_path)
+        except (IOError, OSError) as e:
+            LOG.error("Failed to save checkpoint of events log: {err}".format(
+                      err=unicode(e)))
@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+"""
+Commander's service for storing events from server's events log to database.
+"""
+import datetime
+import itertools
+import simplejson as json
+import threading
+import time
+import tx_logging
+
+from collections import deque
+
+from django.conf import settings as django_settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from il2ds_log_parser import event_types as et
+from il2ds_log_parser.event_types import (EVT_MISSION_PLAYING,
+    EVT_MISSION_END, )
+from il2ds_log_parser.parser import build_default_event_parser
+
+from twisted.application.service import Service
+from twisted.internet import defer, threads
+
+from auth_custom.models import User
+
+from commander.models import Mission, Event
+
+
+LOG = tx_logging.getLogger(__name__)
+
+# Types of events which are never dropped, because they define to which
+# mission other events belong
+MISSION_EVENTS = (EVT_MISSION_PLAYING, EVT_MISSION_END, )
+
+# Max number of callsigns to keep in writer's cache of users' IDs
+USER_IDS_CACHE_SIZE = 10000
+
+
+class StoringEventLogParser(object):
+    """
+    Parser of events log which puts every parsed event to events store
+    before it is passed to services. Events which are not processed by
+    services (e.g. beginning of mission or connection of user) are only put to
+    the store. Events are stored with position of their lines in log (see
+    'parse_lines'), so events which are parsed twice are stored once.
+
+    Lines are parsed by parser of all events which gives types to them and
+    events are passed to the same services' methods as 'EventLogParser' does.
+    """
+
+    def __init__(self, services, store):
+        """
+        Input:
+        `services`  # a tuple with pilots, objects and missions services
+        `store`     # 'EventsStoreService' instance
+        """
+        pilots, objects, missions = services
+        self.store = store
+        # Tuple with ID of log and offset of the current line in it or
+        # 'None' if it is unknown
+        self.position = None
+        # Own instance, so parsers are not shared with anyone else
+        self.parser = build_default_event_parser()
+        self.callbacks = {
+            # Mission flow events
+            et.EVT_MISSION_WON: missions.was_won,
+            et.EVT_TARGET_RESULT: missions.target_end,
+            # User state events
+            et.EVT_WENT_TO_MENU: pilots.went_to_menu,
+            et.EVT_SELECTED_ARMY: pilots.selected_army,
+            # Destruction events
+            et.EVT_DESTROYED_BLD: objects.building_destroyed_by_user,
+            et.EVT_DESTROYED_TREE: objects.tree_destroyed_by_user,
+            et.EVT_DESTROYED_BRIDGE: objects.bridge_destroyed_by_user,
+            et.EVT_DESTROYED_STATIC: objects.static_destroyed_by_user,
+            # Lightning effect events
+            et.EVT_TOGGLE_LANDING_LIGHTS: pilots.toggle_landing_lights,
+            et.EVT_TOGGLE_WINGTIP_SMOKES: pilots.toggle_wingtip_smokes,
+            # Aircraft events
+            et.EVT_WEAPONS_LOADED: pilots.weapons_loaded,
+            et.EVT_TOOK_OFF: pilots.took_off,
+            et.EVT_CRASHED: pilots.crashed,
+            et.EVT_LANDED: pilots.landed,
+            et.EVT_DAMAGED_ON_GROUND: pilots.was_damaged_on_ground,
+            et.EVT_DAMAGED_SELF: pilots.damaged_self,
+            et.EVT_DAMAGED_BY_USER: pilots.was_damaged_by_user,
+            et.EVT_SHOT_DOWN_SELF: pilots.shot_down_self,
+            et.EVT_SHOT_DOWN_BY_STATIC: pilots.was_shot_down_by_static,
+            et.EVT_SHOT_DOWN_BY_USER: pilots.was_shot_down_by_user,
+            # Crew member events
+            et.EVT_SEAT_OCCUPIED: pilots.seat_occupied,
+            et.EVT_KILLED: pilots.was_killed,
+            et.EVT_KILLED_BY_USER: pilots.was_killed_by_user,
+            et.EVT_BAILED_OUT: pilots.bailed_out,
+            et.EVT_SUCCESSFULLY_BAILED_OUT: pilots.parachute_opened,
+            et.EVT_WOUNDED: pilots.was_wounded,
+            et.EVT_HEAVILY_WOUNDED: pilots.was_heavily_wounded,
+            et.EVT_CAPTURED: pilots.was_captured,
+        }
+
+    def parse_line(self, line):
+        """
+        Parse line, store event and tell a corresponding service about it.
+
+        Output:
+        A value returned by service or parsed event or 'None' if line was not
+        parsed.
+        """
+        evt = self.parser(line)
+        if evt is None:
+            return None
+        self.store.put(evt, self.position)
+        callback = self.callbacks.get(evt['type'])
+        if callback is None:
+            return evt
+        return callback(evt) or evt
+
+    __call__ = parse_line
+
+    def get_uncommitted_offset(self, log_id):
+        """
+        Get offset of the first event of given log which is not stored yet
+        (see 'EventsStoreService.get_uncommitted_offset').
+        """
+        return self.store.get_uncommitted_offset(log_id)
+
+
+class EventsStoreService(Service):
+    """
+    Service which writes events to database. Events are put to a bounded
+    in-memory queue and are inserted by a background thread in batches, so
+    the reactor never waits for database. Batch is written as soon as it is
+    full or after a certain period of time since the first event of batch
+    was queued.
+
+    If the queue is full, new events are dropped (except events which start
+    and end missions). Batch which failed to be written is put back to the
+    head of the queue and is written again a limited number of times.
+    Events which have the same positions in events log as already stored
+    ones are skipped. Numbers of dropped and skipped events and max size of
+    the queue are reported by 'get_stats'.
+    """
+
+    thread = None
+
+    def __init__(self, batch_size, batch_interval, max_queue,
+                 max_retries=0, retry_delay=1, aggregator=None):
+        """
+        Input:
+        `batch_size`        # max number of events inserted at once
+        `batch_interval`    # max float number of seconds to wait for batch
+                            # to become full
+        `max_queue`         # max number of events waiting for insertion
+        `max_retries`       # max number of times to write failed batch
+                            # again before it is dropped
+        `retry_delay`       # float number of seconds to wait before the
+                            # first retry, every next one waits longer
+        `aggregator`        # 'StatsAggregator' instance to tell about
+                            # written events
+        """
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.aggregator = aggregator
+        self.queue = deque()
+        # Batch which is being written
+        self.writing = []
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.stats = {
+            'max_queued': 0,
+            'dropped': 0,
+            'skipped': 0,
+            'written': 0,
+            'failed': 0,
+            'retried': 0,
+            'batches': 0,
+            'last_batch_seconds': 0,
+        }
+
+        # State of writer thread: current mission's ID, date of events and
+        # time of the last event used to detect passing of midnight
+        self._mission_id = None
+        self._date = None
+        self._last_time = None
+        self._user_ids = {}
+        # Number of failed attempts to write batch at the head of the queue
+        self._retries = 0
+
+    def startService(self):
+        Service.startService(self)
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run,
+                                       name="commander-events-store")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stopService(self):
+        """
+        Stop writer thread after every queued event is written.
+        """
+        Service.stopService(self)
+        if self.thread is None:
+            return defer.succeed(None)
+        return threads.deferToThread(self.join)
+
+    def join(self):
+        """
+        Stop writer thread after every queued event is written and wait for
+        it. Caller is blocked, so it must not be the reactor's thread.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+
+    def put(self, evt, position=None):
+        """
+        Put event to the queue. This method is called from the reactor's
+        thread and never blocks it for long.
+
+        Input:
+        `evt`       # a dictionary with event
+        `position`  # a tuple with ID of events log and offset of event's
+                    # line in it or 'None' if it is unknown
+        """
+        with self.condition:
+            size = len(self.queue)
+            if size >= self.max_queue and \
+               evt.get('type') not in MISSION_EVENTS:
+                self.stats['dropped'] += 1
+                return
+            # Services may change event later
+            evt = dict(evt)
+            if position is not None:
+                evt['log_position'] = position
+            self.queue.append(evt)
+            size += 1
+            if size > self.stats['max_queued']:
+                self.stats['max_queued'] = size
+            if size == 1 or size >= self.batch_size:
+                self.condition.notify()
+
+    def get_stats(self):
+        """
+        Get a dictionary with current number of queued events, max number of
+        queued events, numbers of dropped, skipped, written, failed and
+        retried events, number of written batches and number of seconds
+        spent on the last batch.
+        """
+        with self.condition:
+            result = dict(self.stats)
+            result['queued'] = len(self.queue)
+        return result
+
+    def get_uncommitted_offset(self, log_id):
+        """
+        Get offset of the first event of given log which is queued or is
+        being written. Log can be parsed again from this offset without loss
+        of events if commander crashes.
+
+        Output:
+        An offset or 'None' if every event of log was written or dropped.
+        """
+        with self.condition:
+            # Events of every log are queued in order of their offsets
+            for evt in itertools.chain(self.writing, self.queue):
+                position = evt.get('log_position')
+                if position is not None and position[0] == log_id:
+                    return position[1]
+        return None
+
+    def _run(self):
+        """
+        Loop of writer thread.
+        """
+        if not self._load():
+            connection.close()
+            return
+
+        # Wake up periodically while there are no events to flush
+        # statistics in time
+        timeout = self.aggregator.flush_interval if self.aggregator else None
+        while True:
+            batch = self._wait_for_batch(timeout)
+            if batch:
+                self._write(batch)
+            elif self.stopping:
+                break
+            if self.aggregator:
+                self.aggregator.maybe_flush()
+
+        if self.aggregator:
+            self.aggregator.flush()
+        connection.close()
+
+    def _wait_for_batch(self, timeout=None):
+        """
+        Wait until batch is full or until time for batch has passed.
+
+        Output:
+        A list of events or an empty list if there were no events during
+        given float number of seconds or if service is stopping and there is
+        nothing more to write.
+        """
+        with self.condition:
+            if not self.queue and not self.stopping:
+                self.condition.wait(timeout)
+            if not self.queue:
+                return []
+            deadline = time.time() + self.batch_interval
+            while len(self.queue) < self.batch_size and not self.stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            count = min(len(self.queue), self.batch_size)
+            popleft = self.queue.popleft
+            self.writing = [popleft() for dummy in xrange(count)]
+            return self.writing
+
+    def _load(self):
+        """
+        Load state of writer and of aggregator. Loading is repeated while
+        database is not available until service is stopped.
+
+        Output:
+        'True' if state was loaded, 'False' if service was stopped before.
+        """
+        while True:
+            try:
+                self._load_state()
+                if self.aggregator:
+                    self.aggregator.load()
+                return True
+            except Exception as e:
+                LOG.error("Failed to load state of events store: {err}"
+                          .format(err=unicode(e)))
+                connection.close()
+            with self.condition:
+                if self.stopping:
+                    return False
+                self.condition.wait(self.retry_delay)
+
+    def _load_state(self):
+        """
+        Continue the last mission if it was not ended, e.g. if commander was
+        restarted while mission was playing.
+        """
+        missions = Mission.objects.filter(ended__isnull=True)[:1]
+        if not missions:
+            return
+        mission = missions[0]
+        last_time = mission.events.order_by('-id').values_list(
+            'time', flat=True)[:1]
+        last_time = self._local(last_time[0] if last_time else mission.began)
+        self._mission_id = mission.pk
+        self._date = last_time.date()
+        self._last_time = last_time.time()
+
+    def _write(self, batch):
+        state = (self._mission_id, self._date, self._last_time, )
+        started_at = time.time()
+        try:
+            with transaction.atomic():
+                events = self._skip_stored(batch)
+                items = self._make_rows(events)
+                rows = [row for row, dummy_data in items]
+                if rows:
+                    Event.objects.bulk_create(rows)
+                    # IDs are not set by bulk insertion, but events are
+                    # inserted by this thread only
+                    last_event_id = Event.objects.order_by(
+                        '-pk').values_list('pk', flat=True)[0]
+        except Exception as e:
+            LOG.error("Failed to write {0} events: {1}".format(
+                      len(batch), unicode(e)))
+            self._mission_id, self._date, self._last_time = state
+            self._user_ids.clear()
+            # Connection may be broken, a new one will be opened
+            connection.close()
+            self._retry(batch)
+            return
+
+        self._retries = 0
+        with self.condition:
+            self.writing = []
+            self.stats['skipped'] += len(batch) - len(events)
+            self.stats['written'] += len(rows)
+            self.stats['batches'] += 1
+            self.stats['last_batch_seconds'] = time.time() - started_at
+
+        if self.aggregator and rows:
+            for row, data in items:
+                self.aggregator.add(row, data)
+            self.aggregator.last_event_id = last_event_id
+
+    def _retry(self, batch):
+        """
+        Put failed batch back to the head of the queue, so events are
+        written in their order, or drop it if it has failed too many times.
+        Wait before the next attempt while database may be unavailable.
+        """
+        with self.condition:
+            self.writing = []
+            if self._retries >= self.max_retries:
+                LOG.error("Dropping {0} events after {1} retries".format(
+                          len(batch), self._retries))
+                self._retries = 0
+                self.stats['failed'] += len(batch)
+                return
+            self._retries += 1
+            self.stats['retried'] += len(batch)
+            self.queue.extendleft(reversed(batch))
+            if not self.stopping:
+                self.condition.wait(self.retry_delay * self._retries)
+
+    @staticmethod
+    def _skip_stored(batch):
+        """
+        Drop events which were stored before, e.g. because events log was
+        parsed again from an older checkpoint after a crash.
+        """
+        positions = [
+            evt['log_position'] for evt in batch if 'log_position' in evt
+        ]
+        if not positions:
+            return batch
+        stored = set(Event.objects.filter(
+            log_id__in=set(log_id for log_id, dummy in positions),
+            log_offset__in=[offset for dummy, offset in positions],
+        ).values_list('log_id', 'log_offset'))
+        if not stored:
+            return batch
+        return [
+            evt for evt in batch
+            if tuple(evt.get('log_position', ())) not in stored
+        ]
+
+    def _make_rows(self, batch):
+        """
+        Convert events to model instances. Missions are created and ended
+        while events are converted, so every event belongs to the mission
+        which was playing at the time of event.
+
+        Output:
+        A list of tuples with 'Event' instance and a dictionary with values
+        of event which are stored as JSON.
+        """
+        if any(evt['type'] == EVT_MISSION_PLAYING for evt in batch):
+            # Users may have signed up since they were looked up
+            self._user_ids.clear()
+        self._look_up_users(batch)
+
+        rows = []
+        for evt in batch:
+            # Event stays untouched in case it will be written again
+            evt = dict(evt)
+            evt_type = evt.pop('type')
+            evt_time = evt.pop('time', None)
+
+            if evt_type == EVT_MISSION_PLAYING:
+                self._begin_mission(evt.pop('mission'), evt.pop('date'),
+                                    evt_time)
+            mission_id = self._mission_id
+            event_datetime = self._get_datetime(evt_time)
+            if evt_type == EVT_MISSION_END:
+                self._end_mission(event_datetime)
+
+            log_id, log_offset = evt.pop('log_position', (None, None))
+            callsign = evt.pop('callsign', '')
+            attacker = evt.pop('attacker', None) or {}
+            attacker_callsign = attacker.get('callsign', '')
+            pos = evt.pop('pos', None) or {}
+            rows.append((Event(
+                mission_id=mission_id,
+                type=evt_type,
+                time=event_datetime,
+                callsign=callsign,
+                user_id=self._user_ids.get(callsign),
+                aircraft=evt.pop('aircraft', ''),
+                attacker_callsign=attacker_callsign,
+                attacker_id=self._user_ids.get(attacker_callsign),
+                attacker_aircraft=attacker.get('aircraft', ''),
+                pos_x=pos.get('x'),
+                pos_y=pos.get('y'),
+                log_id=log_id,
+                log_offset=log_offset,
+                data=json.dumps(evt, default=unicode) if evt else ''), evt))
+        return rows
+
+    def _look_up_users(self, batch):
+        """
+        Get IDs of users who are mentioned in events and are not known yet
+        with a single query.
+        """
+        callsigns = set()
+        for evt in batch:
+            callsigns.add(evt.get('callsign'))
+            callsigns.add((evt.get('attacker') or {}).get('callsign'))
+        callsigns.discard(None)
+        callsigns.discard('')
+        callsigns.difference_update(self._user_ids)
+        if not callsigns:
+            return
+
+        if len(self._user_ids) + len(callsigns) > USER_IDS_CACHE_SIZE:
+            self._user_ids.clear()
+        found = dict(User.objects.filter(
+            callsign__in=callsigns).values_list('callsign', 'pk'))
+        for callsign in callsigns:
+            self._user_ids[callsign] = found.get(callsign)
+
+    def _begin_mission(self, name, date, began):
+        self._date, self._last_time = date, began
+        began = self._get_datetime(began)
+        # Missions which were not ended properly are ended when a new one
+        # begins
+        Mission.objects.filter(ended__isnull=True).update(ended=began)
+        self._mission_id = Mission.objects.create(name=name,
+                                                  began=began).pk
+
+    def _end_mission(self, ended):
+        if self._mission_id is not None:
+            Mission.objects.filter(pk=self._mission_id).update(ended=ended)
+        self._mission_id = None
+
+    def _get_datetime(self, evt_time):
+        """
+        Get date and time of event. Log contains only time of most events,
+        so date is taken from the beginning of mission and is increased if
+        time of event is less than time of the previous event.
+        """
+        if self._date is None:
+            self._date = self._local(timezone.now()).date()
+        if evt_time is None:
+            evt_time = self._last_time or datetime.time()
+        elif self._last_time is not None and evt_time < self._last_time:
+            self._date += datetime.timedelta(days=1)
+        self._last_time = evt_time
+
+        result = datetime.datetime.combine(self._date, evt_time)
+        if django_settings.USE_TZ:
+            result = timezone.make_aware(result,
+                                         timezone.get_default_timezone())
+        return result
+
+    @staticmethod
+    def _local(value):
+        """
+        Convert datetime from database to server's local time.
+        """
+        if django_settings.USE_TZ and timezone.is_aware(value):
+            return timezone.localtime(value, timezone.get_default_timezone())
+        return value
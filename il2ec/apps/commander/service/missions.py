@@ -16,14 +16,28 @@ class MissionsService(DefaultMissionsService, ClientServiceMixin):
     Custom service for missions flow management.
     """
 
+    def __init__(self, log_watcher=None, objects=None):
+        """
+        Input:
+        `log_watcher`   # 'EventsLogWatcher' instance
+        `objects`       # 'ObjectsService' instance which is told about
+                        # beginning and ending of missions
+        """
+        DefaultMissionsService.__init__(self, log_watcher)
+        self.objects = objects
+
     @ClientServiceMixin.radar_refresher
     def began(self, info=None):
+        if self.objects:
+            self.objects.begin_mission()
         DefaultMissionsService.began(self, info)
 
     @ClientServiceMixin.radar_refresher
     def ended(self, info=None):
         DefaultMissionsService.ended(self, info)
+        if self.objects:
+            self.objects.end_mission()
 
     def startService(self):
         DefaultMissionsService.startService(self)
-        return self.cl_client.mission_status()
+        return self.cl_queue.mission_status()
@@ -4,14 +4,220 @@ Commander's objects service.
 """
 import tx_logging
 
+from array import array
+from itertools import izip
+
 from il2ds_middleware.service import MutedObjectsService
+
+from commander import settings
 from commander.service import ClientServiceMixin
+from commander.service.spatial import GridIndex
 
 
 LOG = tx_logging.getLogger(__name__)
 
+# Types of objects in order of their codes
+OBJECT_TYPES = ('building', 'tree', 'static', 'bridge', )
+
+BUILDING, TREE, STATIC, BRIDGE = xrange(len(OBJECT_TYPES))
+
+# Types of objects which have unique names within mission. Names of
+# buildings and trees are names of their models, so such objects are told
+# apart by their positions
+UNIQUE_NAMES = (STATIC, BRIDGE, )
+
+# Index of destroyer of objects which were destroyed by nobody
+NOBODY = -1
+
+
+class MissionObjects(object):
+    """
+    Store of objects which were destroyed in mission. Every field is kept
+    in its own column (typed array or list) instead of a dictionary per
+    object, so thousands of objects take little memory and columns are
+    summarized in one pass. Row of object is found by object's key (see
+    'make_key').
+
+    Callsigns of destroyers are kept once in a separate list and are
+    referred to by their indexes.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.names)
+
+    def clear(self):
+        """
+        Forget all objects, e.g. when a new mission begins.
+        """
+        self.index = {}
+        self.names = []
+        self.types = array('b')
+        self.xs = array('d')
+        self.ys = array('d')
+        # Indexes of callsigns of destroyers or 'NOBODY'
+        self.destroyed_by = array('l')
+        self.callsigns = []
+        self._callsign_ids = {}
+
+    @staticmethod
+    def make_key(name, obj_type, x, y):
+        """
+        Get key which identifies object within mission.
+        """
+        if obj_type in UNIQUE_NAMES:
+            return name
+        return (name, int(round(x)), int(round(y)), )
+
+    def destroy(self, name, obj_type, x, y, callsign=None):
+        """
+        Remember destroyed object.
+
+        Input:
+        `name`      # object's name
+        `obj_type`  # code of object's type
+        `x`         # float x coordinate of object
+        `y`         # float y coordinate of object
+        `callsign`  # callsign of destroyer or 'None'
+
+        Output:
+        Number of object's row or 'None' if object was already destroyed.
+        """
+        key = self.make_key(name, obj_type, x, y)
+        if key in self.index:
+            return None
+        row = self.index[key] = len(self.names)
+        self.names.append(name)
+        self.types.append(obj_type)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.destroyed_by.append(self._get_callsign_id(callsign))
+        return row
+
+    def _get_callsign_id(self, callsign):
+        if not callsign:
+            return NOBODY
+        callsign_id = self._callsign_ids.get(callsign)
+        if callsign_id is None:
+            callsign_id = self._callsign_ids[callsign] = len(self.callsigns)
+            self.callsigns.append(callsign)
+        return callsign_id
+
+    def get(self, row):
+        """
+        Get a dictionary with state of object in given row.
+        """
+        destroyed_by = self.destroyed_by[row]
+        return {
+            'name': self.names[row],
+            'type': OBJECT_TYPES[self.types[row]],
+            'pos': {
+                'x': self.xs[row],
+                'y': self.ys[row],
+            },
+            'destroyed_by': self.callsigns[destroyed_by]
+                            if destroyed_by != NOBODY else None,
+        }
+
+    def summarize(self):
+        """
+        Count destroyed objects by types and by destroyers.
+
+        Output:
+        A dictionary with summary. Example:
+
+        {
+            'destroyed': {'building': 10, 'static': 2, },
+            'destroyed_by': {
+                'CALLSIGN': {'building': 7, 'static': 2, },
+            },
+        }
+        """
+        by_types = [0, ] * len(OBJECT_TYPES)
+        by_users = {}
+        for obj_type, user_id in izip(self.types, self.destroyed_by):
+            by_types[obj_type] += 1
+            if user_id != NOBODY:
+                counts = by_users.get(user_id)
+                if counts is None:
+                    counts = by_users[user_id] = [0, ] * len(OBJECT_TYPES)
+                counts[obj_type] += 1
+        return {
+            'destroyed': _name_counts(by_types),
+            'destroyed_by': {
+                self.callsigns[user_id]: _name_counts(counts)
+                for user_id, counts in by_users.iteritems()
+            },
+        }
+
+
+def _name_counts(counts):
+    return {
+        OBJECT_TYPES[obj_type]: count
+        for obj_type, count in enumerate(counts) if count
+    }
+
 
 class ObjectsService(MutedObjectsService, ClientServiceMixin):
     """
-    Custom service for mission objects management.
+    Custom service for mission objects management. Keeps objects which were
+    destroyed in current mission and index of their positions.
     """
+
+    def __init__(self):
+        self.objects = MissionObjects()
+        # Index of positions of objects keyed by their rows
+        self.grid = GridIndex(settings.COMMANDER_SPATIAL_INDEX['cell_size'])
+
+    def building_destroyed_by_user(self, info):
+        self._destroyed(info['building'], BUILDING, info)
+
+    def tree_destroyed_by_user(self, info):
+        self._destroyed(info['tree'], TREE, info)
+
+    def static_destroyed_by_user(self, info):
+        self._destroyed(info['static'], STATIC, info)
+
+    def bridge_destroyed_by_user(self, info):
+        self._destroyed(info['bridge'], BRIDGE, info)
+
+    def _destroyed(self, name, obj_type, info):
+        pos = info['pos']
+        row = self.objects.destroy(name, obj_type, pos['x'], pos['y'],
+                                   info.get('callsign'))
+        if row is not None:
+            self.grid.update(row, self.objects.xs[row], self.objects.ys[row])
+
+    def get_objects_nearby(self, x, y, radius):
+        """
+        Get objects which are within given radius from point.
+
+        Output:
+        A list of tuples with a dictionary with object's state (see
+        'MissionObjects.get') and distance to object in meters sorted by
+        distance.
+        """
+        return [
+            (self.objects.get(row), distance)
+            for row, distance in self.grid.query_radius(x, y, radius)
+        ]
+
+    def begin_mission(self):
+        self.objects.clear()
+        self.grid.clear()
+
+    def end_mission(self):
+        """
+        Log summary of objects destroyed in ended mission (see
+        'MissionObjects.summarize').
+        """
+        summary = self.objects.summarize()
+        LOG.info("Objects destroyed in mission: {destroyed}, by users: "
+                 "{destroyed_by}".format(**summary))
+
+    def stopService(self):
+        self.objects.clear()
+        self.grid.clear()
+        return MutedObjectsService.stopService(self)
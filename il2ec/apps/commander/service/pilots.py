@@ -2,19 +2,25 @@
 """
 Commander's pilots service.
 """
+import math
 import tx_logging
 
 from django.utils.translation import ugettext as _
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.internet.task import LoopingCall
 
 from il2ds_middleware.service import MutedPilotsService
 
+from commander import settings
 from commander.constants import UserCommand as Commands
 from commander.service import ClientServiceMixin
+from commander.service import radar, state as pilot_state
+from commander.service.spatial import GridIndex
+from commander.service.state import PilotState
+from commander.sharing import shared_storage
+from commander.service.telemetry import AdaptiveLoop
 
-from auth_custom.models import User
 from auth_custom.settings import (CONNECTION_PASSWORD_REQUESTS_COUNT,
     CONNECTION_PASSWORD_REQUESTS_PERIOD, )
 
@@ -39,16 +45,16 @@ class PendingPilot(Pilot):
     def __init__(self, user, client):
         super(PendingPilot, self).__init__(user, client)
         self.calls_left = CONNECTION_PASSWORD_REQUESTS_COUNT
-        self.caller = LoopingCall(self.callback)
-
-    def start(self):
-        self.caller.start(CONNECTION_PASSWORD_REQUESTS_PERIOD)
-
-    def stop(self):
-        if self.caller.running:
-            self.caller.stop()
+        # Deferred result of connection password check which is in progress
+        self.password_check = None
 
     def callback(self):
+        """
+        Ask pilot for password or kick him if there are no calls left.
+
+        Output:
+        'True' if pilot must be called again, 'False' otherwise.
+        """
         if self.calls_left:
             LOG.debug("Ask {0} for password".format(self.user.callsign))
             with self.user.translator:
@@ -56,11 +62,67 @@ class PendingPilot(Pilot):
                         "be kicked.").format(callsign=self.user.callsign)
             self.client.chat_user(msg, self.user.callsign)
             self.calls_left -= 1
+            return True
         else:
-            self.stop()
             LOG.debug("{0} has not entered password and will be kicked"
                      .format(self.user.callsign))
             self.client.kick_callsign(self.user.callsign)
+            return False
+
+
+class PendingPilotsTimer(object):
+    """
+    Timer wheel which calls all pending pilots periodically using a single
+    looping call. Wheel consists of slots, one slot per tick. Each pilot is
+    put to the slot of current tick and is called every time the wheel makes
+    a full turn, so pilots which are due on the same tick are called in one
+    pass and their console requests are written together.
+    """
+    def __init__(self, period, resolution=1):
+        """
+        Input:
+        `period`        # number of seconds between calls of each pilot
+        `resolution`    # number of seconds between ticks
+        """
+        self.resolution = resolution
+        self.size = max(1, int(math.ceil(period / float(resolution))))
+        self.slots = [set() for i in xrange(self.size)]
+        self.positions = {}
+        self.current = 0
+        self.ticker = LoopingCall.withCount(self.tick)
+
+    def add(self, pilot):
+        self.slots[self.current].add(pilot)
+        self.positions[pilot] = self.current
+        if not self.ticker.running:
+            self.ticker.start(self.resolution, now=False)
+
+    def remove(self, pilot):
+        slot = self.positions.pop(pilot, None)
+        if slot is not None:
+            self.slots[slot].discard(pilot)
+        if not self.positions and self.ticker.running:
+            self.ticker.stop()
+
+    def tick(self, count):
+        """
+        `count` - the number of ticks since last call. Slots of missed ticks
+        are processed too.
+        """
+        for i in xrange(min(count, self.size)):
+            self.current = (self.current + 1) % self.size
+            for pilot in list(self.slots[self.current]):
+                if not pilot.callback():
+                    self.remove(pilot)
+        if count > self.size:
+            self.current = (self.current + count - self.size) % self.size
+
+    def clear(self):
+        for slot in self.slots:
+            slot.clear()
+        self.positions.clear()
+        if self.ticker.running:
+            self.ticker.stop()
 
 
 class ConfirmedPilot(Pilot):
@@ -69,13 +131,7 @@ class ConfirmedPilot(Pilot):
     """
     def __init__(self, user, client):
         super(ConfirmedPilot, self).__init__(user, client)
-
-        self.ping = 0
-        self.score = 0
-        self.army = None
-        self.weapons = {}
-        self.aircraft = {}
-        self.position = {}
+        self.state = PilotState()
 
     @classmethod
     def from_pilot(cls, instance):
@@ -91,12 +147,85 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
     # Dictionary which maps callsign to pending pilots
     pending = {}
 
-    def __init__(self):
+    def __init__(self, users, objects=None):
+        """
+        Input:
+        `users`     # 'UsersService' instance used for non-blocking access to
+                    # users' database
+        `objects`   # 'ObjectsService' instance which is asked about
+                    # objects around pilots
+        """
+        self.users = users
+        self.objects = objects
+        # Dictionary which maps callsign to deferred user lookup of a pilot
+        # who has joined, but is not pending or confirmed yet
+        self.joining = {}
         # Mapping of user commands to handlers
         self.command_handlers = {
             Commands.CONNECTION_PASSWORD: self.on_connection_password,
+            Commands.NEARBY: self.on_nearby,
         }
-        self.info_collector = LoopingCall.withCount(self.collect_info)
+        # Pilots' ping, score and weapons are collected less frequently than
+        # their positions
+        self.info_collector = self._make_collector(
+            self.collect_info,
+            settings.COMMANDER_TELEMETRY['info_interval'],
+            settings.COMMANDER_TELEMETRY['info_interval_per_pilot'])
+        self.positions_collector = self._make_collector(
+            self.collect_positions,
+            settings.COMMANDER_TELEMETRY['positions_interval'],
+            settings.COMMANDER_TELEMETRY['positions_interval_per_pilot'])
+        self.pending_timer = PendingPilotsTimer(
+            CONNECTION_PASSWORD_REQUESTS_PERIOD)
+        # Number of the last committed change of confirmed pilots' states
+        self.version = 0
+        # Dictionary which maps callsign of removed confirmed pilot to
+        # version of removal
+        self.removed = {}
+        # Version of pilots' state which was written to shared storage
+        self.shared_version = 0
+        # Deferred write of pilots' state which is in progress and a flag
+        # which tells that there are changes made during that write
+        self._sharing = None
+        self._share_again = False
+        # Deferred write of radar picture which is in progress and the latest
+        # picture which waits for it
+        self._radar_sharing = None
+        self._radar_pending = None
+        # Index of positions of confirmed pilots keyed by callsigns
+        self.grid = GridIndex(settings.COMMANDER_SPATIAL_INDEX['cell_size'])
+        if radar.numpy is not None:
+            self.radar = radar.RadarEngine(**settings.COMMANDER_RADAR)
+        else:
+            LOG.warning("NumPy is not installed, radar picture will not be "
+                        "built")
+            self.radar = None
+
+    def _make_collector(self, func, interval, interval_per_pilot):
+        return AdaptiveLoop(
+            func, interval,
+            interval_per_item=interval_per_pilot,
+            latency_factor=settings.COMMANDER_TELEMETRY['latency_factor'],
+            count_items=lambda: len(self.confirmed))
+
+    def get_telemetry_stats(self):
+        """
+        Get a dictionary with statistics of loops which collect pilots' info
+        and positions (see 'AdaptiveLoop.get_stats').
+        """
+        return {
+            'pilots': len(self.confirmed),
+            'info': self.info_collector.get_stats(),
+            'positions': self.positions_collector.get_stats(),
+        }
+
+    def start_collecting(self):
+        self.info_collector.start()
+        self.positions_collector.start()
+
+    def stop_collecting(self):
+        self.info_collector.stop()
+        self.positions_collector.stop()
 
     def user_joined(self, info):
         callsign = info['callsign']
@@ -106,19 +235,88 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
         if self.is_callsign_used(callsign):
             LOG.debug(
                 "Callsign {0} is already used".format(callsign))
-            self.cl_client.chat_user(
+            self.cl_queue.chat_user(
                 _("{callsign}, your callsign is already used.").format(
                    callsign=callsign), callsign)
-            self.cl_client.kick_callsign(callsign)
+            self.cl_queue.kick_callsign(callsign)
+            return
+
+        return self._look_up_user(callsign)
+
+    def _look_up_user(self, callsign, restored=False):
+        """
+        Look for user in database without blocking other events.
+        """
+        d = self.users.get_by_callsign(callsign)
+        self.joining[callsign] = d
+        d.addCallbacks(self._on_user_found, self._on_user_lookup_failed,
+                       callbackArgs=(callsign, d, restored, ),
+                       errbackArgs=(callsign, d, ))
+        return d
+
+    @defer.inlineCallbacks
+    def restore(self, snapshot, reconnected=None):
+        """
+        Take back pilots who were online before restart of commander. Every
+        connected user is requested at once. Users who had confirmed their
+        connection passwords before restart and are still in the same
+        sessions are confirmed again without asking for password, others are
+        processed as newly joined.
+
+        Input:
+        `snapshot`      # a dictionary returned by 'get_snapshot'
+        `reconnected`   # a set of callsigns of users who have connected or
+                        # disconnected since snapshot was taken or 'None' if
+                        # it is unknown whether sessions are still the same
+        """
+        infos = yield self.cl_queue.users_common_info()
+        confirmed = set(snapshot['confirmed'])
+        if reconnected is None:
+            LOG.debug("Sessions of users are not known to be the same, "
+                      "everyone will be asked for password")
+            confirmed.clear()
+        else:
+            confirmed.difference_update(reconnected)
+        LOG.debug("Restoring {0} of {1} connected users".format(
+                  len(confirmed.intersection(infos)), len(infos)))
+        lookups = []
+        for callsign in infos.iterkeys():
+            if self.is_callsign_used(callsign):
+                continue
+            if callsign in confirmed:
+                lookups.append(self._look_up_user(callsign, restored=True))
+            else:
+                lookups.append(self.user_joined({'callsign': callsign, }))
+        yield defer.DeferredList(lookups)
+
+    def get_snapshot(self):
+        """
+        Get JSON-serializable snapshot of pilots' state which can be restored
+        after restart of commander.
+        """
+        return {
+            'confirmed': sorted(self.confirmed.iterkeys()),
+        }
+
+    def _is_still_joining(self, callsign, lookup):
+        """
+        Tell whether user lookup was not outdated by leaving of the pilot.
+        """
+        if self.joining.get(callsign) is not lookup:
+            LOG.debug("{0} has left before lookup was done".format(callsign))
+            return False
+        del self.joining[callsign]
+        return True
+
+    def _on_user_found(self, user, callsign, lookup, restored=False):
+        if not self._is_still_joining(callsign, lookup):
             return
 
         # Check whether user is registered ------------------------------------
-        try:
-            user = User.objects.get(callsign=callsign)
-        except User.DoesNotExist:
+        if user is None:
             LOG.debug(
                 "{0} is not registered and will be kicked".format(callsign))
-            self.cl_client.chat_user(
+            self.cl_queue.chat_user(
                 _("You are not registered. Please, create an account first."),
                 callsign)
             self._delayed_kick(callsign)
@@ -132,38 +330,61 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
                 msg = _("{callsign}, you are not allowed to connect. Please, "
                         "request connection on the website.").format(
                          callsign=callsign)
-            self.cl_client.chat_user(msg, callsign)
+            self.cl_queue.chat_user(msg, callsign)
             self._delayed_kick(callsign)
             return
 
+        # Confirm pilot who had confirmed password before restart -----------
+        if restored:
+            LOG.debug("Restore {0}".format(callsign))
+            self._confirm(Pilot(user, self.cl_queue))
+            return
+
         # Create a pending pilot and kick user if no password was given during
         # certain period of time
-        pending = PendingPilot(user, self.cl_client)
+        pending = PendingPilot(user, self.cl_queue)
         self.pending[callsign] = pending
-        pending.start()
+        if pending.callback():
+            self.pending_timer.add(pending)
+
+    def _on_user_lookup_failed(self, failure, callsign, lookup):
+        if not self._is_still_joining(callsign, lookup):
+            return
+        LOG.error("Failed to get user {0} from database: {1}".format(
+                  callsign, unicode(failure.value)))
+        self._delayed_kick(callsign)
 
     def is_callsign_used(self, callsign):
-        return callsign in self.confirmed or callsign in self.pending
+        return callsign in self.confirmed or callsign in self.pending or \
+               callsign in self.joining
 
     def _delayed_kick(self, callsign, delay=10):
         from twisted.internet import reactor
-        reactor.callLater(delay, self.cl_client.kick_callsign, callsign)
+        reactor.callLater(delay, self.cl_queue.kick_callsign, callsign)
 
     @ClientServiceMixin.radar_refresher
     def user_left(self, info):
         callsign = info['callsign']
         LOG.debug("{0} has left".format(callsign))
 
-        if callsign in self.pending:
+        if callsign in self.joining:
+            LOG.debug("Forgetting joining pilot {0}".format(callsign))
+            del self.joining[callsign]
+
+        elif callsign in self.pending:
             LOG.debug("Removing pending pilot {0}".format(callsign))
-            self.pending[callsign].stop()
-            del self.pending[callsign]
+            self.pending_timer.remove(self.pending.pop(callsign))
 
         elif callsign in self.confirmed:
             LOG.debug("Removing confirmed pilot {0}".format(callsign))
             del self.confirmed[callsign]
-            if not self.confirmed and self.info_collector.running:
-                self.info_collector.stop()
+            self.grid.remove(callsign)
+            self.version += 1
+            self.removed[callsign] = self.version
+            self.share_changes()
+            self.refresh_radar()
+            if not self.confirmed:
+                self.stop_collecting()
 
     def user_chat(self, (callsign, message)):
         pilot = self.get_pilot(callsign)
@@ -171,7 +392,7 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
         if pilot is None:
             LOG.debug("Chat message from anonymous {0}: '{1}'".format(
                       callsign, message))
-            self.cl_client.chat_user(
+            self.cl_queue.chat_user(
                 _("Sorry, anonymous users are not allowed to use chat."),
                 callsign)
             return
@@ -182,7 +403,7 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
             LOG.debug(
                 "Unknown command from {0}: '{1}'".format(callsign, message))
             with pilot.user.translator:
-                self.cl_client.chat_user(_("Unknown command."), callsign)
+                self.cl_queue.chat_user(_("Unknown command."), callsign)
             return
 
         if command:
@@ -192,7 +413,7 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
                 LOG.debug("Invalid arguments for command '{0}' from {1}: '{2}'"
                           .format(command.value, callsign, ', '.join(args)))
                 with pilot.user.translator:
-                    self.cl_client.chat_user(
+                    self.cl_queue.chat_user(
                         _("Invalid arguments for command '{command}'.").format(
                           command=command.value), callsign)
                 return
@@ -210,87 +431,307 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
             self._process_password(pilot, password)
         elif isinstance(pilot, ConfirmedPilot):
             with pilot.user.translator:
-                self.cl_client.chat_user(
+                self.cl_queue.reply_user(
                     _("Your password was already accepted. Happy flying!"),
                     pilot.user.callsign)
 
+    def on_nearby(self, pilot):
+        """
+        Tell pilot about the nearest pilots of his army and about number of
+        destroyed objects around him. Enemies are not told about.
+        """
+        callsign = pilot.user.callsign
+        if not isinstance(pilot, ConfirmedPilot) or \
+           not pilot.state.has_position:
+            with pilot.user.translator:
+                self.cl_queue.chat_user(_("Your position is unknown yet."),
+                                        callsign)
+            return
+
+        x, y = pilot.state.position[0], pilot.state.position[1]
+        radius = settings.COMMANDER_SPATIAL_INDEX['nearby_radius']
+        army = pilot.state.army
+        friends = [
+            u"{0} {1:.1f}".format(other.user.callsign, distance / 1000.0)
+            for other, distance in self.get_pilots_nearby(x, y, radius)
+            if other is not pilot and army and other.state.army == army
+        ][:settings.COMMANDER_SPATIAL_INDEX['nearby_limit']]
+        destroyed = len(self.objects.get_objects_nearby(x, y, radius)) \
+                    if self.objects else 0
+
+        with pilot.user.translator:
+            msg = _("Within {radius:.0f} km: {pilots}. Destroyed objects: "
+                    "{destroyed}.").format(
+                    radius=radius / 1000.0,
+                    pilots=u", ".join(friends) or _("no friendly pilots"),
+                    destroyed=destroyed)
+            self.cl_queue.chat_user(msg, callsign)
+
     def _process_password(self, pilot, password):
+        if pilot.password_check is not None:
+            LOG.debug("Password of {0} is already being checked".format(
+                      pilot.user.callsign))
+            return
+
+        d = self.users.check_connection_password(pilot.user, password)
+        pilot.password_check = d
+        d.addCallbacks(self._on_password_checked, self._on_password_failed,
+                       callbackArgs=(pilot, ), errbackArgs=(pilot, ))
+        return d
+
+    def _on_password_checked(self, accepted, pilot):
+        pilot.password_check = None
         user = pilot.user
 
-        if user.check_connection_password(password):
-            LOG.debug("Activate {0}".format(user.callsign))
-            user.clear_connection_password(update=True)
+        if self.pending.get(user.callsign) is not pilot:
+            LOG.debug("{0} has left before password was checked".format(
+                      user.callsign))
+            return
 
-            self.pending[user.callsign].stop()
-            del self.pending[user.callsign]
+        if accepted:
+            LOG.debug("Activate {0}".format(user.callsign))
 
-            confirmed = ConfirmedPilot.from_pilot(pilot)
-            self.confirmed[user.callsign] = confirmed
+            self.pending_timer.remove(self.pending.pop(user.callsign))
+            self._confirm(pilot)
 
             with user.translator:
-                self.cl_client.chat_user(
+                self.cl_queue.reply_user(
                     _("Password accepted. Welcome to server!"), user.callsign)
-
-            if not self.info_collector.running:
-                self.info_collector.start(3)
         else:
             with user.translator:
-                self.cl_client.chat_user(
+                self.cl_queue.reply_user(
                     _("Wrong password. Try again please."), user.callsign)
 
+    def _confirm(self, pilot):
+        callsign = pilot.user.callsign
+        self.confirmed[callsign] = ConfirmedPilot.from_pilot(pilot)
+        self.removed.pop(callsign, None)
+        self.commit_changes()
+        self.start_collecting()
+
+    def _on_password_failed(self, failure, pilot):
+        pilot.password_check = None
+        LOG.error("Failed to check password of {0}: {1}".format(
+                  pilot.user.callsign, unicode(failure.value)))
+
     @defer.inlineCallbacks
-    def collect_info(self, count):
+    def collect_info(self):
         """
-        `count` - the number of calls since last callback was invoked.
+        Request pilots' common info, statistics and positions simultaneously
+        and update confirmed pilots.
         """
-        if count > 1:
-            return
-
-        try:
-            all_infos = yield self.cl_client.users_common_info()
-        except Exception as e:
+        results = yield defer.DeferredList([
+            self.cl_queue.users_common_info(),
+            self.cl_queue.users_statistics(),
+            self.dl_client.all_pilots_pos(),
+        ], consumeErrors=True)
+        ((infos_ok, all_infos), (statistics_ok, all_statistics),
+         (positions_ok, all_positions)) = results
+
+        if not infos_ok:
             LOG.error("Failed to get pilots' common info: {err}".format(
-                      err=unicode(e)))
+                      err=unicode(all_infos.value)))
             defer.returnValue(None)
-        try:
-            all_statistics = yield self.cl_client.users_statistics()
-        except Exception as e:
+        if not statistics_ok:
             LOG.error("Failed to get pilots' statistics: {err}".format(
-                      err=unicode(e)))
+                      err=unicode(all_statistics.value)))
             defer.returnValue(None)
-        try:
-            all_positions = yield self.dl_client.all_pilots_pos()
-        except Exception as e:
-            LOG.error("Failed to get pilots' coordinates: {err}".format(
-                      err=unicode(e)))
-            defer.returnValue(None)
-        else:
-            all_positions = {
-                data['callsign']: data['pos'] for data in all_positions
-            }
 
         callsigns = set(all_infos.keys()).intersection(
                     set(all_statistics.keys())).intersection(
                     set(self.confirmed.keys()))
 
         for callsign in callsigns:
-            pilot, info = self.confirmed[callsign], all_infos[callsign]
+            state, info = self.confirmed[callsign].state, all_infos[callsign]
+            state.update_info(info['ping'], info['score'], info['army_code'],
+                              info.get('aircraft'))
+            state.update_weapons(all_statistics[callsign]['weapons'])
 
-            pilot.ping = info['ping']
-            pilot.score = info['score']
+        if positions_ok:
+            self._update_positions(all_positions)
+        else:
+            LOG.error("Failed to get pilots' coordinates: {err}".format(
+                      err=unicode(all_positions.value)))
+            self.commit_changes()
 
-            if 'aircraft_code' in info:
-                pilot.aircraft['code'] = info['aircraft_code']
-                pilot.aircraft['designation'] = info['designation']
-            else:
-                pilot.aircraft.clear()
+    def collect_positions(self):
+        """
+        Request positions of pilots and update confirmed pilots. Positions
+        are also updated by 'collect_info', so request is skipped if info is
+        being collected right now.
+        """
+        if self.info_collector.busy:
+            return
+
+        def on_error(failure):
+            LOG.error("Failed to get pilots' coordinates: {err}".format(
+                      err=unicode(failure.value)))
 
-            pilot.weapons.update(all_statistics[callsign]['weapons'])
+        return self.dl_client.all_pilots_pos().addCallbacks(
+            self._update_positions, on_error)
 
-            if callsign in all_positions:
-                pilot.position.update(all_positions[callsign])
+    def _update_positions(self, all_positions):
+        all_positions = {
+            data['callsign']: data['pos'] for data in all_positions
+        }
+        for callsign, pilot in self.confirmed.iteritems():
+            state = pilot.state
+            state.update_position(all_positions.get(callsign))
+            if state.has_position:
+                self.grid.update(callsign, state.position[0],
+                                 state.position[1])
             else:
-                pilot.position.clear()
+                self.grid.remove(callsign)
+        self.commit_changes()
+        self.refresh_radar()
+
+    def commit_changes(self):
+        """
+        Stamp changes of confirmed pilots' states with a new version.
+        Version is not changed if nothing was changed.
+        """
+        dirty = [
+            pilot.state for pilot in self.confirmed.itervalues()
+            if pilot.state.dirty
+        ]
+        if dirty:
+            self.version += 1
+            for state in dirty:
+                state.commit(self.version)
+            self.share_changes()
+
+    def share_changes(self):
+        """
+        Write changes of pilots' state made since the last write to shared
+        storage, so they will be available for website. All changes are
+        written within a single transaction by a thread, so the reactor does
+        not wait for Redis. Only one write is done at a time: changes which
+        are made during a write are written right after it.
+        """
+        if self._sharing is not None:
+            self._share_again = True
+            return
+        self._share_again = False
+        if self.shared_version == self.version:
+            return
+        version, changed, removed = self.get_changes(
+            self.shared_version, fields=pilot_state.ALL & ~pilot_state.WEAPONS)
+        d = threads.deferToThread(shared_storage.update_pilots, version,
+                                  changed, removed,
+                                  full=not self.shared_version)
+        self._sharing = d
+        d.addCallbacks(self._on_changes_shared, self._on_sharing_failed,
+                       callbackArgs=(d, version, ), errbackArgs=(d, ))
+
+    def _on_changes_shared(self, dummy_result, d, version):
+        if self._sharing is not d:
+            # Service was stopped during the write
+            return
+        self._sharing = None
+        self.shared_version = version
+        if self._share_again:
+            self.share_changes()
+
+    def _on_sharing_failed(self, failure, d):
+        if self._sharing is not d:
+            return
+        self._sharing = None
+        LOG.error("Failed to share pilots' state: {err}".format(
+                  err=unicode(failure.value)))
+        # Write the whole state next time
+        self.shared_version = 0
+
+    def refresh_radar(self):
+        """
+        Build radar picture from positions of confirmed pilots and write it
+        to shared storage by a thread. Radar is refreshed together with
+        positions, i.e. at most once per second. If the previous picture is
+        still being written, only the latest one is written after it.
+        """
+        if self.radar is None:
+            return
+        snapshot = self.radar.refresh([
+            (callsign, pilot.state.army, pilot.state.position)
+            for callsign, pilot in self.confirmed.iteritems()
+            if pilot.state.has_position
+        ])
+        if self._radar_sharing is not None:
+            self._radar_pending = snapshot
+            return
+        self._share_radar(snapshot)
+
+    def _share_radar(self, snapshot):
+        d = threads.deferToThread(shared_storage.set_radar, snapshot)
+        self._radar_sharing = d
+        d.addCallbacks(self._on_radar_shared, self._on_radar_sharing_failed,
+                       callbackArgs=(d, ), errbackArgs=(d, ))
+
+    def _on_radar_shared(self, dummy_result, d):
+        if self._radar_sharing is not d:
+            return
+        self._radar_sharing = None
+        snapshot, self._radar_pending = self._radar_pending, None
+        if snapshot is not None:
+            self._share_radar(snapshot)
+
+    def _on_radar_sharing_failed(self, failure, d):
+        LOG.error("Failed to share radar picture: {err}".format(
+                  err=unicode(failure.value)))
+        self._on_radar_shared(None, d)
+
+    def get_pilots_nearby(self, x, y, radius):
+        """
+        Get confirmed pilots who are within given radius from point.
+
+        Input:
+        `x`         # float x coordinate of point
+        `y`         # float y coordinate of point
+        `radius`    # float number of meters
+
+        Output:
+        A list of tuples with pilot and distance to him in meters sorted by
+        distance.
+        """
+        return [
+            (self.confirmed[callsign], distance)
+            for callsign, distance in self.grid.query_radius(x, y, radius)
+        ]
+
+    def get_changes(self, since=0, fields=pilot_state.ALL):
+        """
+        Get changes of confirmed pilots' states made after given version.
+
+        Input:
+        `since`     # number of version known by consumer. All states are
+                    # returned if it is 0
+        `fields`    # mask of fields to return
+
+        Output:
+        A tuple with current version number, a dictionary which maps
+        callsigns to dictionaries with changed fields and a list of callsigns
+        of removed pilots. Example:
+
+        (
+            10,
+            {
+                'CALLSIGN1': {
+                    'ping': PING,
+                    'position': {'x': X, 'y': Y, 'z': Z, },
+                },
+            },
+            ['CALLSIGN2', ],
+        )
+        """
+        changed = {}
+        for callsign, pilot in self.confirmed.iteritems():
+            mask = pilot.state.changed_since(since) & fields
+            if mask:
+                changed[callsign] = pilot.state.to_dict(mask)
+        removed = [
+            callsign for callsign, version in self.removed.iteritems()
+            if version > since
+        ] if since else []
+        return self.version, changed, removed
 
     @ClientServiceMixin.radar_refresher
     def weapons_loaded(self, info):
@@ -325,7 +766,17 @@ class PilotsService(MutedPilotsService, ClientServiceMixin):
         pass
 
     def stopService(self):
-        if self.info_collector.running:
-            self.info_collector.stop()
+        self.stop_collecting()
+        self.pending_timer.clear()
+        self.joining.clear()
         self.confirmed.clear()
         self.pending.clear()
+        self.removed.clear()
+        self.grid.clear()
+        self.shared_version = 0
+        self._sharing = None
+        self._share_again = False
+        self._radar_sharing = None
+        self._radar_pending = None
+        if self.radar is not None:
+            self.radar.clear()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Commander's service for pushing updates of server info to website's pages.
+"""
+import simplejson as json
+import tx_logging
+
+from twisted.application.service import Service
+from twisted.internet import defer, threads
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from commander import settings
+from commander.helpers import get_server_version
+from commander.service.channels import ChannelListener
+from commander.sharing import CHANNEL_SERVER_UPDATED
+
+
+LOG = tx_logging.getLogger(__name__)
+
+
+class ServerUpdatesResource(Resource):
+    """
+    Long-polling resource. Request contains version of server info known by
+    client in 'version' argument. Response is sent as soon as a newer
+    version appears or after timeout. Response contains current version:
+
+    {"version": VERSION}
+    """
+    isLeaf = True
+
+    def __init__(self, service):
+        Resource.__init__(self)
+        self.service = service
+
+    def render_GET(self, request):
+        try:
+            version = int(request.args.get('version', [None])[0])
+        except (TypeError, ValueError):
+            version = None
+        d = self.service.wait_for_update(version)
+        d.addCallback(self._on_update, request)
+        d.addErrback(self._on_error, request)
+        request.notifyFinish().addErrback(lambda failure: d.cancel())
+        return NOT_DONE_YET
+
+    @staticmethod
+    def _on_update(version, request):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.write(json.dumps({'version': version}))
+        request.finish()
+
+    @staticmethod
+    def _on_error(failure, request):
+        if failure.check(defer.CancelledError):
+            # Client has disconnected
+            return
+        LOG.error("Failed to wait for update of server info: {err}".format(
+                  err=unicode(failure.value)))
+        request.setResponseCode(503)
+        request.finish()
+
+
+class PushService(Service):
+    """
+    Service which manages HTTP listener of long-polling requests for updates
+    of server info. Clients are notified as soon as new version of server
+    info is published to shared storage, so pages need no periodic polling.
+    Waiting requests do not take any website's workers.
+    """
+
+    listener = None
+
+    def __init__(self):
+        # Last known version of server info or 'None' if it has to be read
+        # from shared storage
+        self.version = None
+        # Deferreds of requests waiting for update
+        self.waiters = set()
+        self.channel = ChannelListener(CHANNEL_SERVER_UPDATED,
+                                       on_message=self.on_version_updated,
+                                       on_subscribed=self.forget_version,
+                                       on_lost=self.forget_version,
+                                       name="commander-push")
+
+    def startService(self):
+        root = Resource()
+        root.putChild('server-info', ServerUpdatesResource(self))
+
+        from twisted.internet import reactor
+        self.listener = reactor.listenTCP(settings.COMMANDER_PUSH['port'],
+            Site(root), interface=settings.COMMANDER_PUSH['host'])
+        self.channel.start()
+        Service.startService(self)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.channel.stop()
+        # Release waiting requests, clients will repeat them
+        waiters, self.waiters = self.waiters, set()
+        for d in waiters:
+            d.callback(self.version)
+        self.forget_version()
+        return defer.maybeDeferred(self.listener.stopListening)
+
+    def forget_version(self):
+        """
+        Forget last known version, because updates may be missed while there
+        is no subscription.
+        """
+        self.version = None
+
+    def on_version_updated(self, version):
+        version = int(version)
+        # Messages may come out of order, versions never go back
+        if self.version is not None and version <= self.version:
+            return
+        self.version = version
+        waiters, self.waiters = self.waiters, set()
+        for d in waiters:
+            d.callback(version)
+
+    def wait_for_update(self, version):
+        """
+        Wait until version of server info differs from given one.
+
+        Output:
+        Deferred which fires with current version.
+        """
+        if self.version is None:
+            return threads.deferToThread(get_server_version).addCallback(
+                self._on_version_loaded, version)
+        if version != self.version:
+            return defer.succeed(self.version)
+        return self._wait(settings.COMMANDER_PUSH['timeout'])
+
+    def _on_version_loaded(self, current, version):
+        if self.version is None or current > self.version:
+            self.version = current
+        return self.wait_for_update(version)
+
+    def _wait(self, timeout):
+        from twisted.internet import reactor
+
+        def on_cancel(d):
+            self.waiters.discard(d)
+            if timer.active():
+                timer.cancel()
+
+        def on_timeout():
+            self.waiters.discard(d)
+            d.callback(self.version)
+
+        def on_done(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        d = defer.Deferred(on_cancel)
+        timer = reactor.callLater(timeout, on_timeout)
+        d.addCallback(on_done)
+        self.waiters.add(d)
+        return d
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Radar picture of online pilots built from their positions.
+"""
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Indexes of columns in array of pilots' coordinates
+X, Y, Z = 0, 1, 2
+
+
+class RadarEngine(object):
+    """
+    Builds snapshots of radar picture from positions of confirmed pilots.
+    Coordinates, armies and headings of all pilots are kept in arrays, so
+    visibility of pilots for every army, distances to the nearest enemies and
+    numbers of pilots of every army in sectors of map are computed in one
+    vectorized pass over all pilots at once instead of pilot-by-pilot loops.
+
+    Heading is not reported by server, so it is taken from the direction of
+    pilot's movement since the previous refresh.
+    """
+
+    def __init__(self, visibility_range, sector_size, min_move=1):
+        """
+        Input:
+        `visibility_range`  # float number of meters within which pilots
+                            # are seen by pilots of other armies
+        `sector_size`       # float number of meters in side of square
+                            # sector of map
+        `min_move`          # min float number of meters which pilot has to
+                            # move to change heading
+        """
+        self.visibility_range = visibility_range
+        self.sector_size = sector_size
+        self.min_move = min_move
+        self.version = 0
+        # Number of seconds which the last refresh took
+        self.last_refresh_seconds = 0
+
+        self.clear()
+
+    def refresh(self, pilots):
+        """
+        Build a new snapshot of radar picture.
+
+        Input:
+        `pilots`    # a list of tuples with callsign, integer code of army
+                    # and a sequence with x, y and z coordinates of every
+                    # pilot who has known position
+
+        Output:
+        A JSON-serializable dictionary. Pilots are listed in a compact form:
+        callsign, army, coordinates, heading in degrees ('None' if unknown)
+        and distance to the nearest enemy in meters ('None' if there are no
+        enemies within visibility range). Armies are keyed by strings with
+        their codes and contain indexes of pilots which they can see and
+        counts of their pilots in sectors. Example:
+
+        {
+            'version': 10,
+            'sector_size': 10000,
+            'pilots': [
+                ['CALLSIGN1', 1, 1000, 2000, 500, 90, 4472],
+                ['CALLSIGN2', 2, 3000, 6000, 800, None, 4472],
+            ],
+            'armies': {
+                '1': {
+                    'visible': [0, 1],
+                    'sectors': [[0, 0, 1]],     # column, row and count
+                },
+                ...
+            },
+        }
+        """
+        started_at = time.time()
+        self.version += 1
+        result = {
+            'version': self.version,
+            'sector_size': self.sector_size,
+            'pilots': [],
+            'armies': {},
+        }
+        if not pilots:
+            self.clear()
+            return result
+
+        count = len(pilots)
+        callsigns = [callsign for callsign, dummy, dummy in pilots]
+        armies = numpy.fromiter((army for dummy, army, dummy in pilots),
+                                dtype=int, count=count)
+        positions = numpy.array([pos for dummy, dummy, pos in pilots],
+                                dtype=float).reshape(count, 3)
+        headings = self._get_headings(callsigns, positions)
+
+        # Horizontal distances between every pair of pilots
+        deltas = positions[:, None, :Z] - positions[None, :, :Z]
+        distances = numpy.sqrt((deltas ** 2).sum(axis=2))
+
+        enemies = armies[:, None] != armies[None, :]
+        nearest = numpy.where(enemies, distances, numpy.inf).min(axis=1)
+        # Distances to enemies who can not be seen are not told
+        nearest[nearest > self.visibility_range] = numpy.inf
+
+        # Pilot is visible for army if he belongs to it or if at least one
+        # pilot of army is close enough
+        codes = numpy.unique(armies)
+        members = codes[:, None] == armies[None, :]
+        visible = members | (numpy.dot(
+            members.astype(int),
+            (distances <= self.visibility_range).astype(int)) > 0)
+
+        sectors = numpy.floor(positions[:, :Z] / self.sector_size).astype(int)
+        cells, cells_counts = numpy.unique(
+            numpy.column_stack((armies, sectors)), axis=0, return_counts=True)
+
+        self.callsigns, self.positions, self.headings = (callsigns, positions,
+                                                         headings, )
+
+        result['pilots'] = [
+            [callsign, army, int(round(x)), int(round(y)), int(round(z)),
+             _to_int(heading), _to_int(distance), ]
+            for callsign, army, (x, y, z), heading, distance in zip(
+                callsigns, armies.tolist(), positions.tolist(),
+                headings.tolist(), nearest.tolist())
+        ]
+        for i, code in enumerate(codes.tolist()):
+            result['armies'][str(code)] = {
+                'visible': numpy.flatnonzero(visible[i]).tolist(),
+                'sectors': [
+                    [column, row, cell_count]
+                    for (army, column, row), cell_count
+                    in zip(cells.tolist(), cells_counts.tolist())
+                    if army == code
+                ],
+            }
+        self.last_refresh_seconds = time.time() - started_at
+        return result
+
+    def _get_headings(self, callsigns, positions):
+        """
+        Get headings of pilots in degrees clockwise from the north. Pilots
+        who were not on radar before or who have not moved keep previous
+        headings, unknown headings are 'NaN'.
+        """
+        if not self.callsigns:
+            return numpy.full(len(callsigns), numpy.nan)
+
+        index = {callsign: i for i, callsign in enumerate(self.callsigns)}
+        previous = numpy.fromiter(
+            (index.get(callsign, -1) for callsign in callsigns),
+            dtype=int, count=len(callsigns))
+        known = previous >= 0
+        previous = numpy.where(known, previous, 0)
+
+        deltas = positions[:, :Z] - self.positions[previous, :Z]
+        moved = known & (numpy.hypot(deltas[:, X], deltas[:, Y]) >=
+                         self.min_move)
+        headings = numpy.degrees(
+            numpy.arctan2(deltas[:, X], deltas[:, Y])) % 360
+        return numpy.where(
+            moved, headings,
+            numpy.where(known, self.headings[previous], numpy.nan))
+
+    def clear(self):
+        """
+        Forget pilots, so their headings are unknown until they move again.
+        """
+        # State of the previous refresh: callsigns, coordinates and headings
+        # of pilots in the same order
+        self.callsigns = []
+        self.positions = numpy.zeros((0, 3))
+        self.headings = numpy.zeros(0)
+
+
+def _to_int(value):
+    if numpy.isfinite(value):
+        return int(round(value))
+    return None
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index of positions of pilots and objects on map.
+"""
+import math
+
+
+class GridIndex(object):
+    """
+    Uniform grid over map which answers questions like "who is within 5 km
+    of this point" without scanning all items. Every item is kept in a
+    bucket of the square cell which contains it, so queries look only at
+    cells which intersect the area of interest.
+
+    Index is updated incrementally: item is moved to another bucket only
+    when it crosses the border of its cell. Only horizontal coordinates are
+    indexed.
+    """
+
+    def __init__(self, cell_size):
+        """
+        Input:
+        `cell_size`     # float number of meters in side of cell. Queries
+                        # are the fastest if it is close to typical radius
+                        # of queries
+        """
+        self.cell_size = float(cell_size)
+        # Buckets with keys of items keyed by tuples with column and row of
+        # cell
+        self.cells = {}
+        # Tuples with x, y, column and row of items keyed by items' keys
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def _get_cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)), )
+
+    def update(self, key, x, y):
+        """
+        Add item to index or move it to a new position.
+        """
+        cell = self._get_cell(x, y)
+        item = self.items.get(key)
+        if item is not None:
+            old_cell = item[2:]
+            if old_cell == cell:
+                self.items[key] = (x, y, ) + cell
+                return
+            self._discard(key, old_cell)
+        self.items[key] = (x, y, ) + cell
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            bucket = self.cells[cell] = set()
+        bucket.add(key)
+
+    def remove(self, key):
+        """
+        Remove item from index if it is there.
+        """
+        item = self.items.pop(key, None)
+        if item is not None:
+            self._discard(key, item[2:])
+
+    def _discard(self, key, cell):
+        bucket = self.cells[cell]
+        bucket.discard(key)
+        if not bucket:
+            # Do not let empty buckets pile up after items move away
+            del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.items.clear()
+
+    def get_position(self, key):
+        """
+        Get a tuple with x and y coordinates of item or 'None' if item is not
+        indexed.
+        """
+        item = self.items.get(key)
+        return item[:2] if item is not None else None
+
+    def _iter_candidates(self, min_x, min_y, max_x, max_y):
+        """
+        Iterate over keys of items which are in cells intersecting given
+        rectangle. Empty cells are skipped by iterating over buckets if
+        rectangle covers more cells than there are buckets.
+        """
+        min_column, min_row = self._get_cell(min_x, min_y)
+        max_column, max_row = self._get_cell(max_x, max_y)
+        cells_count = (max_column - min_column + 1) * (max_row - min_row + 1)
+
+        if cells_count > len(self.cells):
+            for (column, row), bucket in self.cells.iteritems():
+                if min_column <= column <= max_column and \
+                   min_row <= row <= max_row:
+                    for key in bucket:
+                        yield key
+        else:
+            get_bucket = self.cells.get
+            for column in xrange(min_column, max_column + 1):
+                for row in xrange(min_row, max_row + 1):
+                    bucket = get_bucket((column, row))
+                    if bucket:
+                        for key in bucket:
+                            yield key
+
+    def query_rect(self, min_x, min_y, max_x, max_y):
+        """
+        Get a list of keys of items inside rectangle (borders included).
+        """
+        items = self.items
+        result = []
+        for key in self._iter_candidates(min_x, min_y, max_x, max_y):
+            x, y = items[key][:2]
+            if min_x <= x <= max_x and min_y <= y <= max_y:
+                result.append(key)
+        return result
+
+    def query_radius(self, x, y, radius):
+        """
+        Get a list of tuples with key of item and distance to it in meters
+        for every item which is within given radius from point. List is
+        sorted by distance.
+        """
+        items = self.items
+        radius_squared = radius * radius
+        result = []
+        for key in self._iter_candidates(x - radius, y - radius,
+                                         x + radius, y + radius):
+            item = items[key]
+            dx, dy = item[0] - x, item[1] - y
+            distance_squared = dx * dx + dy * dy
+            if distance_squared <= radius_squared:
+                result.append((key, math.sqrt(distance_squared)))
+        result.sort(key=lambda (dummy_key, distance): distance)
+        return result
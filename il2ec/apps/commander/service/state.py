@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Compact records of online pilots' state with tracking of changes.
+"""
+from array import array
+
+
+# Fields of pilot's state. Each field has its own bit in masks of changes
+FIELDS = ('ping', 'score', 'army', 'aircraft', 'weapons', 'position', )
+
+PING, SCORE, ARMY, AIRCRAFT, WEAPONS, POSITION = [
+    1 << i for i in xrange(len(FIELDS))]
+ALL = (1 << len(FIELDS)) - 1
+
+# Weapons counters in order of their storage. Each item is a pair of keys of
+# a dictionary with weapons statistics returned by console parser
+WEAPONS_COUNTERS = (
+    ('bullets', 'fire'),
+    ('bullets', 'hit'),
+    ('bullets', 'hit_air'),
+    ('rockets', 'fire'),
+    ('rockets', 'hit'),
+    ('bombs', 'fire'),
+    ('bombs', 'hit'),
+)
+
+POSITION_AXES = ('x', 'y', 'z', )
+
+
+class PilotState(object):
+    """
+    Fixed-schema state of a confirmed pilot. Numeric values are stored in
+    typed arrays instead of dictionaries.
+
+    Every update marks changed fields as dirty. Dirty fields are stamped with
+    a version number on commit, so it is possible to get only fields which
+    were changed since any known version.
+    """
+    __slots__ = ('ping', 'score', 'army', 'aircraft', 'weapons', 'position',
+                 'has_position', 'dirty', 'versions', )
+
+    def __init__(self):
+        self.ping = 0
+        self.score = 0
+        self.army = 0
+        # A tuple with aircraft's code and designation or 'None' if pilot is
+        # not in aircraft
+        self.aircraft = None
+        self.weapons = array('l', [0] * len(WEAPONS_COUNTERS))
+        self.position = array('d', [0.0] * len(POSITION_AXES))
+        self.has_position = False
+        # New state has to be fully read by consumers
+        self.dirty = ALL
+        # Version of last change of every field
+        self.versions = array('l', [0] * len(FIELDS))
+
+    def update_info(self, ping, score, army, aircraft):
+        """
+        Input:
+        `ping`          # integer value of ping
+        `score`         # integer value of score
+        `army`          # integer code of army
+        `aircraft`      # a dictionary with aircraft's code and designation
+                        # or 'None' if pilot is not in aircraft
+        """
+        if self.ping != ping:
+            self.ping = ping
+            self.dirty |= PING
+        if self.score != score:
+            self.score = score
+            self.dirty |= SCORE
+        if self.army != army:
+            self.army = army
+            self.dirty |= ARMY
+        if aircraft is not None:
+            aircraft = (aircraft['code'], aircraft['designation'])
+        if self.aircraft != aircraft:
+            self.aircraft = aircraft
+            self.dirty |= AIRCRAFT
+
+    def update_weapons(self, weapons):
+        """
+        Input:
+        `weapons`       # a dictionary with weapons statistics returned by
+                        # console parser
+        """
+        weapons = array('l', [
+            weapons.get(weapon, {}).get(attr, 0)
+            for weapon, attr in WEAPONS_COUNTERS])
+        if self.weapons != weapons:
+            self.weapons[:] = weapons
+            self.dirty |= WEAPONS
+
+    def update_position(self, pos):
+        """
+        Input:
+        `pos`           # a dictionary with coordinates returned by DeviceLink
+                        # parser or 'None' if position is unknown
+        """
+        if pos is None:
+            if self.has_position:
+                self.has_position = False
+                self.dirty |= POSITION
+            return
+        position = array('d', [pos[axis] for axis in POSITION_AXES])
+        if not self.has_position or self.position != position:
+            self.position[:] = position
+            self.has_position = True
+            self.dirty |= POSITION
+
+    def commit(self, version):
+        """
+        Stamp dirty fields with given version and clear dirty mask.
+
+        Output:
+        Mask of committed fields.
+        """
+        dirty, self.dirty = self.dirty, 0
+        if dirty:
+            for i in xrange(len(FIELDS)):
+                if dirty & (1 << i):
+                    self.versions[i] = version
+        return dirty
+
+    def changed_since(self, version):
+        """
+        Get mask of fields which were committed after given version.
+        """
+        mask = 0
+        for i, field_version in enumerate(self.versions):
+            if field_version > version:
+                mask |= 1 << i
+        return mask
+
+    def to_dict(self, mask=ALL):
+        """
+        Get a dictionary with values of fields selected by mask.
+        """
+        result = {}
+        if mask & PING:
+            result['ping'] = self.ping
+        if mask & SCORE:
+            result['score'] = self.score
+        if mask & ARMY:
+            result['army'] = self.army
+        if mask & AIRCRAFT:
+            result['aircraft'] = {
+                'code': self.aircraft[0],
+                'designation': self.aircraft[1],
+            } if self.aircraft else None
+        if mask & WEAPONS:
+            weapons = {}
+            for (weapon, attr), value in zip(WEAPONS_COUNTERS, self.weapons):
+                weapons.setdefault(weapon, {})[attr] = value
+            result['weapons'] = weapons
+        if mask & POSITION:
+            result['position'] = dict(
+                zip(POSITION_AXES, self.position)
+            ) if self.has_position else None
+        return result
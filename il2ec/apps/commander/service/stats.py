@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregation of pilots' and missions' statistics from stored events.
+"""
+import simplejson as json
+import time
+import tx_logging
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from il2ds_log_parser.event_types import (EVT_MISSION_PLAYING,
+    EVT_MISSION_END, EVT_DISCONNECTED, EVT_WENT_TO_MENU, EVT_SELECTED_ARMY,
+    EVT_TOOK_OFF, EVT_LANDED, EVT_CRASHED, EVT_BAILED_OUT, EVT_CAPTURED,
+    EVT_KILLED, EVT_KILLED_BY_USER, EVT_SHOT_DOWN_SELF,
+    EVT_SHOT_DOWN_BY_STATIC, EVT_SHOT_DOWN_BY_USER, )
+
+from commander import settings
+from commander.models import Event, StatsCounters, MissionStats, StatsState
+
+
+LOG = tx_logging.getLogger(__name__)
+
+# Indexes of counters in lists of aggregator
+KILLS, DEATHS, SORTIES, FLIGHT_TIME = [
+    StatsCounters.COUNTERS.index(name) for name in
+    ('kills', 'deaths', 'sorties', 'flight_time', )
+]
+
+# Types of events which end pilot's flight
+FLIGHT_END_EVENTS = (
+    EVT_LANDED, EVT_CRASHED, EVT_CAPTURED, EVT_SHOT_DOWN_SELF,
+    EVT_SHOT_DOWN_BY_STATIC, EVT_WENT_TO_MENU, EVT_DISCONNECTED,
+)
+
+
+def _new_counters():
+    return [0, ] * len(StatsCounters.COUNTERS)
+
+
+def load_flights(data):
+    flights = {}
+    for callsign, (took_off, user_id, mission_id, army) in \
+            json.loads(data or '{}').iteritems():
+        flights[callsign] = (parse_datetime(took_off), user_id, mission_id,
+                             army, )
+    return flights
+
+
+def dump_flights(flights):
+    return json.dumps({
+        callsign: (took_off.isoformat(), user_id, mission_id, army, )
+        for callsign, (took_off, user_id, mission_id, army)
+        in flights.iteritems()
+    })
+
+
+def reset_stats():
+    """
+    Delete statistics of missions. They are counted again from all stored
+    events when aggregator is loaded next time.
+    """
+    with transaction.atomic():
+        MissionStats.objects.all().delete()
+        StatsState.objects.all().delete()
+        StatsState.objects.create(pk=1)
+
+
+def add_counters(model, changes, get_lookup):
+    """
+    Add changes of counters to existing rows of model and create missing
+    rows with a single query.
+
+    Input:
+    `model`         # subclass of 'StatsCounters'
+    `changes`       # a dictionary which maps keys to lists of changes of
+                    # counters
+    `get_lookup`    # a function which converts key to a dictionary with
+                    # values of fields which identify a row
+    """
+    missing = []
+    for key, counters in changes.iteritems():
+        lookup = get_lookup(key)
+        values = dict(zip(StatsCounters.COUNTERS, counters))
+        updates = {
+            name: F(name) + value for name, value in values.iteritems()
+            if value
+        }
+        if updates and not model.objects.filter(**lookup).update(**updates):
+            values.update(lookup)
+            missing.append(model(**values))
+    if missing:
+        model.objects.bulk_create(missing)
+
+
+class StatsAggregator(object):
+    """
+    Keeps counters of kills, deaths, sorties and flight time of every army
+    in every mission. Counters are updated by events which were written to
+    database, every event is processed in constant time. Statistics of
+    pilots are counted by periods of time including all time by
+    'RollupAggregator' (see 'commander.rollups').
+
+    Only changes of counters are kept in memory. They are added to database
+    periodically in one transaction, so pages read precomputed statistics
+    instead of aggregating raw events. ID of the last added event is saved
+    in the same transaction (see 'StatsState') with pilots who are in the
+    air and armies of pilots, so events which were stored but were not
+    counted before commander was stopped are counted when aggregator is
+    loaded and counting continues correctly in the middle of mission.
+
+    Aggregator is not thread-safe, all its methods must be called from the
+    same thread.
+    """
+
+    def __init__(self, flush_interval):
+        """
+        Input:
+        `flush_interval`    # float number of seconds between writings of
+                            # counters to database
+        """
+        self.flush_interval = flush_interval
+        self.flushed_at = time.time()
+        # Changes of counters keyed by tuples with mission's ID and army
+        self.missions = {}
+        # Armies of pilots in current mission keyed by callsigns
+        self.armies = {}
+        # Tuples with time of take-off, user's ID, mission's ID and army of
+        # pilots who are in the air keyed by callsigns
+        self.flights = {}
+        # ID of the last added event and ID of the last event which was
+        # counted in database
+        self.last_event_id = None
+        self.flushed_event_id = None
+        self.handlers = {
+            EVT_MISSION_PLAYING: self._on_mission_playing,
+            EVT_MISSION_END: self._on_mission_end,
+            EVT_SELECTED_ARMY: self._on_selected_army,
+            EVT_TOOK_OFF: self._on_took_off,
+            EVT_BAILED_OUT: self._on_crew_member_lost,
+            EVT_KILLED: self._on_crew_member_lost,
+            EVT_KILLED_BY_USER: self._on_crew_member_lost,
+            EVT_SHOT_DOWN_BY_USER: self._on_shot_down_by_user,
+        }
+        for evt_type in FLIGHT_END_EVENTS:
+            self.handlers[evt_type] = self._on_flight_end
+
+    def load(self, chunk_size=None):
+        """
+        Load state of aggregation and count events which were stored after
+        the last flush. Changes which were not written are forgotten, so
+        loading can be repeated if database fails.
+        """
+        chunk_size = chunk_size or settings.COMMANDER_STATS['chunk_size']
+        self.missions = {}
+
+        try:
+            state = StatsState.objects.get(pk=1)
+        except StatsState.DoesNotExist:
+            # Statistics were counted without state before, so all stored
+            # events are considered to be counted
+            last_ids = Event.objects.order_by('-pk').values_list(
+                'pk', flat=True)[:1]
+            state = StatsState.objects.create(
+                pk=1, last_event_id=last_ids[0] if last_ids else 0)
+        self.flights = load_flights(state.flights)
+        self.armies = json.loads(state.armies or '{}')
+        self.last_event_id = self.flushed_event_id = state.last_event_id
+
+        while True:
+            events = list(Event.objects.filter(
+                pk__gt=self.last_event_id).order_by('pk')[:chunk_size])
+            for event in events:
+                self.add(event, json.loads(event.data) if event.data else {})
+            if events:
+                self.last_event_id = events[-1].pk
+                self.flush()
+            if len(events) < chunk_size:
+                break
+        if self.flushed_event_id != state.last_event_id:
+            LOG.info("Counted events up to {0} which were stored before"
+                     .format(self.flushed_event_id))
+
+    def add(self, event, data):
+        """
+        Update counters by event.
+
+        Input:
+        `event`     # 'Event' instance
+        `data`      # a dictionary with values of event which are not
+                    # stored in separate fields of 'Event'
+        """
+        handler = self.handlers.get(event.type)
+        if handler is not None:
+            handler(event, data)
+
+    def _count(self, index, value, dummy_time, dummy_user_id, mission_id,
+               army):
+        """
+        Add value to counter of pilot's army in mission. Counters are
+        identified by index in list of counters. Time of event and pilot are
+        not needed here, but they are passed to let subclasses count
+        pilots' statistics by periods of time.
+        """
+        if mission_id is not None and army:
+            key = (mission_id, army)
+            counters = self.missions.get(key)
+            if counters is None:
+                counters = self.missions[key] = _new_counters()
+            counters[index] += value
+
+    def _on_mission_playing(self, event, dummy_data):
+        self._end_flights(event.time)
+        self.armies.clear()
+
+    def _on_mission_end(self, event, dummy_data):
+        self._end_flights(event.time)
+        self.armies.clear()
+        # Make statistics of ended mission available as soon as possible
+        self.flushed_at = 0
+
+    def _on_selected_army(self, event, data):
+        self.armies[event.callsign] = data.get('army')
+
+    def _on_took_off(self, event, dummy_data):
+        army = self.armies.get(event.callsign)
+        self._count(SORTIES, 1, event.time, event.user_id, event.mission_id,
+                    army)
+        self.flights[event.callsign] = (event.time, event.user_id,
+                                        event.mission_id, army, )
+
+    def _on_flight_end(self, event, dummy_data):
+        self._end_flight(event.callsign, event.time)
+
+    def _on_crew_member_lost(self, event, data):
+        if data.get('seat') != 0:
+            # Other crew members do not end the flight
+            return
+        if event.type != EVT_BAILED_OUT:
+            self._count(DEATHS, 1, event.time, event.user_id,
+                        event.mission_id, self.armies.get(event.callsign))
+        self._end_flight(event.callsign, event.time)
+
+    def _on_shot_down_by_user(self, event, dummy_data):
+        self._count(KILLS, 1, event.time, event.attacker_id, event.mission_id,
+                    self.armies.get(event.attacker_callsign))
+        self._end_flight(event.callsign, event.time)
+
+    def _end_flight(self, callsign, landed):
+        flight = self.flights.pop(callsign, None)
+        if flight is None:
+            return
+        took_off, user_id, mission_id, army = flight
+        seconds = int((landed - took_off).total_seconds())
+        if seconds > 0:
+            self._count(FLIGHT_TIME, seconds, landed, user_id, mission_id,
+                        army)
+
+    def _end_flights(self, landed):
+        for callsign in self.flights.keys():
+            self._end_flight(callsign, landed)
+
+    def maybe_flush(self):
+        """
+        Write changes of counters to database if it is time to do it.
+        """
+        if time.time() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Add changes of counters to database. Changes are kept if database
+        is not available, so they will be written next time.
+        """
+        self.flushed_at = time.time()
+        last_event_id = self.last_event_id
+        if last_event_id == self.flushed_event_id:
+            return
+        missions, self.missions = self.missions, {}
+
+        try:
+            with transaction.atomic():
+                add_counters(MissionStats, missions,
+                             lambda (mission_id, army): {
+                                 'mission_id': mission_id,
+                                 'army': army,
+                             })
+                StatsState.objects.filter(pk=1).update(
+                    last_event_id=last_event_id,
+                    flights=dump_flights(self.flights),
+                    armies=json.dumps(self.armies),
+                    updated=timezone.now())
+            self.flushed_event_id = last_event_id
+        except Exception as e:
+            LOG.error("Failed to write statistics: {err}".format(
+                      err=unicode(e)))
+            self._restore(self.missions, missions)
+            connection.close()
+
+    @staticmethod
+    def _restore(current, failed):
+        """
+        Put changes which were not written back to current changes.
+        """
+        for key, counters in failed.iteritems():
+            existing = current.get(key)
+            if existing is None:
+                current[key] = counters
+            else:
+                for i, value in enumerate(counters):
+                    existing[i] += value
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for periodic collecting of information from game server.
+"""
+import tx_logging
+
+from twisted.internet import defer
+
+
+LOG = tx_logging.getLogger(__name__)
+
+
+class AdaptiveLoop(object):
+    """
+    Repeatedly calls a function which may return a deferred. Next call is
+    scheduled only after the previous one is finished, so requests to server
+    never pile up. Interval between calls grows with number of tracked items
+    and with time which server takes to respond, but stays within given
+    bounds.
+    """
+
+    def __init__(self, func, interval, interval_per_item=0, latency_factor=1,
+                 count_items=None, name=None):
+        """
+        Input:
+        `func`                  # callable to call on every cycle
+        `interval`              # a tuple with min and max float number of
+                                # seconds between starts of cycles
+        `interval_per_item`     # float number of seconds to add to interval
+                                # for every tracked item
+        `latency_factor`        # min ratio of interval to duration of cycle
+        `count_items`           # callable which returns number of tracked
+                                # items
+        `name`                  # name of loop for logging
+        """
+        self.func = func
+        self.min_interval, self.max_interval = interval
+        self.interval_per_item = interval_per_item
+        self.latency_factor = latency_factor
+        self.count_items = count_items
+        self.name = name or getattr(func, '__name__', repr(func))
+
+        self.running = False
+        # Number of seconds which the last cycle took
+        self.latency = None
+        # Max number of seconds which a cycle took
+        self.max_latency = 0
+        # Number of finished cycles
+        self.cycles = 0
+        # Number of seconds between starts of the last and the next cycles
+        self.interval = self.min_interval
+
+        # Tells whether cycle is in progress
+        self.busy = False
+        self._call = None
+
+        from twisted.internet import reactor
+        self.clock = reactor
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if not self.busy:
+            self._run()
+
+    def stop(self):
+        self.running = False
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+    def _run(self):
+        self._call = None
+        self.busy = True
+        started = self.clock.seconds()
+        d = defer.maybeDeferred(self.func)
+        d.addErrback(self._on_error)
+        d.addCallback(self._on_done, started)
+
+    def _on_error(self, failure):
+        LOG.error("Cycle of '{name}' has failed: {err}".format(
+                  name=self.name, err=unicode(failure.value)))
+
+    def _on_done(self, dummy_result, started):
+        self.busy = False
+        self.latency = self.clock.seconds() - started
+        self.max_latency = max(self.max_latency, self.latency)
+        self.cycles += 1
+        self.interval = self.get_interval()
+        LOG.debug("Cycle of '{name}' took {latency:.3f} s, next one in "
+                  "{interval:.3f} s".format(name=self.name,
+                                            latency=self.latency,
+                                            interval=self.interval))
+        if self.running:
+            self._call = self.clock.callLater(
+                max(0, self.interval - self.latency), self._run)
+
+    def get_interval(self):
+        """
+        Calculate number of seconds between starts of cycles.
+        """
+        count = self.count_items() if self.count_items else 0
+        interval = max(self.min_interval + count * self.interval_per_item,
+                       (self.latency or 0) * self.latency_factor)
+        return min(interval, self.max_interval)
+
+    def get_stats(self):
+        """
+        Get a dictionary with state of loop, current interval, latency of
+        the last cycle, max latency and number of finished cycles.
+        """
+        return {
+            'running': self.running,
+            'busy': self.busy,
+            'interval': self.interval,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+            'cycles': self.cycles,
+        }
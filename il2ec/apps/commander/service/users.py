@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Commander's service for accessing users' database.
+"""
+import time
+import tx_logging
+
+from collections import OrderedDict
+
+from django.db import close_old_connections
+
+from twisted.application.service import Service
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from commander import settings
+from commander.service.channels import ChannelListener
+from commander.sharing import CHANNEL_USER_CHANGED
+
+from auth_custom.models import User
+
+
+LOG = tx_logging.getLogger(__name__)
+
+
+class UsersCache(object):
+    """
+    Bounded in-memory cache of user instances keyed by callsign. Least
+    recently used entries are evicted when cache is full, every entry expires
+    after a certain period of time.
+
+    Cache stays disabled until it is known that invalidation messages can be
+    received, so no outdated users will be returned.
+    """
+
+    def __init__(self, size, ttl):
+        """
+        Input:
+        `size`  # max number of users to keep
+        `ttl`   # number of seconds to keep each user
+        """
+        self.size = size
+        self.ttl = ttl
+        self.enabled = False
+        # Number of invalidations done. Used to detect users which were read
+        # from database before invalidation and are put to cache after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, callsign):
+        """
+        Get cached user or 'None' if user is not cached or has expired.
+        """
+        entry = self._entries.pop(callsign, None)
+        if entry is not None:
+            user, expires = entry
+            if expires > time.time():
+                # Move entry to the end as the most recently used one
+                self._entries[callsign] = entry
+                self.hits += 1
+                return user
+        self.misses += 1
+        return None
+
+    def put(self, user, generation):
+        """
+        Put user to cache if it was read from database after the last
+        invalidation.
+        """
+        if not self.enabled or generation != self.generation:
+            return
+        self._entries.pop(user.callsign, None)
+        self._entries[user.callsign] = (user, time.time() + self.ttl)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, callsign):
+        self.generation += 1
+        self._entries.pop(callsign, None)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """
+        Get ratio of cache hits to all cache requests.
+        """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+class UsersService(Service):
+    """
+    Service which provides non-blocking access to users' database. Every
+    query is executed by a bounded pool of threads, so the reactor is never
+    blocked by database round trips. All public methods return deferreds.
+    """
+
+    pool = None
+
+    def __init__(self, min_threads=None, max_threads=None,
+                 max_password_checks=None):
+        self.min_threads = min_threads or \
+                           settings.COMMANDER_DB_POOL['min_threads']
+        self.max_threads = max_threads or \
+                           settings.COMMANDER_DB_POOL['max_threads']
+        # Limit number of simultaneous password checks, so they will not take
+        # all of the threads from other database queries
+        self.password_checks = defer.DeferredSemaphore(
+            max_password_checks or
+            settings.COMMANDER_DB_POOL['max_password_checks'])
+        self.cache = UsersCache(size=settings.COMMANDER_USERS_CACHE['size'],
+                                ttl=settings.COMMANDER_USERS_CACHE['ttl'])
+        # Cache is disabled while there is no subscription to changes of
+        # users, because invalidation messages may be lost
+        self.listener = ChannelListener(CHANNEL_USER_CHANGED,
+                                        on_message=self.cache.invalidate,
+                                        on_subscribed=self.cache.enable,
+                                        on_lost=self.cache.disable,
+                                        name="commander-users-cache")
+
+    def startService(self):
+        # Pool is recreated on every start, because stopped pool can not be
+        # started again
+        self.pool = ThreadPool(minthreads=self.min_threads,
+                               maxthreads=self.max_threads,
+                               name="commander-db")
+        self.pool.start()
+        Service.startService(self)
+        self.listener.start()
+
+    def stopService(self):
+        Service.stopService(self)
+        self.listener.stop()
+        self.cache.disable()
+        LOG.debug("Users cache hit rate: {0:.2%} ({1} hits, {2} misses)"
+                  .format(self.cache.hit_rate, self.cache.hits,
+                          self.cache.misses))
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def get_stats(self):
+        """
+        Get a dictionary with number of cached users, numbers of cache hits
+        and misses, hit rate and state of cache.
+        """
+        return {
+            'cached': len(self.cache),
+            'hits': self.cache.hits,
+            'misses': self.cache.misses,
+            'hit_rate': self.cache.hit_rate,
+            'enabled': self.cache.enabled,
+        }
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run blocking callable in the pool of threads.
+
+        Output:
+        Deferred which fires with a result of callable.
+        """
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.pool, self._call, func,
+                                         *args, **kwargs)
+
+    @staticmethod
+    def _call(func, *args, **kwargs):
+        """
+        Call function in pool's thread. Threads live long, so their
+        connections to database are closed if they are broken or too old,
+        like Django does between requests.
+        """
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    def get_by_callsign(self, callsign):
+        """
+        Get user instance by callsign from cache or from database. Cached
+        users who can not connect are read from database again, because they
+        may have requested connection after they were cached.
+
+        Output:
+        Deferred which fires with 'User' instance or with 'None' if user is
+        not registered.
+        """
+        user = self.cache.get(callsign)
+        if user is not None and user.can_connect():
+            return defer.succeed(user)
+        return self.run(self._get_by_callsign, callsign).addCallback(
+            self._on_user_loaded, self.cache.generation)
+
+    @staticmethod
+    def _get_by_callsign(callsign):
+        try:
+            return User.objects.get(callsign=callsign)
+        except User.DoesNotExist:
+            return None
+
+    def _on_user_loaded(self, user, generation):
+        if user is not None:
+            self.cache.put(user, generation)
+        return user
+
+    def check_connection_password(self, user, password):
+        """
+        Check user's connection password and clear it if it matches, so it
+        can not be used again. Password is always checked against the one
+        stored in database, never against the cached one.
+
+        Output:
+        Deferred which fires with 'True' if password was accepted or with
+        'False' otherwise.
+        """
+        return self.password_checks.run(
+            self.run, self._check_connection_password, user.pk, password
+        ).addCallback(self._on_password_checked, user.callsign)
+
+    @staticmethod
+    def _check_connection_password(user_id, password):
+        try:
+            user = User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            return False
+        if not user.check_connection_password(password):
+            return False
+        user.clear_connection_password(update=True)
+        return True
+
+    def _on_password_checked(self, accepted, callsign):
+        if accepted:
+            # Cached connection password is not valid anymore
+            self.cache.invalidate(callsign)
+        return accepted
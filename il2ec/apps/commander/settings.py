@@ -40,6 +40,21 @@ IL2_CONFIG_PATH = getattr(settings, 'IL2_CONFIG_PATH',
 IL2_EVENTS_LOG_PATH = getattr(settings, 'IL2_EVENTS_LOG_PATH',
                               os.path.join('il2ds', 'log', 'events.log'))
 
+# Settings of reading of server's events log
+IL2_EVENTS_LOG_DEFAULTS = {
+    # Path to file where position of the last read event is saved
+    'checkpoint_path': IL2_EVENTS_LOG_PATH + '.checkpoint',
+    # Max number of bytes to read and parse at once. Reactor does nothing
+    # else while a chunk is parsed
+    'chunk_size': 1024 * 64, # 64 KiB
+    # Number of seconds between checks of log if inotify is not available
+    'poll_interval': 1,
+    # Min number of seconds between savings of checkpoint
+    'checkpoint_interval': 5,
+}
+IL2_EVENTS_LOG_USER = getattr(settings, 'IL2_EVENTS_LOG', {})
+IL2_EVENTS_LOG = dict(IL2_EVENTS_LOG_DEFAULTS, **IL2_EVENTS_LOG_USER)
+
 #------------------------------------------------------------------------------
 # Commander settings
 #------------------------------------------------------------------------------
@@ -48,9 +63,38 @@ IL2_EVENTS_LOG_PATH = getattr(settings, 'IL2_EVENTS_LOG_PATH',
 COMMANDER_API_DEFAULTS = {
     'host': '127.0.0.1',
     'port': 20001,
+    # Settings of pool of connections used by every website's process
+    'client': {
+        # Max number of connections
+        'pool_size': 4,
+        # Number of seconds to wait for a free connection and for reply
+        'timeout': 3,
+        # Min and max number of seconds to wait before connecting again
+        # after failure
+        'retry_delay': (0.5, 30),
+        # Codec of length-prefixed frames ('json' or 'msgpack') or 'None' to
+        # use JSON lines
+        'codec': None,
+    },
 }
 COMMANDER_API_USER = getattr(settings, 'COMMANDER_API', {})
 COMMANDER_API = dict(COMMANDER_API_DEFAULTS, **COMMANDER_API_USER)
+# Settings of pool may be given partially
+COMMANDER_API['client'] = dict(COMMANDER_API_DEFAULTS['client'],
+                               **COMMANDER_API_USER.get('client', {}))
+
+# Settings of HTTP listener which notifies website's pages about updates of
+# server info. Requests are expected to be proxied from website's URL
+COMMANDER_PUSH_DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 20002,
+    # Website's URL which is proxied to the listener
+    'url': '/push/',
+    # Max number of seconds to hold a request while waiting for update
+    'timeout': 30,
+}
+COMMANDER_PUSH_USER = getattr(settings, 'COMMANDER_PUSH', {})
+COMMANDER_PUSH = dict(COMMANDER_PUSH_DEFAULTS, **COMMANDER_PUSH_USER)
 
 # Path to a file, where commander's PID will be stored. Use this file to
 # stop commander by executing 'kill `cat /path/to/pid`'. If this value is set
@@ -83,3 +127,154 @@ COMMANDER_TIMEOUT_DEFAULTS = {
 }
 COMMANDER_TIMEOUT_USER = getattr(settings, 'COMMANDER_TIMEOUT', {})
 COMMANDER_TIMEOUT = dict(COMMANDER_TIMEOUT_DEFAULTS, **COMMANDER_TIMEOUT_USER)
+
+# Settings of queue of commands for game server's console which need no
+# output, e.g. chat messages and kicks
+COMMANDER_CONSOLE_DEFAULTS = {
+    # Max number of console lines written at once
+    'max_batch_size': 50,
+    # Max number of query requests (e.g. users' info and statistics) which
+    # are processed by server at once
+    'max_pipelined': 4,
+    # Rate limits of priority classes of console commands: tuples with
+    # number of console lines per second and max burst size. Classes which
+    # are absent or have 'None' rate (e.g. 'reply') are not limited
+    'rates': {
+        'kick': (10, 20),
+        'query': (10, 10),
+        'chat': (20, 50),
+    },
+}
+COMMANDER_CONSOLE_USER = getattr(settings, 'COMMANDER_CONSOLE', {})
+COMMANDER_CONSOLE = dict(COMMANDER_CONSOLE_DEFAULTS, **COMMANDER_CONSOLE_USER)
+
+# Settings of snapshot of commander's state, which is used to take
+# connected pilots back without kicking them after restart
+COMMANDER_SNAPSHOT_DEFAULTS = {
+    # Number of seconds between savings of snapshot while commander is
+    # running. Snapshot is also saved on stop
+    'interval': 5,
+    # Max age of snapshot in seconds. Older snapshot is ignored and everyone
+    # is kicked after start
+    'max_age': 60,
+}
+COMMANDER_SNAPSHOT_USER = getattr(settings, 'COMMANDER_SNAPSHOT', {})
+COMMANDER_SNAPSHOT = dict(COMMANDER_SNAPSHOT_DEFAULTS,
+                          **COMMANDER_SNAPSHOT_USER)
+
+# Settings of thread pool which runs blocking database queries outside of
+# the reactor's thread
+COMMANDER_DB_POOL_DEFAULTS = {
+    # Number of threads to keep running even if there is nothing to do
+    'min_threads': 1,
+    # Max number of database queries to run simultaneously
+    'max_threads': 5,
+    # Max number of connection passwords to check simultaneously. Hashing of
+    # passwords is CPU-bound, so there is no need to make this value high
+    'max_password_checks': 2,
+}
+COMMANDER_DB_POOL_USER = getattr(settings, 'COMMANDER_DB_POOL', {})
+COMMANDER_DB_POOL = dict(COMMANDER_DB_POOL_DEFAULTS, **COMMANDER_DB_POOL_USER)
+
+# Settings of storing of events from server's events log to database
+COMMANDER_EVENTS_STORE_DEFAULTS = {
+    # Max number of events inserted at once
+    'batch_size': 500,
+    # Max number of seconds to wait for batch to become full
+    'batch_interval': 0.5,
+    # Max number of events waiting for insertion. New events are dropped if
+    # database can not keep up with them
+    'max_queue': 10000,
+    # Max number of times to write batch again if database has failed to
+    # write it (e.g. if connection was lost)
+    'max_retries': 5,
+    # Number of seconds to wait before the first retry. Every next retry
+    # waits longer
+    'retry_delay': 1,
+}
+COMMANDER_EVENTS_STORE_USER = getattr(settings, 'COMMANDER_EVENTS_STORE', {})
+COMMANDER_EVENTS_STORE = dict(COMMANDER_EVENTS_STORE_DEFAULTS,
+                              **COMMANDER_EVENTS_STORE_USER)
+
+# Settings of aggregation of pilots' and missions' statistics
+COMMANDER_STATS_DEFAULTS = {
+    # Number of seconds between writings of statistics to database
+    'flush_interval': 30,
+    # Max number of stored events counted in one transaction when
+    # statistics are loaded
+    'chunk_size': 5000,
+}
+COMMANDER_STATS_USER = getattr(settings, 'COMMANDER_STATS', {})
+COMMANDER_STATS = dict(COMMANDER_STATS_DEFAULTS, **COMMANDER_STATS_USER)
+
+# Settings of rollups of pilots' statistics by days and weeks
+COMMANDER_ROLLUPS_DEFAULTS = {
+    # Max number of events added to rollups in one transaction
+    'chunk_size': 5000,
+    # Number of seconds to keep rendered statistics in cache
+    'cache_timeout': 60 * 10,
+}
+COMMANDER_ROLLUPS_USER = getattr(settings, 'COMMANDER_ROLLUPS', {})
+COMMANDER_ROLLUPS = dict(COMMANDER_ROLLUPS_DEFAULTS, **COMMANDER_ROLLUPS_USER)
+
+# Settings of in-memory cache of users who connect to game server
+COMMANDER_USERS_CACHE_DEFAULTS = {
+    # Max number of users to keep in cache
+    'size': 1000,
+    # Number of seconds to keep each user in cache
+    'ttl': 60 * 10,
+}
+COMMANDER_USERS_CACHE_USER = getattr(settings, 'COMMANDER_USERS_CACHE', {})
+COMMANDER_USERS_CACHE = dict(COMMANDER_USERS_CACHE_DEFAULTS,
+                             **COMMANDER_USERS_CACHE_USER)
+
+# Settings of periodic collecting of information about online pilots.
+# Intervals are float values of seconds between starts of requests. Actual
+# interval grows with number of pilots and with time which server takes to
+# respond, but it stays within given bounds
+COMMANDER_TELEMETRY_DEFAULTS = {
+    # Bounds of interval for requesting pilots' ping, score and weapons
+    'info_interval': (3, 15),
+    # Number of seconds to add to interval of info for every pilot
+    'info_interval_per_pilot': 0.05,
+    # Bounds of interval for requesting pilots' positions. Radar is
+    # refreshed together with positions
+    'positions_interval': (1, 5),
+    # Number of seconds to add to interval of positions for every pilot.
+    # Positions of all pilots are returned by a single request, so interval
+    # grows only if server is slow to respond
+    'positions_interval_per_pilot': 0,
+    # Min ratio of interval to time which server takes to respond
+    'latency_factor': 2,
+}
+COMMANDER_TELEMETRY_USER = getattr(settings, 'COMMANDER_TELEMETRY', {})
+COMMANDER_TELEMETRY = dict(COMMANDER_TELEMETRY_DEFAULTS,
+                           **COMMANDER_TELEMETRY_USER)
+
+# Settings of spatial index of pilots' and objects' positions
+COMMANDER_SPATIAL_INDEX_DEFAULTS = {
+    # Number of meters in side of square cell of index
+    'cell_size': 5000,
+    # Number of meters around pilot which are described by 'near' command
+    'nearby_radius': 10000,
+    # Max number of pilots listed by 'near' command
+    'nearby_limit': 5,
+}
+COMMANDER_SPATIAL_INDEX_USER = getattr(settings, 'COMMANDER_SPATIAL_INDEX',
+                                       {})
+COMMANDER_SPATIAL_INDEX = dict(COMMANDER_SPATIAL_INDEX_DEFAULTS,
+                               **COMMANDER_SPATIAL_INDEX_USER)
+
+# Settings of radar picture built from pilots' positions. Distances are float
+# values of meters
+COMMANDER_RADAR_DEFAULTS = {
+    # Pilots are seen by other armies if they are closer to any of their
+    # pilots
+    'visibility_range': 20000,
+    # Side of square sector of map in which pilots are counted
+    'sector_size': 10000,
+    # Min distance which pilot has to move to change heading
+    'min_move': 1,
+}
+COMMANDER_RADAR_USER = getattr(settings, 'COMMANDER_RADAR', {})
+COMMANDER_RADAR = dict(COMMANDER_RADAR_DEFAULTS, **COMMANDER_RADAR_USER)
@@ -1,19 +1,43 @@
 # -*- coding: utf-8 -*-
 """
-Keys for sharing information about server via Redis.
+Keys and channels for sharing information about server via Redis.
 """
 import redis
+import simplejson as json
 
 from django.conf import settings
 
 
-KEY_SERVER_RUNNING = 'ds_running'
-KEY_SERVER_NAME = 'ds_name'
-KEY_SERVER_LOCAL_ADDRESS = 'ds_local_addr'
-KEY_SERVER_USER_PORT = 'ds_user_port'
-KEY_SERVER_CHANNELS = 'ds_channels'
-KEY_SERVER_DIFFICULTY = 'ds_difficulty'
-KEY_SERVER_UPDATE_TOKEN = 'ds_update_token'
+# Hash with information about running game server
+KEY_SERVER_INFO = 'ds_info'
+# Counter which is incremented on every update of server info
+KEY_SERVER_VERSION = 'ds_version'
+
+# Fields of hash with information about game server
+FIELD_SERVER_NAME = 'name'
+FIELD_SERVER_LOCAL_ADDRESS = 'local_addr'
+FIELD_SERVER_USER_PORT = 'user_port'
+FIELD_SERVER_CHANNELS = 'channels'
+FIELD_SERVER_DIFFICULTY = 'difficulty'
+
+# Set of callsigns of online pilots
+KEY_PILOTS = 'pilots'
+# Prefix of keys of hashes with state of each online pilot
+KEY_PILOT_PREFIX = 'pilot:'
+# Version of online pilots' state
+KEY_PILOTS_VERSION = 'pilots_version'
+
+# JSON with the latest snapshot of radar picture
+KEY_RADAR = 'radar'
+
+# Snapshot of commander's state which is saved before stop and restored
+# after start
+KEY_COMMANDER_SNAPSHOT = 'commander_snapshot'
+
+# Channel for publishing callsigns of users whose data has changed
+CHANNEL_USER_CHANGED = 'user_changed'
+# Channel for publishing new versions of server info
+CHANNEL_SERVER_UPDATED = 'ds_updated'
 
 
 class SharedStorage(redis.StrictRedis):
@@ -24,12 +48,206 @@ class SharedStorage(redis.StrictRedis):
                                             password=settings.REDIS_PASSWORD,
                                             db=settings.REDIS_DBS['COMMANDER'])
 
-    def update(self, kwargs):
-        for key, value in kwargs.iteritems():
-            self.set(key, value)
+    def set_server_info(self, info):
+        """
+        Replace information about game server and increment its version
+        within a single transaction, so readers never see partially written
+        info.
+
+        Output:
+        New version of server info.
+        """
+        version = self.pipeline(transaction=True) \
+                      .delete(KEY_SERVER_INFO) \
+                      .hmset(KEY_SERVER_INFO, info) \
+                      .incr(KEY_SERVER_VERSION) \
+                      .execute()[-1]
+        self.publish(CHANNEL_SERVER_UPDATED, version)
+        return version
+
+    def get_server_info(self):
+        """
+        Read information about game server together with its version.
+
+        Output:
+        A tuple with a dictionary of raw values of server info (empty if
+        server is not running) and integer number of version.
+        """
+        info, version = self.pipeline(transaction=True) \
+                            .hgetall(KEY_SERVER_INFO) \
+                            .get(KEY_SERVER_VERSION) \
+                            .execute()
+        return info, int(version or 0)
+
+    def get_server_version(self):
+        return int(self.get(KEY_SERVER_VERSION) or 0)
 
     def clear(self):
-        self.flushdb()
+        """
+        Remove all shared information and increment version of server info
+        within a single transaction. Version is preserved, so it never goes
+        back.
+
+        Output:
+        New version of server info.
+        """
+        result = {}
+
+        def flush(pipe):
+            version = int(pipe.get(KEY_SERVER_VERSION) or 0) + 1
+            pipe.multi()
+            pipe.flushdb()
+            pipe.set(KEY_SERVER_VERSION, version)
+            result['version'] = version
+
+        self.transaction(flush, KEY_SERVER_VERSION)
+        self.publish(CHANNEL_SERVER_UPDATED, result['version'])
+        return result['version']
+
+    def update_pilots(self, version, changed, removed, full=False):
+        """
+        Write changes of online pilots' state in a single transaction.
+
+        Input:
+        `version`   # number of version of pilots' state
+        `changed`   # a dictionary which maps callsigns to dictionaries with
+                    # changed fields of pilots' state as returned by
+                    # 'PilotsService.get_changes'
+        `removed`   # a sequence of callsigns of removed pilots
+        `full`      # 'True' if `changed` contains the whole state, so all
+                    # other pilots have to be removed
+        """
+        def write(pipe):
+            if full:
+                # Set of pilots is watched, so the transaction is retried if
+                # it was changed after it was read
+                stale = set(pipe.smembers(KEY_PILOTS)).difference(changed)
+            else:
+                stale = removed
+            pipe.multi()
+            for callsign in stale:
+                pipe.srem(KEY_PILOTS, callsign)
+                pipe.delete(KEY_PILOT_PREFIX + callsign)
+            for callsign, fields in changed.iteritems():
+                key = KEY_PILOT_PREFIX + callsign
+                mapping, missing = flatten_pilot_state(fields)
+                mapping['callsign'] = callsign
+                pipe.hmset(key, mapping)
+                if missing:
+                    pipe.hdel(key, *missing)
+                pipe.sadd(KEY_PILOTS, callsign)
+            pipe.set(KEY_PILOTS_VERSION, version)
+
+        if full:
+            self.transaction(write, KEY_PILOTS)
+        else:
+            self.transaction(write)
+
+    def get_pilots(self):
+        """
+        Read state of online pilots.
+
+        Output:
+        A tuple with number of version of pilots' state and a list of
+        dictionaries with state of each pilot sorted by callsign.
+        """
+        version, callsigns = self.pipeline(transaction=True) \
+                                 .get(KEY_PILOTS_VERSION) \
+                                 .smembers(KEY_PILOTS) \
+                                 .execute()
+        callsigns = sorted(callsigns)
+        pipe = self.pipeline(transaction=False)
+        for callsign in callsigns:
+            pipe.hgetall(KEY_PILOT_PREFIX + callsign)
+        pilots = [
+            unflatten_pilot_state(mapping) for mapping in pipe.execute()
+            if mapping
+        ]
+        return int(version or 0), pilots
+
+    def set_radar(self, snapshot):
+        """
+        Replace snapshot of radar picture built by 'RadarEngine'.
+        """
+        self.set(KEY_RADAR, json.dumps(snapshot))
+
+    def get_radar(self):
+        """
+        Read snapshot of radar picture.
+
+        Output:
+        A dictionary with snapshot or 'None' if there is no radar picture.
+        """
+        data = self.get(KEY_RADAR)
+        return json.loads(data) if data else None
+
+    def save_snapshot(self, snapshot, ttl):
+        """
+        Save JSON-serializable snapshot of commander's state, which expires
+        after given number of seconds.
+        """
+        self.setex(KEY_COMMANDER_SNAPSHOT, ttl, json.dumps(snapshot))
+
+    def pop_snapshot(self):
+        """
+        Read and remove snapshot of commander's state in a single
+        transaction.
+
+        Output:
+        Snapshot or 'None' if it is absent or expired.
+        """
+        data = self.pipeline(transaction=True) \
+                   .get(KEY_COMMANDER_SNAPSHOT) \
+                   .delete(KEY_COMMANDER_SNAPSHOT) \
+                   .execute()[0]
+        return json.loads(data) if data else None
+
+
+def flatten_pilot_state(fields):
+    """
+    Convert pilot's state into a flat mapping for a hash.
+
+    Output:
+    A tuple with a dictionary of hash fields to set and a list of hash fields
+    to delete.
+    """
+    mapping, missing = {}, []
+    for name in ('ping', 'score', 'army', ):
+        if name in fields:
+            mapping[name] = fields[name]
+    if 'aircraft' in fields:
+        aircraft = fields['aircraft']
+        if aircraft:
+            mapping['aircraft_code'] = aircraft['code']
+            mapping['aircraft_designation'] = aircraft['designation']
+        else:
+            missing.extend(['aircraft_code', 'aircraft_designation', ])
+    if 'position' in fields:
+        position = fields['position']
+        if position:
+            mapping.update(position)
+        else:
+            missing.extend(['x', 'y', 'z', ])
+    return mapping, missing
+
+
+def unflatten_pilot_state(mapping):
+    """
+    Convert a hash with pilot's state back into a dictionary.
+    """
+    return {
+        'callsign': mapping['callsign'],
+        'ping': int(mapping.get('ping', 0)),
+        'score': int(mapping.get('score', 0)),
+        'army': int(mapping.get('army', 0)),
+        'aircraft': {
+            'code': mapping['aircraft_code'],
+            'designation': mapping['aircraft_designation'],
+        } if 'aircraft_code' in mapping else None,
+        'position': {
+            axis: float(mapping[axis]) for axis in ('x', 'y', 'z', )
+        } if 'x' in mapping else None,
+    }
 
 
 shared_storage = SharedStorage()
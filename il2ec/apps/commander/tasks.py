@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Commander Celery tasks.
+"""
+import logging
+
+from celery.task import task
+
+from commander.rollups import refresh_rollups
+
+
+LOG = logging.getLogger(__name__)
+
+
+@task(ignore_result=True)
+def refresh_pilots_rollups():
+    """
+    Task which is called periodically and adds new events to rollups of
+    pilots' statistics.
+    """
+    version = refresh_rollups()
+    LOG.debug("Rollups of pilots' statistics have version {0}".format(
+              version))
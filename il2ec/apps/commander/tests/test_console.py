@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of queue of commands for game server's console.
+"""
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from commander.service.console import ConsoleCommandQueue
+
+
+class FakeConsoleClient(object):
+    """
+    Keeps requests unanswered until test answers them.
+    """
+    delimiter = '\n'
+
+    def __init__(self):
+        self.requests = []
+
+    def send_request(self, line, timeout=None):
+        d = defer.Deferred()
+        self.requests.append((line, d))
+        return d
+
+    def users_common_info(self):
+        return self.send_request('user')
+
+    def mission_load(self, mission):
+        return self.send_request('mission LOAD {0}'.format(mission))
+
+    def answer(self, index=0, result=None):
+        line, d = self.requests.pop(index)
+        d.callback(result)
+        return line
+
+
+class ConsoleCommandQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeConsoleClient()
+        self.queue = ConsoleCommandQueue(self.client, 10, max_pipelined=3)
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def _sent(self):
+        return [line for line, dummy in self.client.requests]
+
+    def test_queries_are_pipelined(self):
+        results = [self.queue.users_common_info() for dummy in xrange(5)]
+        self.queue.flush()
+        self.assertEqual(self._sent(), ['user', ] * 3)
+
+        self.client.answer(result='first')
+        self.queue.flush()
+        self.assertEqual(self._sent(), ['user', ] * 3)
+        self.assertEqual(self.successResultOf(results[0]), 'first')
+
+    def test_queries_do_not_overtake_control(self):
+        self.queue.users_common_info()
+        self.queue.flush()
+        self.queue.mission_load('net/dogfight/test.mis')
+        self.queue.users_common_info()
+        self.queue.chat_all(u"Hello")
+        self.queue.flush()
+        self.assertEqual(self._sent(), ['user', ])
+
+        self.client.answer()
+        self.queue.flush()
+        self.assertEqual(self._sent(), ['mission LOAD net/dogfight/test.mis'])
+
+        self.client.answer()
+        self.queue.flush()
+        self.assertEqual(self._sent(), ['user', ])
+
+    def test_replies_are_not_throttled(self):
+        self.queue.stop()
+        self.queue = ConsoleCommandQueue(self.client, 10,
+                                         rates={'chat': (1, 1), })
+        self.queue.chat_user(u"first", 'user')
+        self.queue.flush()
+        self.client.answer()
+
+        chat = self.queue.chat_user(u"second", 'user')
+        reply = self.queue.reply_user(u"Password accepted.", 'user')
+        self.queue.flush()
+        self.assertEqual(len(self.client.requests), 1)
+        self.assertIn("Password accepted.", self.client.answer())
+        self.assertNoResult(chat)
+        self.assertIsNone(self.successResultOf(reply))
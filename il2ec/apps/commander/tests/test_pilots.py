@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of commander's pilots service.
+"""
+import time
+
+from django.contrib.auth.hashers import make_password
+
+from twisted.internet import defer, task, threads
+from twisted.trial import unittest
+
+from auth_custom.models import User
+
+from commander.service.objects import ObjectsService
+from commander.service.pilots import PilotsService, ConfirmedPilot
+from commander.service.users import UsersService
+
+
+class FakeConsoleQueue(object):
+    """
+    Records messages and kicks instead of sending them to server.
+    """
+
+    def __init__(self, connected=None):
+        self.messages = []
+        self.kicked = []
+        # Callsigns of users who are connected to server
+        self.connected = connected or []
+
+    def chat_user(self, message, callsign):
+        self.messages.append((callsign, message))
+        return defer.succeed(None)
+
+    def kick_callsign(self, callsign):
+        self.kicked.append(callsign)
+        return defer.succeed(None)
+
+    def users_common_info(self):
+        return defer.succeed(dict(
+            (callsign, {'ping': 0, 'score': 0, 'army_code': 0, })
+            for callsign in self.connected))
+
+
+class FakeCommander(object):
+    """
+    Stands for 'CommanderService' as a parent of pilots service.
+    """
+    cl_client = None
+    dl_client = None
+
+    def __init__(self, cl_queue):
+        self.cl_queue = cl_queue
+
+
+class JoinBurstTestCase(unittest.TestCase):
+    """
+    Many users join at once (e.g. when mission begins) while database is
+    slow to answer.
+    """
+
+    # Number of users who join at once
+    users_count = 60
+    # Number of seconds which every lookup of user takes
+    lookup_delay = 0.2
+
+    def setUp(self):
+        self.queue = FakeConsoleQueue()
+        self.users = UsersService(min_threads=1, max_threads=10)
+        self.patch(self.users, 'run', self._slow_run)
+        self.service = PilotsService(self.users)
+        self.service.parent = FakeCommander(self.queue)
+        # Do not wait before kicking users
+        self.patch(self.service, '_delayed_kick', self.queue.kick_callsign)
+
+        password = make_password('password')
+        self.accounts = {}
+        self.allowed, self.kicked = [], []
+        for i in xrange(self.users_count):
+            callsign = "pilot{0}".format(i)
+            kind = i % 3
+            if kind == 0:
+                # Registered user who has requested connection
+                self.accounts[callsign] = User(callsign=callsign,
+                                               connection_password=password)
+                self.allowed.append(callsign)
+            elif kind == 1:
+                # Registered user who has not requested connection
+                self.accounts[callsign] = User(callsign=callsign,
+                                               connection_password='!')
+                self.kicked.append(callsign)
+            else:
+                # User who is not registered
+                self.kicked.append(callsign)
+
+    def tearDown(self):
+        self.service.stopService()
+
+    def _slow_run(self, dummy_func, callsign):
+        """
+        Stands for lookup of user in database which takes a while and runs
+        in a thread.
+        """
+        def look_up():
+            time.sleep(self.lookup_delay)
+            return self.accounts.get(callsign)
+
+        return threads.deferToThread(look_up)
+
+    @defer.inlineCallbacks
+    def test_join_burst(self):
+        gaps = []
+        beats = [time.time()]
+
+        def beat():
+            now = time.time()
+            gaps.append(now - beats[-1])
+            beats.append(now)
+
+        heartbeat = task.LoopingCall(beat)
+        heartbeat.start(0.01)
+
+        started_at = time.time()
+        lookups = [
+            self.service.user_joined({'callsign': callsign, })
+            for callsign in self.allowed + self.kicked
+        ]
+        joined_in = time.time() - started_at
+        yield defer.DeferredList(lookups)
+        heartbeat.stop()
+
+        # Joins do not wait for database and reactor keeps running while
+        # users are looked up
+        self.assertTrue(joined_in < self.lookup_delay)
+        self.assertTrue(max(gaps) < self.lookup_delay / 2)
+
+        # Every user is either pending or kicked exactly once
+        self.assertEqual(sorted(self.service.pending), sorted(self.allowed))
+        self.assertEqual(sorted(self.queue.kicked), sorted(self.kicked))
+        self.assertEqual(self.service.joining, {})
+        self.assertEqual(self.service.confirmed, {})
+
+        # Pending users are asked for password
+        asked = [callsign for callsign, dummy in self.queue.messages]
+        for callsign in self.allowed:
+            self.assertEqual(asked.count(callsign), 1)
+
+
+class RestoreTestCase(unittest.TestCase):
+    """
+    Commander takes back users who were connected before restart.
+    """
+
+    def setUp(self):
+        self.callsigns = ['pilot0', 'pilot1', ]
+        self.queue = FakeConsoleQueue(self.callsigns)
+        password = make_password('password')
+        self.accounts = dict(
+            (callsign, User(callsign=callsign, connection_password=password))
+            for callsign in self.callsigns)
+
+        self.users = UsersService(min_threads=1, max_threads=1)
+        self.patch(self.users, 'run',
+                   lambda dummy_func, callsign:
+                   defer.succeed(self.accounts.get(callsign)))
+        self.service = PilotsService(self.users)
+        self.service.parent = FakeCommander(self.queue)
+        self.patch(self.service, 'start_collecting', lambda: None)
+        self.patch(self.service, 'commit_changes', lambda: None)
+
+    def tearDown(self):
+        self.service.stopService()
+
+    @defer.inlineCallbacks
+    def test_same_sessions_are_confirmed(self):
+        yield self.service.restore({'confirmed': self.callsigns, },
+                                   reconnected=set(['pilot1', ]))
+        self.assertEqual(self.service.confirmed.keys(), ['pilot0', ])
+        self.assertEqual(self.service.pending.keys(), ['pilot1', ])
+
+    @defer.inlineCallbacks
+    def test_unknown_sessions_are_asked_for_password(self):
+        yield self.service.restore({'confirmed': self.callsigns, },
+                                   reconnected=None)
+        self.assertEqual(self.service.confirmed, {})
+        self.assertEqual(sorted(self.service.pending), self.callsigns)
+
+
+class NearbyTestCase(unittest.TestCase):
+    """
+    Pilot asks about pilots and destroyed objects around him.
+    """
+
+    def setUp(self):
+        self.queue = FakeConsoleQueue()
+        self.objects = ObjectsService()
+        self.service = PilotsService(users=None, objects=self.objects)
+        self.service.parent = FakeCommander(self.queue)
+        self.patch(self.service, 'commit_changes', lambda: None)
+        self.patch(self.service, 'refresh_radar', lambda: None)
+
+        positions = []
+        for callsign, army, x in (
+                ('red0', 1, 0), ('red1', 1, 3000), ('red2', 1, 50000),
+                ('blue0', 2, 1000), ):
+            pilot = ConfirmedPilot(User(callsign=callsign), None)
+            pilot.state.update_info(0, 0, army, None)
+            self.service.confirmed[callsign] = pilot
+            positions.append({
+                'callsign': callsign, 'pos': {'x': x, 'y': 0, 'z': 100, },
+            })
+        self.service._update_positions(positions)
+
+    def tearDown(self):
+        self.service.stopService()
+        self.objects.stopService()
+
+    def test_nearby(self):
+        self.objects.building_destroyed_by_user({
+            'building': '3do/Buildings/House', 'callsign': 'blue0',
+            'pos': {'x': 500.0, 'y': 0.0, },
+        })
+        self.service.user_chat(('red0', '<near', ))
+        callsign, message = self.queue.messages[-1]
+        self.assertEqual(callsign, 'red0')
+        self.assertIn(u"red1 3.0", message)
+        self.assertNotIn(u"red2", message)
+        # Enemies are not told about
+        self.assertNotIn(u"blue0", message)
+        self.assertIn(u"Destroyed objects: 1", message)
+
+    def test_position_is_unknown(self):
+        self.service._update_positions([])
+        self.service.user_chat(('red0', '<near', ))
+        self.assertEqual(self.queue.messages[-1],
+                         ('red0', u"Your position is unknown yet."))
@@ -9,6 +9,10 @@ urlpatterns = patterns('',
         name='website-index'),
     url(r'^contact/$', 'website.views.contact',
         name='website-contact'),
+    url(r'^users/$', 'website.views.leaderboard',
+        name='website-leaderboard'),
+    url(r'^users/(?P<callsign>[^/]+)/$', 'website.views.pilot_profile',
+        name='website-pilot-profile'),
 
     # -------------------------------------------------------------------------
     # API views
@@ -21,9 +25,9 @@ urlpatterns = patterns('',
         name='api-website-task-result'),
 
     url(r'^api/server-info/$',
-        'website.views.api_server_info',
-        name='api-website-server-info-no-token'),
-    url(r'^api/server-info/(?P<update_token>\w+)/$',
         'website.views.api_server_info',
         name='api-website-server-info'),
+    url(r'^api/radar/$',
+        'website.views.api_radar',
+        name='api-website-radar'),
 )
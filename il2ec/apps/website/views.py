@@ -6,17 +6,25 @@ import logging
 
 from celery.result import AsyncResult
 
-from coffin.shortcuts import render, resolve_url
+from coffin.shortcuts import render, render_to_string, resolve_url
 from coffin.views.generic import TemplateView
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponseBadRequest
-from django.views.decorators.cache import cache_page
+from django.shortcuts import get_object_or_404
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import condition
 from django.utils.translation import ugettext as _
 
-from commander.helpers import (server_info_was_updated,
-    get_server_update_token, get_server_info, )
+from auth_custom.models import User
+
+from commander.helpers import (get_server_info_n_version, get_server_version,
+    get_radar, )
+from commander.models import PilotRollup
+from commander.rollups import get_rollups_version, local_today
+from commander.settings import COMMANDER_ROLLUPS
 
 from misc.tasks import send_mail
 
@@ -27,6 +35,9 @@ from website.responses import JSONResponse
 
 LOG = logging.getLogger(__name__)
 
+# Max number of pilots shown in leaderboard
+LEADERBOARD_SIZE = 100
+
 
 class BaseView(TemplateView):
     """
@@ -150,16 +161,146 @@ def api_contact(request, template_name='website/emails/contact.html'):
         return JSONResponse.form_field_errors(form)
 
 
+def server_info_etag(request, *args, **kwargs):
+    """
+    Get ETag of server info. Info depends on its version and on language of
+    request.
+    """
+    return make_server_info_etag(get_server_version(), request.LANGUAGE_CODE)
+
+
+def make_server_info_etag(version, language_code):
+    return "{0}-{1}".format(version, language_code)
+
+
 @ajax_api(method='GET')
-@cache_page(30)
-def api_server_info(request, update_token=None):
-    changed = server_info_was_updated(update_token)
-    payload = {
-        'changed': changed,
+@condition(etag_func=server_info_etag)
+def api_server_info(request):
+    """
+    Get server info. Requests with 'If-None-Match' header containing ETag of
+    current version of server info get empty 'Not Modified' response.
+    """
+    server_info, version = get_server_info_n_version()
+    response = JSONResponse.success(payload={
+        'server_info': server_info,
+        'server_info_version': version,
+    })
+    # Version could be changed after ETag was calculated
+    response['ETag'] = quote_etag(
+        make_server_info_etag(version, request.LANGUAGE_CODE))
+    return response
+
+
+@ajax_api(method='GET')
+def api_radar(request):
+    """
+    Get the latest snapshot of radar picture as it is seen by army of
+    current user. Radar is empty while user is not on it. Anonymous users
+    get an error.
+    """
+    if not request.user.is_authenticated():
+        response = JSONResponse.error(
+            message=_("You must be logged in to see radar."))
+        response.status_code = 403
+        return response
+    return JSONResponse.success(payload={
+        'radar': get_radar(request.user.callsign),
+    })
+
+
+def render_rollups_block(request, template_name, get_context, *key_parts):
+    """
+    Render block with pilots' statistics or take it from cache. Cached blocks
+    are keyed by version of rollups, so they become outdated as soon as new
+    events are added to rollups. Blocks contain nothing specific for user,
+    so they are shared by everyone who speaks the same language.
+
+    Input:
+    `template_name`     # name of block's template
+    `get_context`       # a function which returns block's context
+    `key_parts`         # values which identify contents of block
+    """
+    key = u":".join([
+        u"website", template_name, unicode(get_rollups_version()),
+        request.LANGUAGE_CODE,
+    ] + [unicode(part) for part in key_parts]).encode('utf-8')
+    content = cache.get(key)
+    if content is None:
+        content = render_to_string(template_name, get_context())
+        cache.set(key, content, COMMANDER_ROLLUPS['cache_timeout'])
+    return content
+
+
+def leaderboard(request, template_name="website/pages/leaderboard.html"):
+    """
+    A view for showing pilots with the best statistics for current day,
+    current week or for all time.
+    """
+    period = request.GET.get('period')
+    if period not in dict(PilotRollup.PERIODS):
+        period = PilotRollup.WEEK
+    order = request.GET.get('order')
+    if order not in PilotRollup.COUNTERS:
+        order = PilotRollup.COUNTERS[0]
+    start = dict(PilotRollup.get_starts(local_today()))[period]
+
+    def get_context():
+        return {
+            'rollups': PilotRollup.objects.filter(
+                period=period, start=start
+            ).select_related('user').order_by(
+                '-' + order, 'user__callsign'
+            )[:LEADERBOARD_SIZE],
+            'period': period,
+            'order': order,
+        }
+
+    context = {
+        'periods': PilotRollup.PERIODS,
+        'period': period,
+        'order': order,
+        'leaderboard': render_rollups_block(
+            request, "website/blocks/leaderboard.html", get_context,
+            period, start, order),
     }
-    if changed:
-        payload.update({
-            'server_info': get_server_info(),
-            'server_info_update_token': get_server_update_token(),
-        })
-    return JSONResponse.success(payload=payload)
+    return render(request, template_name, context)
+
+
+def pilot_profile(request, callsign,
+                  template_name="website/pages/pilot-profile.html"):
+    """
+    A view for showing statistics of a pilot for current day, current week
+    and for all time.
+    """
+    pilot = get_object_or_404(User, callsign=callsign, is_active=True)
+    starts = PilotRollup.get_starts(local_today())
+
+    def get_context():
+        rollups = {
+            (rollup.period, rollup.start): rollup for rollup in
+            PilotRollup.objects.filter(
+                user=pilot, start__in=[start for period, start in starts])
+        }
+        rows = [
+            (period, rollups.get((period, start)))
+            for period, start in starts
+        ]
+        all_time = rollups.get((PilotRollup.ALL_TIME,
+                                PilotRollup.ALL_TIME_START))
+        rank = PilotRollup.objects.filter(
+            period=PilotRollup.ALL_TIME, kills__gt=all_time.kills
+        ).count() + 1 if all_time else None
+        return {
+            'pilot': pilot,
+            'periods': dict(PilotRollup.PERIODS),
+            'rows': rows,
+            'rank': rank,
+        }
+
+    context = {
+        'pilot': pilot,
+        'stats': render_rollups_block(
+            request, "website/blocks/pilot-stats.html", get_context,
+            pilot.pk, pilot.callsign, starts[0][1]),
+    }
+    return render(request, template_name, context)
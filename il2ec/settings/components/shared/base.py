@@ -272,6 +272,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'auth_custom.tasks.delete_expired_sign_up_requests',
         'schedule': timedelta(hours=1),
     },
+    'refresh-pilots-rollups': {
+        'task': 'commander.tasks.refresh_pilots_rollups',
+        'schedule': timedelta(minutes=1),
+    },
 }
 
 # Jinja2 ----------------------------------------------------------------------
@@ -320,6 +324,11 @@ COMMANDER_API = {
     'host': '127.0.0.1',
     'port': 20001,
 }
+COMMANDER_PUSH = {
+    'host': '127.0.0.1',
+    'port': 20002,
+    'url': '/push/',
+}
 COMMANDER_LOG = {
     'filename': os.path.join(LOG_ROOT, 'il2ec-daemon.log'),
     'level': "DEBUG",